@@ -76,6 +76,9 @@ class CropSegLayer(caffe.Layer):
         ins_cropped_resized = np.zeros((len(all_rois), pch, self.pooled_w, self.pooled_h), dtype=np.float32)
         # pad_corr = all_rois[:, 1:].copy()
 
+        # pixels of each instance in the whole map, counted once
+        full_pic_nums = dict(zip(*np.unique(ins_gt, return_counts=True)))
+
         for ix, roi in enumerate(all_rois):
             # print 'roi', roi
             x_start = int(math.floor(roi[1]))
@@ -106,13 +109,14 @@ class CropSegLayer(caffe.Layer):
             # print 'ins_cropped.shape', ins_cropped.shape
 
             full_roi_num = ins_cropped.size
-            ins_cropped_ravel = list(ins_cropped.copy().ravel())
-            precision_dict = {k: ins_cropped_ravel.count(k) / (full_roi_num + 0.0) for k in set(ins_cropped_ravel)}
+            crop_ids, in_box_nums = np.unique(ins_cropped, return_counts=True)
+            in_box_nums = dict(zip(crop_ids, in_box_nums))
+            precision_dict = {k: in_box_nums[k] / (full_roi_num + 0.0) for k in crop_ids}
 
             recall_dict = {}
             for d_i, _ in precision_dict.items():
-                in_box_num = ins_cropped[ins_cropped == d_i].size
-                full_pic_num = ins_gt[ins_gt == d_i].size
+                in_box_num = in_box_nums[d_i]
+                full_pic_num = full_pic_nums[d_i]
                 recall = in_box_num / (full_pic_num + 0.0)
                 recall_dict[d_i] = recall
             recall_dict = sorted(recall_dict.items(), lambda x, y: cmp(x[1], y[1]), reverse=True)
@@ -73,3 +73,42 @@ def clip_boxes(boxes, im_shape):
     # y2 < im_shape[0]
     boxes[:, 3::4] = np.maximum(np.minimum(boxes[:, 3::4], im_shape[0] - 1), 0)
     return boxes
+
+def expand_bbox_targets(bbox_target_data, num_classes, inside_weights,
+                        agnostic=False, out=None):
+    """Expand compact N x (class, tx, ty, tw, th) regression targets into the
+    4-of-4K representation used by the network (only the columns of the
+    class, or of the foreground with agnostic, are non-zero), with the loss
+    weights expanded the same way, in one scatter.
+
+    Arguments:
+        bbox_target_data (ndarray): N x 5 compact targets
+        num_classes (int): K
+        inside_weights (sequence): the 4 loss weights of a foreground RoI
+        agnostic (bool): class-agnostic regression (K is then 2)
+        out (tuple): N x 4K float32 (bbox_targets, bbox_inside_weights) to
+            fill (e.g. from a utils.blob.BlobBuffer), allocated if None
+
+    Returns:
+        bbox_targets (ndarray): N x 4K blob of regression targets
+        bbox_inside_weights (ndarray): N x 4K blob of loss weights
+    """
+    clss = bbox_target_data[:, 0]
+    if out is None:
+        shape = (clss.size, 4 * num_classes)
+        bbox_targets = np.zeros(shape, dtype=np.float32)
+        bbox_inside_weights = np.zeros(shape, dtype=np.float32)
+    else:
+        bbox_targets, bbox_inside_weights = out
+        bbox_targets.fill(0)
+        bbox_inside_weights.fill(0)
+    inds = np.where(clss > 0)[0]
+    if agnostic:
+        starts = np.full(inds.size, 4, dtype=np.int64)
+    else:
+        starts = (4 * clss[inds]).astype(np.int64)
+    rows = inds[:, np.newaxis]
+    cols = starts[:, np.newaxis] + np.arange(4)
+    bbox_targets[rows, cols] = bbox_target_data[inds, 1:]
+    bbox_inside_weights[rows, cols] = inside_weights
+    return bbox_targets, bbox_inside_weights
@@ -40,6 +40,18 @@ __C.TRAIN.SCALES = (800,)
 # Max pixel size of the longest side of a scaled input image
 __C.TRAIN.MAX_SIZE = 1333
 
+# Resize the training images in uint8 and subtract PIXEL_MEANS while writing
+# the blob (see utils.blob.prep_im_for_blob), instead of resizing a float32
+# copy of the full image. Pixel values differ from the float path by rounding
+# (up to ~0.8 per pixel, see tools/bench_prep_im.py), so it is off by default
+__C.TRAIN.UINT8_RESIZE = False
+
+# Decode JPEG training images at 1/2, 1/4 or 1/8 resolution when they are
+# downscaled at least that much (see utils.image_io.read_image). Lossy: the
+# blob pixels differ from decoding at full resolution, so training results do
+# not reproduce those of the full-resolution path
+__C.TRAIN.REDUCED_DECODE = False
+
 # Images to use per minibatch
 __C.TRAIN.IMS_PER_BATCH = 1
 
@@ -74,9 +86,38 @@ __C.TRAIN.SNAPSHOT_ITERS = 1250
 # infix to yield the path: <prefix>[_<infix>]_iters_XYZ.caffemodel
 __C.TRAIN.SNAPSHOT_INFIX = ''
 
-# Use a prefetch thread in roi_data_layer.layer
-# So far I haven't found this useful; likely more engineering work is required
-__C.TRAIN.USE_PREFETCH = False
+# Number of worker processes building minibatches ahead of time in
+# roi_data_layer.layer (0 builds them in the layer's forward)
+__C.TRAIN.USE_PREFETCH = 0
+
+# Use threads instead of processes for the prefetch workers
+__C.TRAIN.PREFETCH_THREADS = False
+
+# Number of built minibatches each prefetch worker may queue
+__C.TRAIN.PREFETCH_DEPTH = 2
+
+# Prefetch worker processes build the minibatches in shared memory slots
+# instead of pickling them through a queue
+__C.TRAIN.PREFETCH_SHARED_MEMORY = True
+
+# Size in MB of the in-memory LRU cache of decoded training images and
+# instance maps, shared with the prefetch workers (0 disables it)
+__C.TRAIN.IMAGE_CACHE_MB = 0
+
+# Directory of the training images pre-rendered at TRAIN.SCALES by
+# tools/prescale_images.py ('' to resize every image online). Images missing
+# from it, or changed since, are resized online
+__C.TRAIN.PRESCALED_DIR = ''
+
+# Index of the instance label maps written by tools/build_instance_index.py
+# ('' to scan the maps at every iteration). The mask targets of the indexed
+# maps come from the index
+__C.TRAIN.INSTANCE_INDEX = ''
+
+# Seconds between two summaries of the time spent building each blob of the
+# minibatches (see utils/profiler.py), printed by roi_data_layer.layer or by
+# each prefetch worker process; a negative value disables them
+__C.TRAIN.PROFILE_INTERVAL = -1.
 
 # Normalize the targets (subtract empirical mean, divide by empirical stddev)
 __C.TRAIN.BBOX_NORMALIZE_TARGETS = True
@@ -143,6 +184,48 @@ __C.TEST.SCALES = (600,)
 # Max pixel size of the longest side of a scaled input image
 __C.TEST.MAX_SIZE = 1000
 
+# Resize the test image pyramid in uint8 (each level from the nearest larger
+# one) and subtract PIXEL_MEANS while writing the blob, instead of resizing a
+# float32 copy of the full image for every entry of SCALES. Also used by the
+# batched test blob and rpn.generate. Pixel values differ from the float path
+# by rounding, so reported accuracy may drift from it; off by default
+__C.TEST.UINT8_PYRAMID = False
+
+# Decode JPEG test images at 1/2, 1/4 or 1/8 resolution when every entry of
+# SCALES downscales them at least that much (see utils.image_io.read_image).
+# Lossy: the blob pixels, and so the reported accuracy, differ from decoding
+# at full resolution
+__C.TEST.REDUCED_DECODE = False
+
+# Images to push through the net per forward pass in test_net (requires a
+# single entry in SCALES); images are zero-padded to the largest in the batch
+__C.TEST.IMS_PER_BATCH = 1
+
+# Overlap image decoding, the forward pass and post-processing (NMS, mask
+# writing) in test_net / test_net_mask with a pipeline of thread pools
+__C.TEST.PIPELINE = False
+# Threads decoding and preprocessing images ahead of the forward pass
+__C.TEST.PIPELINE_PREPARE_THREADS = 2
+# Threads post-processing the outputs of the forward pass
+__C.TEST.PIPELINE_POST_THREADS = 2
+# Max number of batches buffered between two stages of the pipeline
+__C.TEST.PIPELINE_DEPTH = 4
+
+# Seconds between two latency summaries (see utils/profiler.py) printed while
+# testing; a negative value disables them. The statistics of the whole run are
+# always written to profile.json / profile.csv in the output dir
+__C.TEST.PROFILE_INTERVAL = 10.
+
+# Zero-pad each input blob to the smallest of a fixed set of canvas sizes
+# (see fast_rcnn/shape_buckets.py), so the net is not reshaped for every
+# image; im_info keeps the real size of the resized image
+__C.TEST.SHAPE_BUCKETS = False
+# Long side / short side ratios of the bucket canvases; canvases with the long
+# side at MAX_SIZE are always added
+__C.TEST.BUCKET_ASPECTS = (1.0, 1.5)
+# Bucket canvas sides are rounded up to a multiple of this
+__C.TEST.BUCKET_STRIDE = 32
+
 # Overlap threshold used for non-maximum suppression (suppress boxes with
 # IoU >= this threshold)
 __C.TEST.NMS = 0.3
@@ -172,6 +255,12 @@ __C.TEST.RPN_MIN_SIZE = 16
 # whether use class aware box or not
 __C.TEST.AGNOSTIC = False
 
+# A pasted mask pixel is foreground if its mask probability is > MASK_THRESH
+__C.TEST.MASK_THRESH = 0.5
+# Upsample mask probabilities bilinearly before thresholding them when
+# pasting masks into the image (nearest-neighbor sampling otherwise)
+__C.TEST.MASK_BILINEAR = False
+
 
 #
 # MISC
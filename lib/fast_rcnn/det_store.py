@@ -0,0 +1,237 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Append-only on-disk store of test detections.
+
+A store is a directory of raw column files:
+
+    boxes.f32    N x 4 float32 (x1, y1, x2, y2)
+    scores.f32   N float32
+    labels.i32   N int32 class indices
+    index.i64    one (image, start, count) int64 row per appended image
+    meta.json    number of images and classes
+
+The detections of an image are appended as soon as it is done, sorted by
+class, and its index row is written last. A run that crashes therefore
+leaves a valid store holding every image that completed, and the memory of
+the test loop does not grow with the size of the dataset. The reader maps
+the columns with np.memmap and serves all_boxes[cls][image] lazily.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+
+_COLUMNS = (('boxes', np.float32, 4), ('scores', np.float32, 1),
+            ('labels', np.int32, 1))
+_INDEX_FILE = 'index.i64'
+_META_FILE = 'meta.json'
+
+
+def _column_file(path, name, dtype):
+    return os.path.join(path, '{:s}.{:s}{:d}'.format(
+        name, np.dtype(dtype).kind, np.dtype(dtype).itemsize * 8))
+
+
+def _read_index(path):
+    """Return the (image, start, count) rows of the store at path."""
+    index = np.fromfile(os.path.join(path, _INDEX_FILE), dtype=np.int64)
+    return index[:len(index) // 3 * 3].reshape(-1, 3)
+
+
+class DetectionWriter(object):
+    """Append the detections of each image to the store at path.
+
+    Arguments:
+        path (str): directory of the store
+        num_images (int): number of images of the test set
+        num_classes (int): number of classes, background included
+        resume (bool): keep the images already in the store (dropping any
+            rows written after its last complete image) instead of
+            starting an empty store
+    """
+
+    def __init__(self, path, num_images, num_classes, resume=False):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self._lock = threading.Lock()
+
+        index = np.zeros((0, 3), dtype=np.int64)
+        if resume and os.path.exists(os.path.join(path, _INDEX_FILE)):
+            index = _read_index(path)
+        self.done = set(index[:, 0].tolist())
+        self._num_rows = int((index[:, 1] + index[:, 2]).max()) \
+            if len(index) else 0
+
+        with open(os.path.join(path, _META_FILE), 'w') as f:
+            json.dump({'num_images': num_images,
+                       'num_classes': num_classes}, f)
+        # truncate whatever a crashed run wrote after its last index row
+        self._files = []
+        for name, dtype, width in _COLUMNS:
+            f = open(_column_file(path, name, dtype), 'ab' if resume else 'wb')
+            f.truncate(self._num_rows * width * np.dtype(dtype).itemsize)
+            f.seek(0, os.SEEK_END)
+            self._files.append(f)
+        self._index = open(os.path.join(path, _INDEX_FILE),
+                           'ab' if resume else 'wb')
+        self._index.truncate(index.nbytes)
+        self._index.seek(0, os.SEEK_END)
+
+    def append(self, image, dets, labels):
+        """Store the detections of an image.
+
+        Arguments:
+            image (int): index of the image in the test set
+            dets (ndarray): N x 5 array of (x1, y1, x2, y2, score)
+            labels (ndarray): N class indices of dets
+        """
+        labels = np.asarray(labels, dtype=np.int32)
+        if np.any(labels[1:] < labels[:-1]):
+            order = np.argsort(labels, kind='mergesort')
+            dets, labels = dets[order], labels[order]
+        columns = (dets[:, :4], dets[:, 4], labels)
+        with self._lock:
+            for f, (_, dtype, _), column in zip(self._files, _COLUMNS,
+                                                columns):
+                f.write(np.ascontiguousarray(column, dtype=dtype).tobytes())
+                f.flush()
+            # the index row commits the image
+            self._index.write(np.array([image, self._num_rows, len(labels)],
+                                       dtype=np.int64).tobytes())
+            self._index.flush()
+            self._num_rows += len(labels)
+            self.done.add(image)
+
+    def close(self):
+        for f in self._files + [self._index]:
+            f.close()
+
+
+class _ClassBoxes(object):
+    """all_boxes[cls] of a DetectionReader: indexed by image."""
+
+    def __init__(self, reader, cls):
+        self._reader = reader
+        self._cls = cls
+
+    def __len__(self):
+        return self._reader.num_images
+
+    def __getitem__(self, image):
+        return self._reader.class_dets(image, self._cls)
+
+    def __iter__(self):
+        for image in xrange(len(self)):
+            yield self[image]
+
+
+class _AllBoxes(object):
+    """Lazy all_boxes[cls][image] view of a DetectionReader."""
+
+    def __init__(self, reader):
+        self._reader = reader
+
+    def __len__(self):
+        return self._reader.num_classes
+
+    def __getitem__(self, cls):
+        return _ClassBoxes(self._reader, cls)
+
+    def __iter__(self):
+        for cls in xrange(len(self)):
+            yield self[cls]
+
+
+class DetectionReader(object):
+    """Memory-mapped view of the store at path."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, _META_FILE), 'r') as f:
+            meta = json.load(f)
+        self.num_images = meta['num_images']
+        self.num_classes = meta['num_classes']
+
+        index = _read_index(path)
+        # later rows win if an image was appended twice
+        self._start = np.zeros(self.num_images, dtype=np.int64)
+        self._count = np.zeros(self.num_images, dtype=np.int64)
+        self._start[index[:, 0]] = index[:, 1]
+        self._count[index[:, 0]] = index[:, 2]
+        self.done = np.zeros(self.num_images, dtype=np.bool)
+        self.done[index[:, 0]] = True
+
+        num_rows = int((index[:, 1] + index[:, 2]).max()) if len(index) else 0
+        self._columns = {}
+        for name, dtype, width in _COLUMNS:
+            shape = (num_rows, width) if width > 1 else (num_rows,)
+            if num_rows == 0:
+                # np.memmap refuses empty files
+                self._columns[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self._columns[name] = np.memmap(
+                    _column_file(path, name, dtype), dtype=dtype, mode='r',
+                    shape=shape)
+
+    def image_dets(self, image):
+        """Return the detections of an image as (dets, labels), with dets
+        the N x 5 float32 array of (x1, y1, x2, y2, score) sorted by class.
+        """
+        start = self._start[image]
+        end = start + self._count[image]
+        dets = np.hstack((self._columns['boxes'][start:end],
+                          self._columns['scores'][start:end, np.newaxis]))
+        return dets, np.array(self._columns['labels'][start:end])
+
+    def class_dets(self, image, cls):
+        """Return the N x 5 float32 detections of class cls in an image."""
+        start = self._start[image]
+        labels = self._columns['labels'][start:start + self._count[image]]
+        lo, hi = start + np.searchsorted(labels, [cls, cls + 1])
+        return np.hstack((self._columns['boxes'][lo:hi],
+                          self._columns['scores'][lo:hi, np.newaxis]))
+
+    def all_boxes(self):
+        """Return a lazy all_boxes[cls][image] view of the store, as
+        consumed by imdb.evaluate_detections.
+        """
+        return _AllBoxes(self)
+
+
+def shard_path(path, shard):
+    """Path of the store of shard (index, count) of the store at path."""
+    return '{:s}_shard{:d}of{:d}'.format(path, shard[0], shard[1])
+
+
+def merge_stores(paths, path):
+    """Merge the stores at paths (e.g. the shards of a test run) into a new
+    store at path.
+
+    Images are appended in index order; an image found in several stores is
+    taken from the first of paths that holds it, so the merged store only
+    depends on the order of paths.
+
+    Returns:
+        missing (list): indices of the images found in none of the stores
+    """
+    readers = [DetectionReader(p) for p in paths]
+    num_images = readers[0].num_images
+    num_classes = readers[0].num_classes
+    assert all(r.num_images == num_images and r.num_classes == num_classes
+               for r in readers), 'The stores do not cover the same test set'
+
+    store = DetectionWriter(path, num_images, num_classes)
+    missing = []
+    for image in xrange(num_images):
+        for reader in readers:
+            if reader.done[image]:
+                store.append(image, *reader.image_dets(image))
+                break
+        else:
+            missing.append(image)
+    store.close()
+    return missing
@@ -0,0 +1,56 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Pool of warm caffe.Net instances.
+
+Building a caffe.Net parses the prototxt and the (large) caffemodel, which
+costs far more than a forward pass. The pool builds each (prototxt, weights)
+pair once and hands out the same net on every later request.
+"""
+
+import os
+import threading
+import caffe
+
+
+class ModelPool(object):
+    """Load each (prototxt, weights) pair once and keep the net warm."""
+
+    def __init__(self, phase=caffe.TEST):
+        self._phase = phase
+        self._nets = {}
+        self._lock = threading.Lock()
+
+    def get(self, prototxt, weights, share_with=None):
+        """Return the net for (prototxt, weights), building it on first use.
+
+        Arguments:
+            prototxt (str): path to the network definition
+            weights (str): path to the caffemodel
+            share_with (caffe.Net): if given, the parameters of every layer
+                whose name also exists in share_with are shared with it
+                (e.g. the backbone of a mask net and a detection net), so
+                only one copy of them is kept in memory
+
+        Returns:
+            net (caffe.Net): a net named after the weights file
+        """
+        key = (os.path.abspath(prototxt), os.path.abspath(weights),
+               id(share_with) if share_with is not None else None)
+        with self._lock:
+            net = self._nets.get(key)
+            if net is None:
+                net = caffe.Net(prototxt, weights, self._phase)
+                net.name = os.path.splitext(os.path.basename(weights))[0]
+                if share_with is not None:
+                    # layers missing from share_with keep their own weights
+                    net.share_with(share_with)
+                self._nets[key] = net
+        return net
+
+    def clear(self):
+        """Drop every net held by the pool."""
+        with self._lock:
+            self._nets = {}
@@ -5,9 +5,10 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
+import numpy as np
 from fast_rcnn.config import cfg
 from nms.gpu_nms import gpu_nms
-from nms.cpu_nms import cpu_nms
+from nms.cpu_nms import cpu_nms, cpu_nms_grouped
 
 def nms(dets, thresh, force_cpu=False):
     """Dispatch to either CPU or GPU NMS implementations."""
@@ -19,3 +20,86 @@ def nms(dets, thresh, force_cpu=False):
         return gpu_nms(dets, thresh, device_id=GPU_ID)
     else:
         return cpu_nms(dets, thresh)
+
+def class_nms(dets, labels, thresh, force_cpu=False):
+    """NMS applied independently to the boxes of each label, in one call.
+
+    Arguments:
+        dets (ndarray): N x 5 float32 array of (x1, y1, x2, y2, score)
+        labels (ndarray): N class labels
+        thresh (float): overlap threshold
+
+    Returns:
+        keep (ndarray): indices of the kept boxes, sorted by label and then
+            by descending score
+    """
+    if dets.shape[0] == 0:
+        return np.zeros((0,), dtype=np.int64)
+    labels = labels.astype(np.int32, copy=False)
+    if cfg.USE_GPU_NMS and not force_cpu:
+        # Shift the boxes of every label into their own region of the plane,
+        # so boxes of different labels never overlap and a single NMS call
+        # handles all labels
+        offsets = labels * (dets[:, :4].max() + 1)
+        shifted = dets.copy()
+        shifted[:, :4] += offsets[:, np.newaxis]
+        GPU_ID = cfg.GPU_ID[0] if isinstance(cfg.GPU_ID, list) else cfg.GPU_ID
+        keep = np.array(gpu_nms(shifted, thresh, device_id=GPU_ID),
+                        dtype=np.int64)
+        return keep[np.lexsort((-dets[keep, 4], labels[keep]))]
+    return cpu_nms_grouped(dets, labels, thresh)
+
+def multiclass_nms(scores, boxes, thresh, score_thresh=-np.inf,
+                   max_per_image=0, agnostic=False, force_cpu=False):
+    """Class-aware NMS over the outputs of im_detect in a single call.
+
+    Arguments:
+        scores (ndarray): R x K array of class scores (class 0 is background)
+        boxes (ndarray): R x 4K array of per-class boxes (with agnostic, the
+            boxes in columns 4:8 are used for every class)
+        thresh (float): NMS overlap threshold
+        score_thresh (float): only boxes scoring > score_thresh are kept
+        max_per_image (int): if > 0, only keep the detections scoring at
+            least as high as the max_per_image-th best over all classes
+
+    Returns:
+        dets (ndarray): M x 5 float32 array of (x1, y1, x2, y2, score)
+        labels (ndarray): class of each detection; detections are sorted by
+            class and then by descending score
+    """
+    num_boxes, num_classes = scores.shape
+    if num_boxes == 0:
+        return (np.zeros((0, 5), dtype=np.float32),
+                np.zeros((0,), dtype=np.int64))
+    inds, labels = np.nonzero(scores[:, 1:] > score_thresh)
+    labels += 1
+    dets = np.empty((len(inds), 5), dtype=np.float32)
+    if agnostic:
+        dets[:, :4] = boxes[inds, 4:8]
+    else:
+        dets[:, :4] = boxes.reshape(num_boxes, -1, 4)[inds, labels]
+    dets[:, 4] = scores[inds, labels]
+
+    keep = class_nms(dets, labels, thresh, force_cpu=force_cpu)
+    dets = dets[keep]
+    labels = labels[keep]
+
+    # Limit to max_per_image detections *over all classes*
+    if max_per_image > 0 and len(dets) > max_per_image:
+        image_scores = dets[:, 4]
+        kth = np.argpartition(image_scores, -max_per_image)[-max_per_image]
+        keep = np.where(image_scores >= image_scores[kth])[0]
+        dets = dets[keep]
+        labels = labels[keep]
+    return dets, labels
+
+def split_by_class(dets, labels, num_classes):
+    """Split the output of multiclass_nms into per-class arrays.
+
+    Returns:
+        cls_dets (list): cls_dets[j] holds the detections of class j
+            (cls_dets[0], the background, is [])
+    """
+    bounds = np.searchsorted(labels, np.arange(num_classes + 1))
+    return [[]] + [dets[bounds[j]:bounds[j + 1]]
+                   for j in xrange(1, num_classes)]
@@ -0,0 +1,177 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Pipelined executor that overlaps decoding, forward and post-processing.
+
+Work items flow through three stages:
+
+    prepare (thread pool) -> forward (caller's thread) -> post (thread pool)
+
+The prepare pool decodes and preprocesses images and stays up to `depth`
+items ahead of the forward stage. The forward stage runs on the thread that
+called run(), since a caffe.Net must not be shared between threads. The post
+pool consumes forward outputs (NMS, trimming, writing results). Both queues
+are bounded so memory stays flat no matter how large the image set is.
+"""
+
+import threading
+import time
+import sys
+import Queue
+
+# Marks the end of the work stream in a queue
+_STOP = object()
+
+
+class _StageStats(object):
+    """Accumulated busy time of the workers of one stage."""
+
+    def __init__(self, name, num_workers):
+        self.name = name
+        self.num_workers = num_workers
+        self.busy_time = 0.
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def add(self, diff):
+        with self._lock:
+            self.busy_time += diff
+            self.calls += 1
+
+    def utilisation(self, wall_time):
+        if wall_time <= 0:
+            return 0.
+        return self.busy_time / (wall_time * self.num_workers)
+
+
+class Pipeline(object):
+    """Run prepare_fn, forward_fn and post_fn over a stream of items.
+
+    Arguments:
+        prepare_fn (callable): item -> payload, run in the prepare pool
+        forward_fn (callable): (item, payload) -> output, run in the caller's
+            thread in the order payloads become ready
+        post_fn (callable): (item, output) -> None, run in the post pool
+        num_prepare (int): number of prepare threads
+        num_post (int): number of post-processing threads
+        depth (int): max number of items buffered between two stages
+    """
+
+    def __init__(self, prepare_fn, forward_fn, post_fn, num_prepare=2,
+                 num_post=2, depth=4):
+        assert num_prepare > 0 and num_post > 0 and depth > 0
+        self._prepare_fn = prepare_fn
+        self._forward_fn = forward_fn
+        self._post_fn = post_fn
+        self._num_prepare = num_prepare
+        self._num_post = num_post
+        self._depth = depth
+        self._error = None
+        self.stats = {}
+        self.wall_time = 0.
+
+    def _fail(self):
+        # keep the first exception raised by any worker
+        if self._error is None:
+            self._error = sys.exc_info()
+
+    def _prepare_worker(self, in_queue, ready_queue, stats):
+        while True:
+            item = in_queue.get()
+            if item is _STOP:
+                ready_queue.put(_STOP)
+                return
+            if self._error is not None:
+                continue
+            try:
+                start = time.time()
+                payload = self._prepare_fn(item)
+                stats.add(time.time() - start)
+            except Exception:
+                self._fail()
+                continue
+            ready_queue.put((item, payload))
+
+    def _post_worker(self, post_queue, stats):
+        while True:
+            entry = post_queue.get()
+            if entry is _STOP:
+                return
+            if self._error is not None:
+                continue
+            try:
+                start = time.time()
+                self._post_fn(*entry)
+                stats.add(time.time() - start)
+            except Exception:
+                self._fail()
+
+    def run(self, items):
+        """Push every item through the pipeline and wait for completion."""
+        items = list(items)
+        self.stats = {
+            'prepare': _StageStats('prepare', self._num_prepare),
+            'forward': _StageStats('forward', 1),
+            'post': _StageStats('post', self._num_post)}
+        self._error = None
+
+        in_queue = Queue.Queue()
+        ready_queue = Queue.Queue(self._depth)
+        post_queue = Queue.Queue(self._depth)
+        for item in items:
+            in_queue.put(item)
+        for _ in xrange(self._num_prepare):
+            in_queue.put(_STOP)
+
+        workers = [threading.Thread(target=self._prepare_worker,
+                                    args=(in_queue, ready_queue,
+                                          self.stats['prepare']))
+                   for _ in xrange(self._num_prepare)]
+        workers += [threading.Thread(target=self._post_worker,
+                                     args=(post_queue, self.stats['post']))
+                    for _ in xrange(self._num_post)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        start_time = time.time()
+        num_stopped = 0
+        try:
+            while num_stopped < self._num_prepare:
+                entry = ready_queue.get()
+                if entry is _STOP:
+                    num_stopped += 1
+                    continue
+                if self._error is not None:
+                    # drain the prepare pool so its threads can exit
+                    continue
+                item, payload = entry
+                try:
+                    start = time.time()
+                    output = self._forward_fn(item, payload)
+                    self.stats['forward'].add(time.time() - start)
+                except Exception:
+                    self._fail()
+                    continue
+                post_queue.put((item, output))
+        finally:
+            for _ in xrange(self._num_post):
+                post_queue.put(_STOP)
+            for w in workers:
+                w.join()
+            self.wall_time = time.time() - start_time
+
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def summary(self):
+        """Return a one-line report of per-stage utilisation."""
+        parts = ['{:s} {:.1f}% ({:d}x{:.3f}s)'.format(
+                     name, 100. * s.utilisation(self.wall_time), s.num_workers,
+                     s.busy_time / max(s.calls, 1))
+                 for name, s in [(n, self.stats[n])
+                                 for n in ('prepare', 'forward', 'post')]]
+        return 'pipeline: {:.3f}s wall, utilisation: {:s}'.format(
+            self.wall_time, ', '.join(parts))
@@ -0,0 +1,110 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Fixed canvas sizes for test-time input blobs.
+
+Resizing images to TEST.SCALES / TEST.MAX_SIZE gives a different blob shape
+for nearly every aspect ratio, and every new shape makes Caffe reshape all
+intermediate blobs (and the cuDNN workspaces) of the net. Padding each image
+blob to the smallest of a few canvas sizes keeps the net at a handful of
+shapes. The padding goes to the bottom and right, as in im_list_to_blob, and
+im_info keeps the real image size, so RoIs and proposals are unaffected.
+"""
+
+import threading
+from collections import Counter
+import numpy as np
+from fast_rcnn.config import cfg
+
+
+def _round_up(x, stride):
+    return int(np.ceil(x / float(stride)) * stride)
+
+
+class ShapeBuckets(object):
+    """Canvas sizes for the images resized to scales / max_size.
+
+    For each scale and long / short side ratio in aspects, a landscape and a
+    portrait canvas are made, plus the canvases whose long side is max_size,
+    which fit any resized image. Sides are rounded up to a multiple of stride.
+
+    Arguments:
+        scales (tuple): pixel sizes of the shortest image side
+        max_size (int): max pixel size of the longest image side
+        aspects (tuple): long side / short side ratios of the canvases
+        stride (int): canvas sides are multiples of stride
+    """
+
+    def __init__(self, scales, max_size, aspects=(1.0,), stride=32):
+        canvases = set()
+        for scale in scales:
+            short = _round_up(min(scale, max_size), stride)
+            for aspect in tuple(aspects) + (float(max_size) / scale,):
+                aspect = max(aspect, 1. / aspect)
+                long_side = _round_up(min(scale * aspect, max_size), stride)
+                canvases.add((short, long_side))
+                canvases.add((long_side, short))
+        # smallest canvas first
+        self.canvases = sorted(canvases, key=lambda c: (c[0] * c[1], c))
+        self.hits = Counter()
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def select(self, height, width):
+        """Return the smallest (height, width) canvas that fits a blob of
+        height x width, or None if no canvas is large enough.
+        """
+        for canvas in self.canvases:
+            if canvas[0] >= height and canvas[1] >= width:
+                with self._lock:
+                    self.hits[canvas] += 1
+                return canvas
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def summary(self):
+        """Return a one-line histogram of the canvas hits."""
+        parts = ['{:d}x{:d}: {:d}'.format(h, w, self.hits[(h, w)])
+                 for h, w in self.canvases]
+        parts.append('unbucketed: {:d}'.format(self.misses))
+        return 'shape buckets: {:s}'.format(', '.join(parts))
+
+
+# ShapeBuckets built from the config, by (scales, max_size, aspects, stride)
+_buckets = {}
+
+def get_shape_buckets():
+    """Return the ShapeBuckets of the current TEST config."""
+    key = (tuple(cfg.TEST.SCALES), cfg.TEST.MAX_SIZE,
+           tuple(cfg.TEST.BUCKET_ASPECTS), cfg.TEST.BUCKET_STRIDE)
+    if key not in _buckets:
+        _buckets[key] = ShapeBuckets(*key)
+    return _buckets[key]
+
+
+def set_data_blob(net, data, name='data'):
+    """Copy the image blob data into the input blob of net.
+
+    With TEST.SHAPE_BUCKETS, data is zero-padded to its canvas, so net is
+    only reshaped when consecutive images fall in different buckets.
+    Otherwise the input blob takes the shape of data.
+    """
+    blob = net.blobs[name]
+    n, c, height, width = data.shape
+    canvas = None
+    if cfg.TEST.SHAPE_BUCKETS:
+        canvas = get_shape_buckets().select(height, width)
+    if canvas is None:
+        blob.reshape(*data.shape)
+        blob.data[...] = data
+        return
+    if blob.data.shape != (n, c) + canvas:
+        blob.reshape(n, c, canvas[0], canvas[1])
+    target = blob.data
+    target[:, :, :height, :width] = data
+    # the rest of the canvas may hold the previous image
+    target[:, :, height:, :] = 0
+    target[:, :, :height, width:] = 0
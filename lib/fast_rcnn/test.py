@@ -10,16 +10,22 @@
 from fast_rcnn.config import cfg, get_output_dir
 from fast_rcnn.bbox_transform import clip_boxes, bbox_transform_inv
 import argparse
-from utils.timer import Timer
+from utils.profiler import get_profiler
 import numpy as np
 import cv2
 import os
 os.environ['GLOG_minloglevel'] = '2'
 import caffe
-from fast_rcnn.nms_wrapper import nms
-import cPickle
-from utils.blob import im_list_to_blob
-import os
+from fast_rcnn.nms_wrapper import nms, class_nms, multiclass_nms, split_by_class
+from utils.blob import im_list_to_blob, im_pyramid, prep_im_for_blob, \
+    get_im_scale
+from utils.image_io import image_size, read_image
+from utils.masks import paste_masks
+from fast_rcnn.pipeline import Pipeline
+from fast_rcnn.model_pool import ModelPool
+from fast_rcnn.shape_buckets import set_data_blob, get_shape_buckets
+from fast_rcnn.det_store import DetectionWriter, DetectionReader, shard_path
+import time
 
 def _get_image_blob(im):
     """Converts an image into a network input.
@@ -32,24 +38,32 @@ def _get_image_blob(im):
         im_scale_factors (list): list of image scales (relative to im) used
             in the image pyramid
     """
-    im_orig = im.astype(np.float32, copy=True)
-    im_orig -= cfg.PIXEL_MEANS
-
-    im_shape = im_orig.shape
+    im_shape = im.shape
     im_size_min = np.min(im_shape[0:2])
     im_size_max = np.max(im_shape[0:2])
 
-    processed_ims = []
     im_scale_factors = []
-
     for target_size in cfg.TEST.SCALES:
         im_scale = float(target_size) / float(im_size_min)
         # Prevent the biggest axis from being more than MAX_SIZE
         if np.round(im_scale * im_size_max) > cfg.TEST.MAX_SIZE:
             im_scale = float(cfg.TEST.MAX_SIZE) / float(im_size_max)
+        im_scale_factors.append(im_scale)
+
+    if cfg.TEST.UINT8_PYRAMID:
+        # resize the image as it was decoded and subtract the means while
+        # writing the blob
+        processed_ims = im_pyramid(im, im_scale_factors)
+        blob = im_list_to_blob(processed_ims, pixel_means=cfg.PIXEL_MEANS)
+        return blob, np.array(im_scale_factors)
+
+    im_orig = im.astype(np.float32, copy=True)
+    im_orig -= cfg.PIXEL_MEANS
+
+    processed_ims = []
+    for im_scale in im_scale_factors:
         im = cv2.resize(im_orig, None, None, fx=im_scale, fy=im_scale,
                         interpolation=cv2.INTER_LINEAR)
-        im_scale_factors.append(im_scale)
         processed_ims.append(im)
 
     # Create a blob to hold the input images
@@ -57,6 +71,38 @@ def _get_image_blob(im):
 
     return blob, np.array(im_scale_factors)
 
+def _get_image_batch_blob(ims):
+    """Converts a list of images into a single-scale batched network input.
+
+    Arguments:
+        ims (list): color images in BGR order
+
+    Returns:
+        blob (ndarray): a data blob holding the images, zero-padded to the
+            largest resized image in the batch
+        im_info (ndarray): N x 3 array of (height, width, scale) for each
+            resized image, relative to the corresponding entry of ims
+    """
+    assert len(cfg.TEST.SCALES) == 1, \
+        'Batched testing only supports a single entry in TEST.SCALES'
+    target_size = cfg.TEST.SCALES[0]
+
+    processed_ims = []
+    im_info = np.zeros((len(ims), 3))
+
+    fused = cfg.TEST.UINT8_PYRAMID
+    for i, im in enumerate(ims):
+        im, im_scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size,
+                                        cfg.TEST.MAX_SIZE, fused=fused)
+        im_info[i, :] = (im.shape[0], im.shape[1], im_scale)
+        processed_ims.append(im)
+
+    # Create a blob to hold the input images
+    blob = im_list_to_blob(processed_ims,
+                           pixel_means=cfg.PIXEL_MEANS if fused else None)
+
+    return blob, im_info
+
 def _get_rois_blob(im_rois, im_scale_factors):
     """Converts RoIs into network inputs.
 
@@ -99,14 +145,120 @@ def _project_im_rois(im_rois, scales):
 
     return rois, levels
 
-def _get_blobs(im, rois, mask=False):
-    """Convert an image and RoIs within that image into network inputs."""
+def _get_im_info(im_shape, im_scales):
+    """Return the (height, width, scale) rows of the pyramid levels built by
+    _get_image_blob for an image of shape im_shape.
+    """
+    return np.array([[np.round(im_shape[0] * s), np.round(im_shape[1] * s), s]
+                     for s in im_scales], dtype=np.float32)
+
+def _read_image(path, full_res=False):
+    """Decode the test image at path, at reduced resolution if
+    TEST.REDUCED_DECODE allows it and full_res (e.g. to draw on it) is not
+    set.
+
+    Returns:
+        im (ndarray): the decoded image
+        im_shape (tuple): shape of the full-resolution image
+        decode_scale (float): scale of im relative to the full-resolution
+            image
+    """
+    if full_res or not cfg.TEST.REDUCED_DECODE:
+        im = cv2.imread(path)
+        return im, im.shape, 1.
+    height, width = image_size(path)
+    max_scale = max(get_im_scale((height, width), target_size,
+                                 cfg.TEST.MAX_SIZE)
+                    for target_size in cfg.TEST.SCALES)
+    im, decode_scale = read_image(path, max_scale)
+    return im, (height, width, im.shape[2]), decode_scale
+
+def _get_blobs(im, rois, mask=False, decode_scale=1.):
+    """Convert an image and RoIs within that image into network inputs.
+
+    With RPN, every level of the image pyramid is an image of the batch and
+    blobs['im_info'] holds one row per level. im may be decoded at
+    decode_scale of the full-resolution image (see _read_image); rois and
+    the returned scales are relative to the full-resolution image.
+    """
     blobs = {'data' : None, 'rois' : None}
     blobs['data'], im_scale_factors = _get_image_blob(im)
+    if cfg.TEST.HAS_RPN:
+        blobs['im_info'] = _get_im_info(im.shape, im_scale_factors)
+    im_scale_factors = im_scale_factors * decode_scale
+    if cfg.TEST.HAS_RPN:
+        blobs['im_info'][:, 2] = im_scale_factors
     if not cfg.TEST.HAS_RPN or mask:
         blobs['rois'] = _get_rois_blob(rois, im_scale_factors)
     return blobs, im_scale_factors
 
+def _get_blobs_batch(ims, rois=None, decode_scales=None):
+    """Convert a list of images (and RoIs within them) into network inputs.
+
+    The batch index of every RoI is the position of its image in ims. The
+    images may be decoded at decode_scales of their full resolution, as in
+    _get_blobs.
+    """
+    blobs = {'data' : None, 'rois' : None}
+    blobs['data'], im_info = _get_image_batch_blob(ims)
+    if decode_scales is not None:
+        im_info[:, 2] *= decode_scales
+    if cfg.TEST.HAS_RPN:
+        blobs['im_info'] = im_info
+    else:
+        rois_blob = [_get_rois_blob(im_rois, im_info[i:i + 1, 2])
+                     for i, im_rois in enumerate(rois)]
+        for i in xrange(len(rois_blob)):
+            rois_blob[i][:, 0] = i
+        blobs['rois'] = np.vstack(rois_blob)
+    return blobs, im_info
+
+def _mask_branch_start(net):
+    """Name of the first layer of the mask branch of a combined detection
+    and mask deploy net (see tools/combine_mask_deploy.py), None otherwise.
+    """
+    if 'mask_rois' not in net.blobs:
+        return None
+    return 'mask_rois'
+
+def _set_input_blob(net, name, data):
+    """Reshape the input blob name of net to the shape of data and copy data
+    into it.
+
+    The inputs are set in place rather than passed to net.forward, which
+    only takes keyword inputs for all of net.inputs at once (and the
+    "mask_rois" input of a combined net is not known at detection time).
+    """
+    blob = net.blobs[name]
+    blob.reshape(*(data.shape))
+    blob.data[...] = data
+
+def _forward_det(net):
+    """Run the detection layers of net on its input blobs, stopping before
+    the mask branch of a combined deploy net.
+
+    Returns:
+        blobs_out (dict): the output blobs of the detection layers
+    """
+    start = _mask_branch_start(net)
+    if start is None:
+        return net.forward()
+    layer_names = list(net._layer_names)
+    end = layer_names[layer_names.index(start) - 1]
+    net.forward(end=end)
+    return dict((name, net.blobs[name].data) for name in net.outputs
+                if name != 'mask_prob')
+
+def _forward_blobs(net, blobs):
+    """Reshape the network inputs to match blobs and run a forward pass."""
+    with get_profiler().span('forward'):
+        set_data_blob(net, blobs['data'])
+        if cfg.TEST.HAS_RPN:
+            _set_input_blob(net, 'im_info', blobs['im_info'])
+        else:
+            _set_input_blob(net, 'rois', blobs['rois'])
+        return _forward_det(net)
+
 def im_detect(net, im, boxes=None):
     """Detect object classes in an image given object proposals.
 
@@ -121,7 +273,12 @@ def im_detect(net, im, boxes=None):
         boxes (ndarray): R x (4*K) array of predicted bounding boxes
     """
     blobs, im_scales = _get_blobs(im, boxes)
+    return _im_detect_blobs(net, blobs, im_scales, im.shape, boxes)
 
+def _im_detect_blobs(net, blobs, im_scales, im_shape, boxes=None):
+    """Forward pass and box decoding of im_detect, on the inputs built by
+    _get_blobs for an image of shape im_shape.
+    """
     # When mapping from image ROIs to feature map ROIs, there's some aliasing
     # (some distinct image ROIs get mapped to the same feature ROI).
     # Here, we identify duplicate feature ROIs, so we only compute features
@@ -134,32 +291,95 @@ def im_detect(net, im, boxes=None):
         blobs['rois'] = blobs['rois'][index, :]
         boxes = boxes[index, :]
 
-    if cfg.TEST.HAS_RPN:
-        im_blob = blobs['data']
-        blobs['im_info'] = np.array(
-            [[im_blob.shape[2], im_blob.shape[3], im_scales[0]]],
-            dtype=np.float32)
+    blobs_out = _forward_blobs(net, blobs)
+    start_time = time.time()
 
-    # reshape network inputs
-    net.blobs['data'].reshape(*(blobs['data'].shape))
     if cfg.TEST.HAS_RPN:
-        net.blobs['im_info'].reshape(*(blobs['im_info'].shape))
+        rois = net.blobs['rois'].data.copy()
+        # unscale back to raw image space, from the pyramid level of each RoI
+        levels = rois[:, 0].astype(np.int)
+        boxes = rois[:, 1:5] / im_scales[levels][:, np.newaxis]
+
+    if cfg.TEST.SVM:
+        # use the raw scores before softmax under the assumption they
+        # were trained as linear SVMs
+        scores = net.blobs['cls_score'].data
     else:
-        net.blobs['rois'].reshape(*(blobs['rois'].shape))
+        # use softmax estimated probabilities
+        scores = blobs_out['cls_prob']
 
-    # do forward
-    forward_kwargs = {'data': blobs['data'].astype(np.float32, copy=False)}
-    if cfg.TEST.HAS_RPN:
-        forward_kwargs['im_info'] = blobs['im_info'].astype(np.float32, copy=False)
+    if cfg.TEST.BBOX_REG:
+        # Apply bounding-box regression deltas
+        box_deltas = blobs_out['bbox_pred']
+        pred_boxes = bbox_transform_inv(boxes, box_deltas)
+        pred_boxes = clip_boxes(pred_boxes, im_shape)
     else:
-        forward_kwargs['rois'] = blobs['rois'].astype(np.float32, copy=False)
-    blobs_out = net.forward(**forward_kwargs)
+        # Simply repeat the boxes, once for each class
+        pred_boxes = np.tile(boxes, (1, scores.shape[1]))
+
+    if cfg.DEDUP_BOXES > 0 and not cfg.TEST.HAS_RPN:
+        # Map scores and predictions back to the original set of boxes
+        scores = scores[inv_index, :]
+        pred_boxes = pred_boxes[inv_index, :]
+
+    get_profiler().add('bbox_decode', time.time() - start_time)
+    return scores, pred_boxes
+
+def im_detect_batch(net, ims, boxes=None):
+    """Detect object classes in a batch of images given object proposals.
+
+    All images go through the network in a single forward pass. With RPN,
+    the batch index of each RoI produced by the ProposalLayer routes it back
+    to its image.
+
+    Arguments:
+        net (caffe.Net): Fast R-CNN network to use
+        ims (list): color images to test (in BGR order)
+        boxes (list): per-image R_i x 4 arrays of object proposals or None
+            (for RPN)
+
+    Returns:
+        scores (list): per-image R_i x K arrays of object class scores (K
+            includes background as object category 0)
+        boxes (list): per-image R_i x (4*K) arrays of predicted bounding boxes
+    """
+    blobs, im_info = _get_blobs_batch(ims, boxes)
+    return _im_detect_batch_blobs(net, blobs, im_info,
+                                  [im.shape for im in ims], boxes)
+
+def _im_detect_batch_blobs(net, blobs, im_info, im_shapes, boxes=None):
+    """Forward pass and box decoding of im_detect_batch, on the inputs built
+    by _get_blobs_batch for images of shapes im_shapes.
+    """
+    num_images = len(im_shapes)
+    im_scales = im_info[:, 2]
+
+    if not cfg.TEST.HAS_RPN:
+        batch_inds = blobs['rois'][:, 0].astype(np.int)
+        boxes = np.vstack(boxes)
+
+    # When mapping from image ROIs to feature map ROIs, there's some aliasing
+    # (some distinct image ROIs get mapped to the same feature ROI).
+    # Here, we identify duplicate feature ROIs, so we only compute features
+    # on the unique subset. The (unscaled) batch index takes part in the hash,
+    # so RoIs are only merged within an image.
+    if cfg.DEDUP_BOXES > 0 and not cfg.TEST.HAS_RPN:
+        v = np.array([1e3, 1e6, 1e9, 1e12])
+        hashes = np.round(blobs['rois'][:, 1:] * cfg.DEDUP_BOXES).dot(v) + \
+                 blobs['rois'][:, 0]
+        _, index, inv_index = np.unique(hashes, return_index=True,
+                                        return_inverse=True)
+        blobs['rois'] = blobs['rois'][index, :]
+        boxes = boxes[index, :]
+
+    blobs_out = _forward_blobs(net, blobs)
+    start_time = time.time()
 
     if cfg.TEST.HAS_RPN:
-        assert len(im_scales) == 1, "Only single-image batch implemented"
         rois = net.blobs['rois'].data.copy()
+        batch_inds = rois[:, 0].astype(np.int)
         # unscale back to raw image space
-        boxes = rois[:, 1:5] / im_scales[0]
+        boxes = rois[:, 1:5] / im_scales[batch_inds][:, np.newaxis]
 
     if cfg.TEST.SVM:
         # use the raw scores before softmax under the assumption they
@@ -173,7 +393,6 @@ def im_detect(net, im, boxes=None):
         # Apply bounding-box regression deltas
         box_deltas = blobs_out['bbox_pred']
         pred_boxes = bbox_transform_inv(boxes, box_deltas)
-        pred_boxes = clip_boxes(pred_boxes, im.shape)
     else:
         # Simply repeat the boxes, once for each class
         pred_boxes = np.tile(boxes, (1, scores.shape[1]))
@@ -183,7 +402,19 @@ def im_detect(net, im, boxes=None):
         scores = scores[inv_index, :]
         pred_boxes = pred_boxes[inv_index, :]
 
-    return scores, pred_boxes
+    # Split the outputs back into per-image arrays
+    all_scores = []
+    all_pred_boxes = []
+    for i in xrange(num_images):
+        inds = np.where(batch_inds == i)[0]
+        all_scores.append(scores[inds, :])
+        if cfg.TEST.BBOX_REG:
+            all_pred_boxes.append(clip_boxes(pred_boxes[inds, :], im_shapes[i]))
+        else:
+            all_pred_boxes.append(pred_boxes[inds, :])
+
+    get_profiler().add('bbox_decode', time.time() - start_time)
+    return all_scores, all_pred_boxes
 
 def im_det(net, im, boxes=None):
     """Detect object classes in an image given object proposals.
@@ -197,9 +428,28 @@ def im_det(net, im, boxes=None):
         scores (ndarray): R x K array of object class scores (K includes
             background as object category 0)
         boxes (ndarray): R x (4*K) array of predicted bounding boxes
+        feat (ndarray): res4f features, owned by net (valid until its next
+            forward or reshape)
+    """
+    return im_det_with_scales(net, im, boxes)[:3]
+
+def im_det_with_scales(net, im, boxes=None):
+    """im_det, also returning the scales of the image blob, which
+    im_seg_dets needs to project the detections onto feat.
+
+    Returns:
+        scores, boxes, feat: as returned by im_det
+        im_scales (ndarray): scale factors of the image blob, relative to im
     """
     blobs, im_scales = _get_blobs(im, boxes)
+    scores, pred_boxes, feat = _im_det_blobs(net, blobs, im_scales,
+                                             im.shape, boxes)
+    return scores, pred_boxes, feat, im_scales
 
+def _im_det_blobs(net, blobs, im_scales, im_shape, boxes=None):
+    """Forward pass and box decoding of im_det, on the inputs built by
+    _get_blobs for an image of shape im_shape.
+    """
     # When mapping from image ROIs to feature map ROIs, there's some aliasing
     # (some distinct image ROIs get mapped to the same feature ROI).
     # Here, we identify duplicate feature ROIs, so we only compute features
@@ -212,33 +462,14 @@ def im_det(net, im, boxes=None):
         blobs['rois'] = blobs['rois'][index, :]
         boxes = boxes[index, :]
 
-    if cfg.TEST.HAS_RPN:
-        im_blob = blobs['data']
-        blobs['im_info'] = np.array(
-            [[im_blob.shape[2], im_blob.shape[3], im_scales[0]]],
-            dtype=np.float32)
-
-    # reshape network inputs
-    net.blobs['data'].reshape(*(blobs['data'].shape))
-    if cfg.TEST.HAS_RPN:
-        net.blobs['im_info'].reshape(*(blobs['im_info'].shape))
-    else:
-        net.blobs['rois'].reshape(*(blobs['rois'].shape))
-
-    # do forward
-    print(im_blob.shape)
-    forward_kwargs = {'data': blobs['data'].astype(np.float32, copy=False)}
-    if cfg.TEST.HAS_RPN:
-        forward_kwargs['im_info'] = blobs['im_info'].astype(np.float32, copy=False)
-    else:
-        forward_kwargs['rois'] = blobs['rois'].astype(np.float32, copy=False)
-    blobs_out = net.forward(**forward_kwargs)
+    blobs_out = _forward_blobs(net, blobs)
+    start_time = time.time()
 
     if cfg.TEST.HAS_RPN:
-        assert len(im_scales) == 1, "Only single-image batch implemented"
         rois = net.blobs['rois'].data.copy()
-        # unscale back to raw image space
-        boxes = rois[:, 1:5] / im_scales[0]
+        # unscale back to raw image space, from the pyramid level of each RoI
+        levels = rois[:, 0].astype(np.int)
+        boxes = rois[:, 1:5] / im_scales[levels][:, np.newaxis]
 
     scores = blobs_out['cls_prob']
 
@@ -246,7 +477,7 @@ def im_det(net, im, boxes=None):
         # Apply bounding-box regression deltas
         box_deltas = blobs_out['bbox_pred']
         pred_boxes = bbox_transform_inv(boxes, box_deltas)
-        pred_boxes = clip_boxes(pred_boxes, im.shape)
+        pred_boxes = clip_boxes(pred_boxes, im_shape)
     else:
         # Simply repeat the boxes, once for each class
         pred_boxes = np.tile(boxes, (1, scores.shape[1]))
@@ -256,21 +487,26 @@ def im_det(net, im, boxes=None):
         scores = scores[inv_index, :]
         pred_boxes = pred_boxes[inv_index, :]
 
-    feat = net.blobs['res4f'].data.copy()
+    # handed to the mask net without a copy, it stays valid until the next
+    # forward or reshape of net
+    feat = net.blobs['res4f'].data
+    get_profiler().add('bbox_decode', time.time() - start_time)
     return scores, pred_boxes, feat
 
-def im_seg(net, im, feat, boxes=None):
-    """Detect object classes in an image given object proposals.
+def im_seg(net, im, feat, boxes=None, thresh=0.5):
+    """Predict the masks of detections in an image.
 
     Arguments:
-        net (caffe.Net): Fast R-CNN network to use
+        net (caffe.Net): mask network to use
         im (ndarray): color image to test (in BGR order)
-        boxes (ndarray): R x 4 array of object proposals or None (for RPN)
+        feat (ndarray): res4f features of im, as returned by im_det
+        boxes (ndarray): R x 4 array of detections
+        thresh (float): binarize the masks at this threshold, or None to
+            return the mask probabilities
 
     Returns:
-        scores (ndarray): R x K array of object class scores (K includes
-            background as object category 0)
-        boxes (ndarray): R x (4*K) array of predicted bounding boxes
+        masks (ndarray): R x 1 x M x M array of binary (int32) masks, or of
+            mask probabilities if thresh is None
     """
     blobs, im_scales = _get_blobs(im, boxes, mask=True)
     # blobs['rois']=blobs['rois'][:,1:]
@@ -283,17 +519,59 @@ def im_seg(net, im, feat, boxes=None):
     # print(feat)
     net.blobs['res4f'].data[...] = feat
     net.blobs['rois'].data[...] = blobs['rois']
-    forward_kwargs = {'rois': blobs['rois'].astype(np.float32, copy=False), 'res4f': feat}
     blobs_out = net.forward()
 
     seg_result = blobs_out['mask_prob']
     # print(seg_result)
     # print(np.unique(seg_result))
     # print(np.unique(feat))
-    seg_result = np.array(seg_result > 0.5, dtype=np.int32)
+    if thresh is None:
+        # the net owns the output array
+        return seg_result.copy()
+    seg_result = np.array(seg_result > thresh, dtype=np.int32)
 
     return seg_result
 
+def im_seg_dets(net, feat, boxes, labels, im_scales):
+    """Predict the masks of all detections in an image with one forward.
+
+    Arguments:
+        net (caffe.Net): mask network to use, or a combined detection and
+            mask deploy net that just ran the detection for this image
+        feat (ndarray): res4f features of the image, as returned by im_det
+            (unused with a combined net)
+        boxes (ndarray): R x 4 array of detections in image coordinates
+        labels (ndarray): R class indices of the detections, used to pick
+            the mask channel when the mask head is class specific
+        im_scales (list): scale factors of the image blob feat was
+            computed on, as returned by _get_blobs
+
+    Returns:
+        masks (ndarray): R x 1 x M x M array of mask probabilities
+    """
+    mask_shape = net.blobs['mask_prob'].data.shape[2:]
+    if len(boxes) == 0:
+        # nothing survived NMS, skip the net
+        return np.zeros((0, 1) + mask_shape, dtype=np.float32)
+
+    rois = _get_rois_blob(boxes, im_scales)
+    start = _mask_branch_start(net)
+    if start is None:
+        _set_input_blob(net, 'res4f', feat)
+        _set_input_blob(net, 'rois', rois)
+        net.forward()
+    else:
+        # the mask branch reads the features of the detection layers in place
+        _set_input_blob(net, 'mask_rois', rois)
+        net.forward(start=start)
+    mask_prob = net.blobs['mask_prob'].data
+
+    if mask_prob.shape[1] > 1:
+        # class specific masks: keep the channel of each RoI's class
+        return mask_prob[np.arange(len(boxes)), labels][:, np.newaxis]
+    # the net owns the output array
+    return mask_prob.copy()
+
 def im_detect_rpn(net, im):
     """Detect object classes in an image given object proposals.
 
@@ -308,29 +586,20 @@ def im_detect_rpn(net, im):
         boxes (ndarray): R x (4*K) array of predicted bounding boxes
     """
     blobs, im_scales = _get_blobs(im, None)
-
-    # When mapping from image ROIs to feature map ROIs, there's some aliasing
-    # (some distinct image ROIs get mapped to the same feature ROI).
-    # Here, we identify duplicate feature ROIs, so we only compute features
-    # on the unique subset.
-    im_blob = blobs['data']
-    blobs['im_info'] = np.array(
-        [[im_blob.shape[2], im_blob.shape[3], im_scales[0]]],
-        dtype=np.float32)
+    if not cfg.TEST.HAS_RPN:
+        blobs['im_info'] = _get_im_info(im.shape, im_scales)
 
     # reshape network inputs
-    net.blobs['data'].reshape(*(blobs['data'].shape))
-    net.blobs['im_info'].reshape(*(blobs['im_info'].shape))
+    set_data_blob(net, blobs['data'])
+    _set_input_blob(net, 'im_info', blobs['im_info'])
 
     # do forward
-    forward_kwargs = {'data': blobs['data'].astype(np.float32, copy=False)}
-    forward_kwargs['im_info'] = blobs['im_info'].astype(np.float32, copy=False)
-    blobs_out = net.forward(**forward_kwargs)
+    blobs_out = net.forward()
 
-    assert len(im_scales) == 1, "Only single-image batch implemented"
     rois = net.blobs['rois'].data.copy()
-    # unscale back to raw image space
-    boxes = rois[:, 1:5] / im_scales[0]
+    # unscale back to raw image space, from the pyramid level of each RoI
+    levels = rois[:, 0].astype(np.int)
+    boxes = rois[:, 1:5] / im_scales[levels][:, np.newaxis]
     scores = net.blobs['scores'].data
 
     return scores, boxes
@@ -354,13 +623,11 @@ def im_detect_mask(net, im, boxes=None):
     # Here, we identify duplicate feature ROIs, so we only compute features
     # on the unique subset.
     # reshape network inputs
-    net.blobs['data'].reshape(*(blobs['data'].shape))
-    net.blobs['rois'].reshape(*(blobs['rois'].shape))
+    set_data_blob(net, blobs['data'])
+    _set_input_blob(net, 'rois', blobs['rois'])
 
     # do forward
-    forward_kwargs = {'data': blobs['data'].astype(np.float32, copy=False)}
-    forward_kwargs['rois'] = blobs['rois'].astype(np.float32, copy=False)
-    blobs_out = net.forward(**forward_kwargs)
+    blobs_out = net.forward()
 
     masks = blobs_out['mask_prob']
 
@@ -393,123 +660,234 @@ def apply_nms(all_boxes, thresh):
     num_images = len(all_boxes[0])
     nms_boxes = [[[] for _ in xrange(num_images)]
                  for _ in xrange(num_classes)]
-    for cls_ind in xrange(num_classes):
-        for im_ind in xrange(num_images):
-            dets = all_boxes[cls_ind][im_ind]
-            if dets == []:
-                continue
-            # CPU NMS is much faster than GPU NMS when the number of boxes
-            # is relative small (e.g., < 10k)
-            # TODO(rbg): autotune NMS dispatch
-            keep = nms(dets, thresh, force_cpu=True)
-            if len(keep) == 0:
-                continue
-            nms_boxes[cls_ind][im_ind] = dets[keep, :].copy()
+    for im_ind in xrange(num_images):
+        cls_inds = [cls_ind for cls_ind in xrange(num_classes)
+                    if len(all_boxes[cls_ind][im_ind]) > 0]
+        if len(cls_inds) == 0:
+            continue
+        dets = np.vstack([all_boxes[cls_ind][im_ind] for cls_ind in cls_inds])
+        labels = np.hstack([np.full(len(all_boxes[cls_ind][im_ind]), cls_ind,
+                                    dtype=np.int32)
+                            for cls_ind in cls_inds])
+        # CPU NMS is much faster than GPU NMS when the number of boxes
+        # is relative small (e.g., < 10k)
+        # TODO(rbg): autotune NMS dispatch
+        keep = class_nms(dets.astype(np.float32, copy=False), labels, thresh,
+                         force_cpu=True)
+        cls_dets = split_by_class(dets[keep, :], labels[keep], num_classes)
+        for cls_ind in cls_inds:
+            if len(cls_dets[cls_ind]) > 0:
+                nms_boxes[cls_ind][im_ind] = cls_dets[cls_ind].copy()
     return nms_boxes
 
-def test_net(net, imdb, max_per_image=400, thresh=-np.inf, vis=False, mask=False):
-    """Test a Fast R-CNN network on an image database."""
-    num_images = len(imdb.image_index)
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(imdb.num_classes)]
+def apply_nms_store(reader, path, thresh):
+    """Apply non-maximum suppression to the detections of a DetectionReader,
+    one image at a time, writing the kept ones to a new store at path.
+
+    Returns:
+        reader (DetectionReader): the store of the kept detections
+    """
+    store = DetectionWriter(path, reader.num_images, reader.num_classes)
+    for im_ind in xrange(reader.num_images):
+        dets, labels = reader.image_dets(im_ind)
+        keep = class_nms(dets, labels, thresh, force_cpu=True)
+        store.append(im_ind, dets[keep, :], labels[keep])
+    store.close()
+    return DetectionReader(path)
 
+def _paste_instance_mask(im_shape, dets, masks):
+    """Paste the mask predictions of every detection into a label map.
+
+    Arguments:
+        im_shape (tuple): shape of the tested image
+        dets (ndarray): N x 5 array of detections, as returned by
+            multiclass_nms
+        masks (ndarray): N x 1 x M x M mask probabilities of dets, as
+            returned by im_seg_dets
+
+    Returns:
+        out_mask (ndarray): H x W label map, instance k (row k of dets) is
+            numbered k + 1 and overlaps go to the higher scoring detection
+    """
+    return paste_masks(dets[:, :4], masks, im_shape, scores=dets[:, -1],
+                       thresh=cfg.TEST.MASK_THRESH,
+                       bilinear=cfg.TEST.MASK_BILINEAR)
+
+def _run_stages(prepare, forward, post, items, vis=False):
+    """Run prepare -> forward -> post over items, through a Pipeline when
+    cfg.TEST.PIPELINE is set, otherwise one item after another.
+
+    Visualization uses matplotlib, which is not thread safe, so it always
+    runs serially.
+    """
+    if cfg.TEST.PIPELINE and not vis:
+        pipeline = Pipeline(prepare, forward, post,
+                            num_prepare=cfg.TEST.PIPELINE_PREPARE_THREADS,
+                            num_post=cfg.TEST.PIPELINE_POST_THREADS,
+                            depth=cfg.TEST.PIPELINE_DEPTH)
+        pipeline.run(items)
+        print pipeline.summary()
+    else:
+        for item in items:
+            post(item, forward(item, prepare(item)))
+    if cfg.TEST.SHAPE_BUCKETS:
+        print get_shape_buckets().summary()
+
+def _open_store(output_dir, imdb, shard=None, resume=False):
+    """Open the detection store of a test run.
+
+    Arguments:
+        shard (tuple): (index, count) to test only the images index,
+            index + count, ... of imdb, in a store of their own
+        resume (bool): keep the images already in the store and skip them
+
+    Returns:
+        det_path (str): directory of the store
+        store (DetectionWriter): the opened store
+        images (list): indices of the images left to test
+    """
+    num_images = len(imdb.image_index)
+    det_path = os.path.join(output_dir, 'detections')
+    images = range(num_images)
+    if shard is not None:
+        det_path = shard_path(det_path, shard)
+        images = images[shard[0]::shard[1]]
+    store = DetectionWriter(det_path, num_images, imdb.num_classes,
+                            resume=resume)
+    if store.done:
+        print 'Resuming: {:d} images already tested in {:s}'.format(
+            len(store.done), det_path)
+        images = [i for i in images if i not in store.done]
+    return det_path, store, images
+
+def _start_profile():
+    """Reset the shared profiler for a new test run and return it."""
+    profiler = get_profiler()
+    profiler.reset()
+    profiler.report_interval = cfg.TEST.PROFILE_INTERVAL
+    return profiler
+
+def _report_profile(profiler, output_dir):
+    """Print the span statistics of a test run and dump them to output_dir
+    as profile.json and profile.csv.
+    """
+    print profiler.summary()
+    for ext in ('json', 'csv'):
+        profile_file = os.path.join(output_dir, 'profile.' + ext)
+        profiler.dump(profile_file)
+    print 'Wrote profile to: {:s}'.format(os.path.join(output_dir,
+                                                       'profile.{json,csv}'))
+
+def test_net(net, imdb, max_per_image=400, thresh=-np.inf, vis=False, mask=False,
+             shard=None, resume=False):
+    """Test a Fast R-CNN network on an image database.
+
+    The detections are streamed to a DetectionWriter store in
+    output_dir/detections as images complete. With shard (index, count),
+    only every count-th image is tested, into a store of its own, and the
+    evaluation is left to the merge of all shards (see
+    tools/test_net_sharded.py). With resume, the images already in the store
+    are skipped.
+    """
+    num_images = len(imdb.image_index)
     output_dir = get_output_dir(imdb, net)
+    det_path, store, images = _open_store(output_dir, imdb, shard, resume)
 
-    # timers
-    _t = {'im_detect' : Timer(), 'misc' : Timer()}
+    profiler = _start_profile()
 
     if not cfg.TEST.HAS_RPN:
         roidb = imdb.roidb
 
-    for i in xrange(num_images):
+    ims_per_batch = cfg.TEST.IMS_PER_BATCH
+    batches = [images[start:start + ims_per_batch]
+               for start in xrange(0, len(images), ims_per_batch)]
+
+    def prepare(batch_inds):
         # filter out any ground truth boxes
         if cfg.TEST.HAS_RPN:
-            box_proposals = None
+            box_proposals = [None for _ in batch_inds]
         else:
             # The roidb may contain ground-truth rois (for example, if the roidb
             # comes from the training or val split). We only want to evaluate
             # detection on the *non*-ground-truth rois. We select those the rois
             # that have the gt_classes field set to 0, which means there's no
             # ground truth.
-            box_proposals = roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
-
-        im = cv2.imread(imdb.image_path_at(i))
-        _t['im_detect'].tic()
-        scores, boxes = im_detect(net, im, box_proposals)
-        _t['im_detect'].toc()
-
-        _t['misc'].tic()
-        # skip j = 0, because it's the background class
-        for j in xrange(1, imdb.num_classes):
-            inds = np.where(scores[:, j] > thresh)[0]
-            cls_scores = scores[inds, j]
-            if cfg.TEST.AGNOSTIC:
-                cls_boxes = boxes[inds, 4:8]
+            box_proposals = [roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
+                             for i in batch_inds]
+
+        with profiler.span('decode'):
+            ims, im_shapes, decode_scales = zip(
+                *[_read_image(imdb.image_path_at(i), full_res=vis)
+                  for i in batch_inds])
+        with profiler.span('preprocess'):
+            if ims_per_batch > 1:
+                blobs, im_info = _get_blobs_batch(
+                    ims, None if cfg.TEST.HAS_RPN else box_proposals,
+                    decode_scales)
             else:
-                cls_boxes = boxes[inds, j*4:(j+1)*4]
-            cls_dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
-                .astype(np.float32, copy=False)
-            keep = nms(cls_dets, cfg.TEST.NMS)
-            cls_dets = cls_dets[keep, :]
+                blobs, im_info = _get_blobs(ims[0], box_proposals[0],
+                                            decode_scale=decode_scales[0])
+        return ims, im_shapes, box_proposals, blobs, im_info
+
+    def forward(batch_inds, payload):
+        ims, im_shapes, box_proposals, blobs, im_info = payload
+        if ims_per_batch > 1:
+            batch_scores, batch_boxes = _im_detect_batch_blobs(
+                net, blobs, im_info, im_shapes,
+                None if cfg.TEST.HAS_RPN else box_proposals)
+        else:
+            scores, boxes = _im_detect_blobs(
+                net, blobs, im_info, im_shapes[0], box_proposals[0])
+            # the network owns the output arrays, so copy them before the
+            # next forward pass overwrites them
+            batch_scores, batch_boxes = [scores.copy()], [boxes]
+        return ims, batch_scores, batch_boxes
+
+    def post(batch_inds, output):
+        for i, im, scores, boxes in zip(batch_inds, *output):
+            with profiler.span('nms'):
+                dets, labels = multiclass_nms(scores, boxes, cfg.TEST.NMS,
+                                              score_thresh=thresh,
+                                              max_per_image=max_per_image,
+                                              agnostic=cfg.TEST.AGNOSTIC)
             if vis:
-                vis_detections(im, imdb.classes[j], cls_dets)
-            all_boxes[j][i] = cls_dets
-
-        # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1]
-                                      for j in xrange(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
+                cls_dets = split_by_class(dets, labels, imdb.num_classes)
                 for j in xrange(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-        # _t['misc'].toc()
-        #
-        # _t['im_detect'].tic()
-        # seg = im_seg(net, im, all_boxes[:][i])
-        # _t['im_detect'].toc()
-        #
-        # _t['misc'].tic()
-
-        print 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
-              .format(i + 1, num_images, _t['im_detect'].average_time,
-                      _t['misc'].average_time)
-
-    det_file = os.path.join(output_dir, 'detections.pkl')
-    with open(det_file, 'wb') as f:
-        cPickle.dump(all_boxes, f, cPickle.HIGHEST_PROTOCOL)
+                    vis_detections(im, imdb.classes[j], cls_dets[j])
+            with profiler.span('write'):
+                store.append(i, dets, labels)
+            profiler.maybe_report('im_detect: {:d}/{:d}'.format(i + 1,
+                                                                num_images))
+
+    _run_stages(prepare, forward, post, batches, vis=vis)
+    store.close()
+    _report_profile(profiler, output_dir)
+    if shard is not None:
+        return
 
     print 'Evaluating detections'
-    imdb.evaluate_detections(all_boxes, output_dir)
+    imdb.evaluate_detections(DetectionReader(det_path).all_boxes(), output_dir)
 
 def test_rpn(net, imdb, max_per_image=400, thresh=-np.inf, vis=False):
     """Test a Fast R-CNN network on an image database."""
     num_images = len(imdb.image_index)
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(2)]
-
     output_dir = get_output_dir(imdb, net)
+    det_path = os.path.join(output_dir, 'detections')
+    store = DetectionWriter(det_path, num_images, 2)
 
-    # timers
-    _t = {'im_detect' : Timer(), 'misc' : Timer()}
+    profiler = _start_profile()
 
     if not cfg.TEST.HAS_RPN:
         roidb = imdb.roidb
 
     for i in xrange(num_images):
-        im = cv2.imread(imdb.image_path_at(i))
-        _t['im_detect'].tic()
-        scores, boxes = im_detect_rpn(net, im)
-        _t['im_detect'].toc()
+        with profiler.span('decode'):
+            im = cv2.imread(imdb.image_path_at(i))
+        # preprocess and forward
+        with profiler.span('detect'):
+            scores, boxes = im_detect_rpn(net, im)
 
-        _t['misc'].tic()
+        nms_start = time.time()
         # skip j = 0, because it's the background class
         inds = np.where(scores[:] > thresh)[0]
         cls_scores = scores[inds]
@@ -520,51 +898,48 @@ def test_rpn(net, imdb, max_per_image=400, thresh=-np.inf, vis=False):
         cls_dets = cls_dets[keep, :]
         if vis:
             vis_detections(im, imdb.classes[1], cls_dets)
-        all_boxes[1][i] = cls_dets
 
         # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[1][i][:, -1]
-                                      for j in xrange(1, 2)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in xrange(1, 2):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-        _t['misc'].toc()
-
-        print 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
-              .format(i + 1, num_images, _t['im_detect'].average_time,
-                      _t['misc'].average_time)
-
-    det_file = os.path.join(output_dir, 'detections.pkl')
-    with open(det_file, 'wb') as f:
-        cPickle.dump(all_boxes, f, cPickle.HIGHEST_PROTOCOL)
+        if max_per_image > 0 and len(cls_dets) > max_per_image:
+            image_thresh = np.sort(cls_dets[:, -1])[-max_per_image]
+            cls_dets = cls_dets[cls_dets[:, -1] >= image_thresh]
+        profiler.add('nms', time.time() - nms_start)
+
+        with profiler.span('write'):
+            store.append(i, cls_dets, np.ones(len(cls_dets), dtype=np.int32))
+        profiler.maybe_report('im_detect: {:d}/{:d}'.format(i + 1,
+                                                            num_images))
+
+    store.close()
+    _report_profile(profiler, output_dir)
 
     print 'Evaluating detections'
-    imdb.evaluate_detections(all_boxes, output_dir)
+    imdb.evaluate_detections(DetectionReader(det_path).all_boxes(), output_dir)
 
-def test_net_mask(net, net_mask, imdb, max_per_image=400, thresh=-np.inf, vis=False, save_path="./output/"):
-    """Test a Fast R-CNN network on an image database."""
-    num_images = len(imdb.image_index)
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(imdb.num_classes)]
+def test_net_mask(net, net_mask, imdb, max_per_image=400, thresh=-np.inf, vis=False, save_path="./output/",
+                  mask_scale=100, shard=None, resume=False):
+    """Test a Fast R-CNN network on an image database.
 
+    net_mask may be None when net is a combined detection and mask deploy net
+    (see tools/combine_mask_deploy.py); the mask branch then reads the
+    backbone features of the detection layers in place. shard and resume are
+    as in test_net; an image counts as done once its mask is written.
+    """
+    if net_mask is None:
+        net_mask = net
+    num_images = len(imdb.image_index)
     output_dir = get_output_dir(imdb, net)
+    det_path, store, images = _open_store(output_dir, imdb, shard, resume)
 
     if not os.path.exists(save_path):
         os.makedirs(save_path)
 
-    # timers
-    _t = {'im_detect' : Timer(), 'im_seg' : Timer(),'misc' : Timer()}
+    profiler = _start_profile()
 
     if not cfg.TEST.HAS_RPN:
         roidb = imdb.roidb
 
-    for i in xrange(num_images):
+    def prepare(i):
         # filter out any ground truth boxes
         if cfg.TEST.HAS_RPN:
             box_proposals = None
@@ -576,199 +951,79 @@ def test_net_mask(net, net_mask, imdb, max_per_image=400, thresh=-np.inf, vis=Fa
             # ground truth.
             box_proposals = roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
 
-        im = cv2.imread(imdb.image_path_at(i))
-        print(im.shape)
-        _t['im_detect'].tic()
-        scores, boxes, feat = im_det(net, im, box_proposals)
-        _t['im_detect'].toc()
-
-        _t['misc'].tic()
-        # skip j = 0, because it's the background class
-        for j in xrange(1, imdb.num_classes):
-            inds = np.where(scores[:, j] > thresh)[0]
-            cls_scores = scores[inds, j]
-            if cfg.TEST.AGNOSTIC:
-                cls_boxes = boxes[inds, 4:8]
-            else:
-                cls_boxes = boxes[inds, j*4:(j+1)*4]
-            cls_dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
-                .astype(np.float32, copy=False)
-            keep = nms(cls_dets, cfg.TEST.NMS)
-            cls_dets = cls_dets[keep, :]
-            if vis:
-                vis_detections(im, imdb.classes[j], cls_dets)
-            all_boxes[j][i] = cls_dets
-
-        # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1]
-                                      for j in xrange(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in xrange(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-
-        print 'im_detection: {:d}/{:d} {:.3f}s {:.3f}s' \
-              .format(i + 1, num_images, _t['im_detect'].average_time,
-                      _t['misc'].average_time)
-
-        _t['im_seg'].tic()
-        out_mask = np.zeros((im.shape[0], im.shape[1]))
-        for j in xrange(1, imdb.num_classes):
-            ins_index = 1
-            boxes_this_im = all_boxes[j][i][:, :-1]
-            seg = im_seg(net_mask, im, feat, boxes_this_im)
-            # print(seg.shape)
-            for ii in xrange(seg.shape[0]):
-                seg_now = seg[ii][0]
-                # seg_now = np.transpose(seg_now)
-                box_now = boxes_this_im[ii]
-                box_now = box_now.astype(int)
-                # im_now=im[box_now[1]: box_now[3], box_now[0]:box_now[2]]
-                # cv2.imshow("test", im_now)
-                # cv2.waitKey()
-                seg_org_size = cv2.resize(seg_now, (box_now[2] - box_now[0], box_now[3] - box_now[1]), interpolation=cv2.INTER_NEAREST)
-                # print((seg_org_size*99999).shape)
-                # cv2.imshow("seg", seg_org_size*99999)
-                # cv2.waitKey()
-                seg_org_size = seg_org_size*ins_index
-                out_mask[box_now[1]: box_now[3], box_now[0]:box_now[2]] = seg_org_size
-                ins_index += 1
-        _t['im_seg'].toc()
-
+        with profiler.span('decode'):
+            im, im_shape, decode_scale = _read_image(imdb.image_path_at(i),
+                                                     full_res=vis)
+        with profiler.span('preprocess'):
+            blobs, im_scales = _get_blobs(im, box_proposals,
+                                          decode_scale=decode_scale)
+        return im, im_shape, box_proposals, blobs, im_scales
+
+    def forward(i, payload):
+        # detection, NMS and the mask head all run here: the mask head needs
+        # the kept detections and the features of this image
+        im, im_shape, box_proposals, blobs, im_scales = payload
+        scores, boxes, feat = _im_det_blobs(net, blobs, im_scales, im_shape,
+                                            box_proposals)
+
+        with profiler.span('nms'):
+            dets, labels = multiclass_nms(scores, boxes, cfg.TEST.NMS,
+                                          score_thresh=thresh,
+                                          max_per_image=max_per_image,
+                                          agnostic=cfg.TEST.AGNOSTIC)
+        if vis:
+            cls_dets = split_by_class(dets, labels, imdb.num_classes)
+            for j in xrange(1, imdb.num_classes):
+                vis_detections(im, imdb.classes[j], cls_dets[j])
+
+        with profiler.span('mask_forward'):
+            masks = im_seg_dets(net_mask, feat, dets[:, :4], labels,
+                                im_scales)
+        return im_shape, dets, labels, masks
+
+    def post(i, output):
+        im_shape, dets, labels, masks = output
+        with profiler.span('mask_paste'):
+            out_mask = _paste_instance_mask(im_shape, dets, masks)
         mask_save_path = os.path.join(save_path, os.path.basename(imdb.image_path_at(i)).replace(".jpg", ".png"))
-        cv2.imwrite(mask_save_path, out_mask*100)
-
-        print 'im_seg: {:d}/{:d} {:.3f}s' \
-              .format(i + 1, num_images, _t['im_seg'].average_time)
-
-    det_file = os.path.join(output_dir, 'detections.pkl')
-    with open(det_file, 'wb') as f:
-        cPickle.dump(all_boxes, f, cPickle.HIGHEST_PROTOCOL)
+        with profiler.span('write'):
+            cv2.imwrite(mask_save_path, out_mask*mask_scale)
+            # the image is done once its mask is on disk
+            store.append(i, dets, labels)
+        profiler.maybe_report('im_seg: {:d}/{:d}'.format(i + 1, num_images))
+
+    _run_stages(prepare, forward, post, images, vis=vis)
+    store.close()
+    _report_profile(profiler, output_dir)
+    if shard is not None:
+        return
 
     print 'Evaluating detections'
-    imdb.evaluate_detections(all_boxes, output_dir)
+    imdb.evaluate_detections(DetectionReader(det_path).all_boxes(), output_dir)
 
 
-def test_net_mask_reload(net_proto, net_mask_proto, weights, imdb, max_per_image=400, thresh=-np.inf, vis=False, save_path="./output/"):
-    """Test a Fast R-CNN network on an image database."""
-    num_images = len(imdb.image_index)
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
+def test_net_mask_reload(net_proto, net_mask_proto, weights, imdb, max_per_image=400, thresh=-np.inf, vis=False, save_path="./output/",
+                         pool=None, shard=None, resume=False):
+    """Test a Fast R-CNN network on an image database, loading the detection
+    and mask nets through a ModelPool.
 
+    Both nets are built once, instead of once per image (the mask net shares
+    the weights of the layers it has in common with the detection net), and
+    stay loaded in the pool after the run. With net_mask_proto
+    None, net_proto is a combined detection and mask deploy net and only one
+    net is built.
+    """
     caffe.set_mode_gpu()
     caffe.set_device(cfg.GPU_ID)
 
+    if pool is None:
+        pool = ModelPool()
+    net = pool.get(net_proto, weights)
+    if net_mask_proto is None:
+        net_mask = None
+    else:
+        net_mask = pool.get(net_mask_proto, weights, share_with=net)
 
-    all_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(imdb.num_classes)]
-
-    net = caffe.Net(net_proto, weights, caffe.TEST)
-    net.name = os.path.splitext(os.path.basename(weights))[0]
-    output_dir = get_output_dir(imdb, net)
-
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-
-    # timers
-    _t = {'im_detect' : Timer(), 'im_seg' : Timer(),'misc' : Timer()}
-
-    if not cfg.TEST.HAS_RPN:
-        roidb = imdb.roidb
-
-    del net
-    for i in xrange(num_images):
-        # filter out any ground truth boxes
-        if cfg.TEST.HAS_RPN:
-            box_proposals = None
-        else:
-            # The roidb may contain ground-truth rois (for example, if the roidb
-            # comes from the training or val split). We only want to evaluate
-            # detection on the *non*-ground-truth rois. We select those the rois
-            # that have the gt_classes field set to 0, which means there's no
-            # ground truth.
-            box_proposals = roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
-
-        net = caffe.Net(net_proto, weights, caffe.TEST)
-        net.name = os.path.splitext(os.path.basename(weights))[0]
-        im = cv2.imread(imdb.image_path_at(i))
-        print(im.shape)
-        _t['im_detect'].tic()
-        scores, boxes, feat = im_det(net, im, box_proposals)
-        _t['im_detect'].toc()
-
-        _t['misc'].tic()
-        # skip j = 0, because it's the background class
-        for j in xrange(1, imdb.num_classes):
-            inds = np.where(scores[:, j] > thresh)[0]
-            cls_scores = scores[inds, j]
-            if cfg.TEST.AGNOSTIC:
-                cls_boxes = boxes[inds, 4:8]
-            else:
-                cls_boxes = boxes[inds, j*4:(j+1)*4]
-            cls_dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
-                .astype(np.float32, copy=False)
-            keep = nms(cls_dets, cfg.TEST.NMS)
-            cls_dets = cls_dets[keep, :]
-            if vis:
-                vis_detections(im, imdb.classes[j], cls_dets)
-            all_boxes[j][i] = cls_dets
-
-        # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1]
-                                      for j in xrange(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in xrange(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-
-        print 'im_detection: {:d}/{:d} {:.3f}s {:.3f}s' \
-              .format(i + 1, num_images, _t['im_detect'].average_time,
-                      _t['misc'].average_time)
-        del net
-
-        net_mask = caffe.Net(net_mask_proto, weights, caffe.TEST)
-        net_mask.name = os.path.splitext(os.path.basename(weights))[0]
-        _t['im_seg'].tic()
-        out_mask = np.zeros((im.shape[0], im.shape[1]))
-        for j in xrange(1, imdb.num_classes):
-            ins_index = 1
-            boxes_this_im = all_boxes[j][i][:, :-1]
-            seg = im_seg(net_mask, im, feat, boxes_this_im)
-            # print(seg.shape)
-            for ii in xrange(seg.shape[0]):
-                seg_now = seg[ii][0]
-                # seg_now = np.transpose(seg_now)
-                box_now = boxes_this_im[ii]
-                box_now = box_now.astype(int)
-                if box_now[2] == box_now[0] or box_now[3] == box_now[1]:
-                    continue
-                # im_now=im[box_now[1]: box_now[3], box_now[0]:box_now[2]]
-                # cv2.imshow("test", im_now)
-                # cv2.waitKey()
-                seg_org_size = cv2.resize(seg_now, (box_now[2] - box_now[0], box_now[3] - box_now[1]), interpolation=cv2.INTER_NEAREST)
-                # print((seg_org_size*99999).shape)
-                # cv2.imshow("seg", seg_org_size*99999)
-                # cv2.waitKey()
-                seg_org_size = seg_org_size*ins_index
-                out_mask[box_now[1]: box_now[3], box_now[0]:box_now[2]] = seg_org_size
-                ins_index += 1
-        _t['im_seg'].toc()
-
-        mask_save_path = os.path.join(save_path, os.path.basename(imdb.image_path_at(i)).replace(".jpg", ".png"))
-        cv2.imwrite(mask_save_path, out_mask*10)
-
-        print 'im_seg: {:d}/{:d} {:.3f}s' \
-              .format(i + 1, num_images, _t['im_seg'].average_time)
-        del net_mask
-
-    det_file = os.path.join(output_dir, 'detections.pkl')
-    with open(det_file, 'wb') as f:
-        cPickle.dump(all_boxes, f, cPickle.HIGHEST_PROTOCOL)
-
-    print 'Evaluating detections'
-    imdb.evaluate_detections(all_boxes, output_dir)
\ No newline at end of file
+    test_net_mask(net, net_mask, imdb, max_per_image=max_per_image,
+                  thresh=thresh, vis=vis, save_path=save_path, mask_scale=10,
+                  shard=shard, resume=resume)
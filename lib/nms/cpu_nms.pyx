@@ -7,11 +7,12 @@
 
 import numpy as np
 cimport numpy as np
+cimport cython
 
-cdef inline np.float32_t max(np.float32_t a, np.float32_t b):
+cdef inline np.float32_t max(np.float32_t a, np.float32_t b) nogil:
     return a if a >= b else b
 
-cdef inline np.float32_t min(np.float32_t a, np.float32_t b):
+cdef inline np.float32_t min(np.float32_t a, np.float32_t b) nogil:
     return a if a <= b else b
 
 def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
@@ -66,3 +67,63 @@ def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
                 suppressed[j] = 1
 
     return keep
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpu_nms_grouped(np.ndarray[np.float32_t, ndim=2] dets,
+                    np.ndarray[np.int32_t, ndim=1] labels, np.float thresh):
+    """Greedy NMS applied independently within each label.
+
+    Boxes are visited sorted by label, then by descending score, and the
+    loop over all labels runs without the GIL. Returns the kept indices in
+    that order.
+    """
+    cdef int ndets = dets.shape[0]
+    if ndets == 0:
+        return np.zeros((0,), dtype=np.int64)
+    cdef np.ndarray[np.int64_t, ndim=1] order = \
+            np.lexsort((-dets[:, 4], labels)).astype(np.int64)
+    cdef np.float32_t[:, ::1] d = np.ascontiguousarray(dets[order, :4])
+    cdef np.int32_t[::1] l = np.ascontiguousarray(labels[order])
+    cdef np.float32_t[::1] areas = np.ascontiguousarray(
+        (dets[order, 2] - dets[order, 0] + 1) *
+        (dets[order, 3] - dets[order, 1] + 1))
+    cdef np.uint8_t[::1] suppressed = np.zeros((ndets,), dtype=np.uint8)
+    cdef np.ndarray[np.uint8_t, ndim=1] kept = \
+            np.zeros((ndets,), dtype=np.uint8)
+    cdef np.uint8_t[::1] k = kept
+    cdef float fthresh = thresh
+
+    cdef int i, j
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float32_t xx1, yy1, xx2, yy2
+    cdef np.float32_t w, h
+    cdef np.float32_t inter, ovr
+
+    with nogil:
+        for i in range(ndets):
+            if suppressed[i] == 1:
+                continue
+            k[i] = 1
+            ix1 = d[i, 0]
+            iy1 = d[i, 1]
+            ix2 = d[i, 2]
+            iy2 = d[i, 3]
+            iarea = areas[i]
+            # boxes of the same label are contiguous
+            j = i + 1
+            while j < ndets and l[j] == l[i]:
+                if suppressed[j] == 0:
+                    xx1 = max(ix1, d[j, 0])
+                    yy1 = max(iy1, d[j, 1])
+                    xx2 = min(ix2, d[j, 2])
+                    yy2 = min(iy2, d[j, 3])
+                    w = max(0.0, xx2 - xx1 + 1)
+                    h = max(0.0, yy2 - yy1 + 1)
+                    inter = w * h
+                    ovr = inter / (iarea + areas[j] - inter)
+                    if ovr >= fthresh:
+                        suppressed[j] = 1
+                j += 1
+
+    return order[kept.view(np.bool_)]
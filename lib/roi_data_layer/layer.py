@@ -12,75 +12,91 @@ RoIDataLayer implements a Caffe Python layer.
 
 import caffe
 from fast_rcnn.config import cfg
-from roi_data_layer.minibatch import get_minibatch
+from roi_data_layer.minibatch import get_minibatch, minibatch_blob_names
 import numpy as np
 import yaml
-from multiprocessing import Process, Queue
+from utils.blob import BlobBuffer
+from roi_data_layer.prefetch import MinibatchStream, Prefetcher, \
+    minibatch_slot_bytes
+from utils.image_cache import ImageCache
+from utils.instance_index import load_instance_index
+from utils.profiler import Profiler
+from functools import partial
+
+def _make_image_cache(roidb, with_masks=True):
+    """Return an ImageCache of the images (and instance maps if with_masks)
+    of roidb, of at most cfg.TRAIN.IMAGE_CACHE_MB, or None if the cache is
+    disabled.
+    """
+    budget = int(cfg.TRAIN.IMAGE_CACHE_MB * (1 << 20))
+    if budget <= 0:
+        return None
+    # full-resolution sizes, keyed by path to count flipped entries once
+    sizes = {}
+    for entry in roidb:
+        pixels = entry['height'] * entry['width']
+        sizes[entry['image']] = 3 * pixels
+        if with_masks:
+            sizes[entry['ins']] = pixels
+    # no more than the whole decoded set
+    budget = min(budget, sum(sizes.itervalues()) + 64 * len(sizes))
+    print 'Caching decoded images in {:.1f}MB'.format(budget / float(1 << 20))
+    return ImageCache(sizes.keys(), budget)
 
 class RoIDataLayer(caffe.Layer):
     """Fast R-CNN data layer used for training."""
 
-    def _shuffle_roidb_inds(self, gpu_id):
-        self.gpu_id = gpu_id
-        """Randomly permute the training roidb."""
-        if cfg.TRAIN.ASPECT_GROUPING:
-            widths = np.array([r['width'] for r in self._roidb])
-            heights = np.array([r['height'] for r in self._roidb])
-            horz = (widths >= heights)
-            vert = np.logical_not(horz)
-            horz_inds = np.where(horz)[0]
-            vert_inds = np.where(vert)[0]
-            inds = np.hstack((
-                np.random.permutation(horz_inds),
-                np.random.permutation(vert_inds)))
-            inds = np.reshape(inds, (-1, 2))
-            np.random.seed(gpu_id)
-            row_perm = np.random.permutation(np.arange(inds.shape[0]))
-            inds = np.reshape(inds[row_perm, :], (-1,))
-            self._perm = inds
-        else:
-            self._perm = np.random.permutation(np.arange(len(self._roidb)))
-        self._cur = 0
-
-    def _get_next_minibatch_inds(self):
-        """Return the roidb indices for the next minibatch."""
-        if self._cur + cfg.TRAIN.IMS_PER_BATCH >= len(self._roidb):
-            self._shuffle_roidb_inds(self.gpu_id)
-
-        db_inds = self._perm[self._cur:self._cur + cfg.TRAIN.IMS_PER_BATCH]
-        self._cur += cfg.TRAIN.IMS_PER_BATCH
-        return db_inds
-
     def _get_next_minibatch(self):
         """Return the blobs to be used for the next minibatch.
 
-        If cfg.TRAIN.USE_PREFETCH is True, then blobs will be computed in a
-        separate process and made available through self._blob_queue.
+        If cfg.TRAIN.USE_PREFETCH is a number of workers, the blobs are
+        built ahead of time by a Prefetcher.
         """
-        if cfg.TRAIN.USE_PREFETCH:
-            return self._blob_queue.get()
-        else:
-            db_inds = self._get_next_minibatch_inds()
-            minibatch_db = [self._roidb[i] for i in db_inds]
-            return get_minibatch(minibatch_db, self._num_classes, self._output_h_w)
+        if self._prefetcher is not None:
+            return self._prefetcher.get()
+        db_inds = self._stream.next()
+        minibatch_db = [self._roidb[i] for i in db_inds]
+        return get_minibatch(minibatch_db, self._num_classes,
+                             self._output_h_w, buf=self._blob_buffer,
+                             cache=self._image_cache,
+                             blob_names=self._blob_names,
+                             profiler=self._profiler)
 
     def set_roidb(self, roidb, gpu_id=0):
-        """Set the roidb to be used by this layer during training."""
+        """Set the roidb to be used by this layer during training.
+
+        The minibatch order is seeded with cfg.RNG_SEED + gpu_id, so that
+        the GPUs of a multi-GPU run train on different minibatches.
+        """
         self._roidb = roidb
-        self._shuffle_roidb_inds(gpu_id)
-        if cfg.TRAIN.USE_PREFETCH:
-            self._blob_queue = Queue(10)
-            self._prefetch_process = BlobFetcher(self._blob_queue,
-                                                 self._roidb,
-                                                 self._num_classes, gpu_id)
-            self._prefetch_process.start()
-            # Terminate the child process when the parent exists
-            def cleanup():
-                print 'Terminating BlobFetcher'
-                self._prefetch_process.terminate()
-                self._prefetch_process.join()
-            import atexit
-            atexit.register(cleanup)
+        seed = cfg.RNG_SEED + gpu_id
+        # created before the prefetch workers, so shared with them
+        self._image_cache = _make_image_cache(roidb, self._with_masks)
+        if cfg.TRAIN.INSTANCE_INDEX and self._with_masks:
+            load_instance_index(cfg.TRAIN.INSTANCE_INDEX)
+        num_workers = int(cfg.TRAIN.USE_PREFETCH)
+        if num_workers > 0:
+            build_fn = partial(get_minibatch, num_classes=self._num_classes,
+                               mask_h_w=self._output_h_w,
+                               cache=self._image_cache,
+                               blob_names=self._blob_names,
+                               profiler=self._profiler)
+            slot_bytes = None
+            if cfg.TRAIN.PREFETCH_SHARED_MEMORY:
+                # room for the float32 data blob at their largest
+                slot_bytes = minibatch_slot_bytes(
+                    cfg.TRAIN.IMS_PER_BATCH, max(cfg.TRAIN.SCALES),
+                    cfg.TRAIN.MAX_SIZE, 3 * 4)
+            self._prefetcher = Prefetcher(
+                roidb, build_fn, num_workers, cfg.TRAIN.IMS_PER_BATCH, seed,
+                aspect_grouping=cfg.TRAIN.ASPECT_GROUPING,
+                depth=cfg.TRAIN.PREFETCH_DEPTH,
+                use_threads=cfg.TRAIN.PREFETCH_THREADS,
+                slot_bytes=slot_bytes)
+        else:
+            self._stream = MinibatchStream(
+                roidb, cfg.TRAIN.IMS_PER_BATCH, seed,
+                aspect_grouping=cfg.TRAIN.ASPECT_GROUPING)
 
     def setup(self, bottom, top):
         """Setup the RoIDataLayer."""
@@ -89,72 +105,78 @@ class RoIDataLayer(caffe.Layer):
         layer_params = yaml.load(self.param_str)
 
         self._num_classes = layer_params['num_classes']
+        # the blobs are copied into the tops as soon as they are built, so
+        # their memory is reused across minibatches (but not by the
+        # prefetch workers, whose blobs wait in a queue)
+        self._blob_buffer = BlobBuffer()
+        self._prefetcher = None
+        self._image_cache = None
         self._output_h_w = layer_params['output_h_w']
 
-        self._name_to_top_map = {}
-
-        # data blob: holds a batch of N images, each with 3 channels
-        idx = 0
-        top[idx].reshape(cfg.TRAIN.IMS_PER_BATCH, 3,
-            max(cfg.TRAIN.SCALES), cfg.TRAIN.MAX_SIZE)
-        self._name_to_top_map['data'] = idx
-        idx += 1
-
-        if cfg.TRAIN.HAS_RPN:
-            top[idx].reshape(1, 3)
-            self._name_to_top_map['im_info'] = idx
-            idx += 1
-
-            top[idx].reshape(cfg.TRAIN.BATCH_SIZE, 4)
-            self._name_to_top_map['gt_boxes'] = idx
-            idx += 1
-        else: # not using RPN
+        # the tops are the blobs named by 'top_names' in param_str (pycaffe
+        # does not expose the top names of a layer), or else the first
+        # len(top) blobs of minibatch_blob_names(); only these are built
+        all_names = minibatch_blob_names()
+        top_names = layer_params.get('top_names', all_names[:len(top)])
+        assert len(top_names) == len(top), \
+            'RoIDataLayer has {:d} tops but {:d} blob names'.format(
+                len(top), len(top_names))
+        unknown = [name for name in top_names if name not in all_names]
+        assert not unknown, 'RoIDataLayer cannot build {} (builds {})' \
+            .format(unknown, all_names)
+        assert 'data' in top_names, 'RoIDataLayer needs a data top'
+        self._name_to_top_map = dict(
+            (name, idx) for idx, name in enumerate(top_names))
+
+        shapes = {
+            # data blob: holds a batch of N images, each with 3 channels
+            'data': (cfg.TRAIN.IMS_PER_BATCH, 3, max(cfg.TRAIN.SCALES),
+                     cfg.TRAIN.MAX_SIZE),
+            'im_info': (1, 3),
+            'gt_boxes': (cfg.TRAIN.BATCH_SIZE, 4),
             # rois blob: holds R regions of interest, each is a 5-tuple
             # (n, x1, y1, x2, y2) specifying an image batch index n and a
             # rectangle (x1, y1, x2, y2)
-            top[idx].reshape(cfg.TRAIN.BATCH_SIZE, 5)
-            self._name_to_top_map['rois'] = idx
-            idx += 1
-
-            # labels blob: R categorical labels in [0, ..., K] for K foreground
-            # classes plus background
-            top[idx].reshape(cfg.TRAIN.BATCH_SIZE)
-            self._name_to_top_map['labels'] = idx
-            idx += 1
-
-            if cfg.TRAIN.BBOX_REG:
-                # bbox_targets blob: R bounding-box regression targets with 4
-                # targets per class
-                top[idx].reshape(cfg.TRAIN.BATCH_SIZE, self._num_classes * 4)
-                self._name_to_top_map['bbox_targets'] = idx
-                idx += 1
-
-                # bbox_inside_weights blob: At most 4 targets per roi are active;
-                # thisbinary vector sepcifies the subset of active targets
-                top[idx].reshape(cfg.TRAIN.BATCH_SIZE, self._num_classes * 4)
-                self._name_to_top_map['bbox_inside_weights'] = idx
-                idx += 1
-
-                top[idx].reshape(cfg.TRAIN.BATCH_SIZE, self._num_classes * 4)
-                self._name_to_top_map['bbox_outside_weights'] = idx
-                idx += 1
-
-
-        # add ins data
-        top[idx].reshape(cfg.TRAIN.IMS_PER_BATCH, 5)
-        self._name_to_top_map['mask_rois'] = idx
-        idx += 1
-
-        top[idx].reshape(cfg.TRAIN.IMS_PER_BATCH, 1, 14, 14)
-        self._name_to_top_map['masks'] = idx
-        idx += 1
-        # add seg data
-        # top[idx].reshape(cfg.TRAIN.IMS_PER_BATCH, 1,
-        #                  max(cfg.TRAIN.SCALES), cfg.TRAIN.MAX_SIZE)
-        # self._name_to_top_map['seg'] = idx
-        # idx += 1
-
-        # add ins data
+            'rois': (cfg.TRAIN.BATCH_SIZE, 5),
+            # labels blob: R categorical labels in [0, ..., K] for K
+            # foreground classes plus background
+            'labels': (cfg.TRAIN.BATCH_SIZE,),
+            # bbox_targets blob: R bounding-box regression targets with 4
+            # targets per class
+            'bbox_targets': (cfg.TRAIN.BATCH_SIZE, self._num_classes * 4),
+            # bbox_inside_weights blob: At most 4 targets per roi are
+            # active; this binary vector specifies the subset of active
+            # targets
+            'bbox_inside_weights': (cfg.TRAIN.BATCH_SIZE,
+                                    self._num_classes * 4),
+            'bbox_outside_weights': (cfg.TRAIN.BATCH_SIZE,
+                                     self._num_classes * 4),
+            # add ins data
+            'mask_rois': (cfg.TRAIN.IMS_PER_BATCH, 5),
+            'masks': (cfg.TRAIN.IMS_PER_BATCH, 1, self._output_h_w,
+                      self._output_h_w),
+        }
+        for name, idx in self._name_to_top_map.iteritems():
+            top[idx].reshape(*shapes[name])
+        self._blob_names = top_names
+
+        self._with_masks = 'mask_rois' in top_names or 'masks' in top_names
+
+        skipped = [name for name in all_names if name not in top_names]
+        if skipped:
+            # without RPN, every blob but data comes from the sampled RoIs
+            with_rois = self._with_masks or (not cfg.TRAIN.HAS_RPN and
+                                       len(top_names) > 1)
+            work = [label for label, done in (('RoI sampling', with_rois),
+                                              ('instance maps',
+                                               self._with_masks))
+                    if not done]
+            print 'RoIDataLayer: not building {:s}{:s}'.format(
+                ', '.join(skipped),
+                ' (no {:s})'.format(', '.join(work)) if work else '')
+        self._profiler = None
+        if cfg.TRAIN.PROFILE_INTERVAL >= 0:
+            self._profiler = Profiler(cfg.TRAIN.PROFILE_INTERVAL)
 
         print 'RoiDataLayer: name_to_top:', self._name_to_top_map
         assert len(top) == len(self._name_to_top_map)
@@ -181,41 +203,3 @@ class RoIDataLayer(caffe.Layer):
     def reshape(self, bottom, top):
         """Reshaping happens during the call to forward."""
         pass
-
-class BlobFetcher(Process):
-    """Experimental class for prefetching blobs in a separate process."""
-    def __init__(self, queue, roidb, num_classes, gpu_id=0):
-        super(BlobFetcher, self).__init__()
-        self._queue = queue
-        self._roidb = roidb
-        self._num_classes = num_classes
-        self._perm = None
-        self._cur = 0
-        self.gpu_id = gpu_id
-        self._shuffle_roidb_inds(self.gpu_id)
-        # fix the random seed for reproducibility
-        np.random.seed(cfg.RNG_SEED)
-
-    def _shuffle_roidb_inds(self):
-        """Randomly permute the training roidb."""
-        # TODO(rbg): remove duplicated code
-        self._perm = np.random.permutation(np.arange(len(self._roidb)))
-        self._cur = 0
-
-    def _get_next_minibatch_inds(self):
-        """Return the roidb indices for the next minibatch."""
-        # TODO(rbg): remove duplicated code
-        if self._cur + cfg.TRAIN.IMS_PER_BATCH >= len(self._roidb):
-            self._shuffle_roidb_inds(self.gpu_id)
-
-        db_inds = self._perm[self._cur:self._cur + cfg.TRAIN.IMS_PER_BATCH]
-        self._cur += cfg.TRAIN.IMS_PER_BATCH
-        return db_inds
-
-    def run(self):
-        print 'BlobFetcher started'
-        while True:
-            db_inds = self._get_next_minibatch_inds()
-            minibatch_db = [self._roidb[i] for i in db_inds]
-            blobs = get_minibatch(minibatch_db, self._num_classes, self._output_h_w)
-            self._queue.put(blobs)
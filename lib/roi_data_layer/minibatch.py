@@ -11,12 +11,49 @@ import numpy as np
 import numpy.random as npr
 import cv2
 from fast_rcnn.config import cfg
-from utils.blob import prep_im_for_blob, im_list_to_blob
+from utils.blob import prep_im_for_blob, im_list_to_blob, get_im_scale
+from utils.image_io import read_image, get_decode_scale
+from utils.prescaled import read_prescaled
+from utils.instance_index import load_instance_index
+from utils.mask_targets import slice_bounds, crop_resize_targets, \
+    crop_resize_instance_targets
 from utils.cython_bbox import bbox_overlaps
+from fast_rcnn.bbox_transform import expand_bbox_targets
 import math
+from contextlib import contextmanager
+
+def minibatch_blob_names():
+    """Return the names of all the blobs get_minibatch can build for the
+    current config, in the order of the tops of RoIDataLayer.
+    """
+    names = ['data']
+    if cfg.TRAIN.HAS_RPN:
+        names += ['im_info', 'gt_boxes']
+    else:
+        names += ['rois', 'labels']
+        if cfg.TRAIN.BBOX_REG:
+            names += ['bbox_targets', 'bbox_inside_weights',
+                      'bbox_outside_weights']
+    return names + ['mask_rois', 'masks']
+
+def get_minibatch(roidb, num_classes, mask_h_w, buf=None, cache=None,
+                  blob_names=None, profiler=None):
+    """Given a roidb, construct a minibatch sampled from it.
+
+    The image blobs are written into buf (a utils.blob.BlobBuffer) if given.
+    The images and instance maps are read through cache (a
+    utils.image_cache.ImageCache) if given.
+
+    Only the blobs in blob_names (default: minibatch_blob_names()) are
+    built: the RoIs are only sampled for the rois, labels, bbox and mask
+    blobs, and the instance maps only read for the mask blobs. The time
+    spent on each kind of blob is recorded in profiler (a
+    utils.profiler.Profiler) if given.
+    """
+    if blob_names is None:
+        blob_names = minibatch_blob_names()
+    wants = lambda *names: any(name in blob_names for name in names)
 
-def get_minibatch(roidb, num_classes, mask_h_w):
-    """Given a roidb, construct a minibatch sampled from it."""
     num_images = len(roidb)
     # Sample random scales to use for each image in this batch
     random_scale_inds = npr.randint(0, high=len(cfg.TRAIN.SCALES),
@@ -28,7 +65,9 @@ def get_minibatch(roidb, num_classes, mask_h_w):
     fg_rois_per_image = np.round(cfg.TRAIN.FG_FRACTION * rois_per_image)
 
     # Get the input image blob, formatted for caffe
-    im_blob, im_scales = _get_image_blob(roidb, random_scale_inds)
+    with _span(profiler, 'data'):
+        im_blob, im_scales = _get_image_blob(roidb, random_scale_inds, buf,
+                                             cache)
 
     # Get the input seg image blob, formatted for caffe
     # seg_blob, im_scales = _get_seg_blob(roidb, random_scale_inds)
@@ -39,6 +78,18 @@ def get_minibatch(roidb, num_classes, mask_h_w):
     # blobs = {'data': im_blob, 'seg': seg_blob, 'ins': ins_blob}
     blobs = {'data': im_blob}
 
+    # Sample the RoIs of every image first, so that every blob can be
+    # allocated once at its final size and dtype and filled in place
+    with_masks = wants('mask_rois', 'masks')
+    samples = []
+    if with_masks or (not cfg.TRAIN.HAS_RPN and
+                      wants('rois', 'labels', 'bbox_targets',
+                            'bbox_inside_weights', 'bbox_outside_weights')):
+        with _span(profiler, 'rois'):
+            samples = [_sample_rois(roidb[im_i], fg_rois_per_image,
+                                    rois_per_image)
+                       for im_i in xrange(num_images)]
+
     if cfg.TRAIN.HAS_RPN:
         assert len(im_scales) == 1, "Single batch only"
         assert len(roidb) == 1, "Single batch only"
@@ -51,50 +102,20 @@ def get_minibatch(roidb, num_classes, mask_h_w):
         blobs['im_info'] = np.array(
             [[im_blob.shape[2], im_blob.shape[3], im_scales[0]]],
             dtype=np.float32)
-        mask_rois_blob = np.zeros((0, 5), dtype=np.float32)
-        masks_blob = np.zeros((0, 14, 14), dtype=np.float32)
-        for im_i in xrange(num_images):
-            labels, overlaps, im_rois, bbox_targets, bbox_inside_weights, mask_rois, masks \
-                = _sample_rois(roidb[im_i], fg_rois_per_image, rois_per_image,
-                               num_classes, mask_h_w)
-            batch_ind_mask =  im_i * np.ones((mask_rois.shape[0], 1))
-            mask_rois_blob_this_image = np.hstack((batch_ind_mask, mask_rois))
-            mask_rois_blob = np.vstack((mask_rois_blob, mask_rois_blob_this_image))
-            masks_blob = np.vstack((masks_blob, masks))
-
-        blobs['mask_rois'] = mask_rois_blob
-        blobs['masks'] = masks_blob
-    else: # not using RPN
+    elif samples:
         # Now, build the region of interest and label blobs
-        rois_blob = np.zeros((0, 5), dtype=np.float32)
-        mask_rois_blob = np.zeros((0, 5), dtype=np.float32)
-        labels_blob = np.zeros((0), dtype=np.float32)
-        bbox_targets_blob = np.zeros((0, 4 * num_classes), dtype=np.float32)
-        bbox_inside_blob = np.zeros(bbox_targets_blob.shape, dtype=np.float32)
-        masks_blob = np.zeros((0, 14, 14), dtype=np.float32)
-        # all_overlaps = []
-        for im_i in xrange(num_images):
-            labels, overlaps, im_rois, bbox_targets, bbox_inside_weights, mask_rois, masks \
-                = _sample_rois(roidb[im_i], fg_rois_per_image, rois_per_image,
-                               num_classes, mask_h_w)
-
+        num_rois = sum(len(labels) for labels, _, _, _ in samples)
+        rois_blob = _empty_blob(buf, 'rois', (num_rois, 5), np.float32)
+        labels_blob = _empty_blob(buf, 'labels', (num_rois,), np.float32)
+        start = 0
+        for im_i, (labels, overlaps, im_rois, _) in enumerate(samples):
+            end = start + len(labels)
             # Add to RoIs blob
-            rois = im_rois
             # _project_im_rois(im_rois, im_scales[im_i])
-            batch_ind = im_i * np.ones((rois.shape[0], 1))
-            batch_ind_mask =  im_i * np.ones((mask_rois.shape[0], 1))
-            rois_blob_this_image = np.hstack((batch_ind, rois))
-            mask_rois_blob_this_image = np.hstack((batch_ind_mask, mask_rois))
-
-            rois_blob = np.vstack((rois_blob, rois_blob_this_image))
-            mask_rois_blob = np.vstack((mask_rois_blob, mask_rois_blob_this_image))
-
-            # Add to labels, bbox targets, and bbox loss blobs
-            labels_blob = np.hstack((labels_blob, labels))
-            bbox_targets_blob = np.vstack((bbox_targets_blob, bbox_targets))
-            bbox_inside_blob = np.vstack((bbox_inside_blob, bbox_inside_weights))
-            masks_blob = np.vstack((masks_blob, masks))
-            # all_overlaps = np.hstack((all_overlaps, overlaps))
+            rois_blob[start:end, 0] = im_i
+            rois_blob[start:end, 1:] = im_rois
+            labels_blob[start:end] = labels
+            start = end
 
         # For debug visualizations
         # _vis_minibatch(im_blob, rois_blob, labels_blob, all_overlaps)
@@ -102,18 +123,82 @@ def get_minibatch(roidb, num_classes, mask_h_w):
         blobs['rois'] = rois_blob
         blobs['labels'] = labels_blob
 
-        if cfg.TRAIN.BBOX_REG:
-            blobs['bbox_targets'] = bbox_targets_blob
-            blobs['bbox_inside_weights'] = bbox_inside_blob
-            blobs['bbox_outside_weights'] = \
-                np.array(bbox_inside_blob > 0).astype(np.float32)
-
-        blobs['mask_rois'] = mask_rois_blob
-        blobs['masks'] = masks_blob
-
-    return blobs
+        if cfg.TRAIN.BBOX_REG and wants('bbox_targets', 'bbox_inside_weights',
+                                        'bbox_outside_weights'):
+            with _span(profiler, 'bbox_targets'):
+                _add_bbox_blobs(blobs, samples, num_classes, buf)
+
+    if with_masks:
+        with _span(profiler, 'masks'):
+            _add_mask_blobs(blobs, roidb, samples, mask_h_w, cache, buf)
+
+    if profiler is not None:
+        profiler.maybe_report('Minibatch blobs')
+    return dict((name, blobs[name]) for name in blob_names)
+
+def _add_bbox_blobs(blobs, samples, num_classes, buf=None):
+    """Add the bbox target and loss weight blobs of the sampled RoIs."""
+    num_rois = sum(len(labels) for labels, _, _, _ in samples)
+    shape = (num_rois, 4 * num_classes)
+    bbox_targets_blob = _empty_blob(buf, 'bbox_targets', shape, np.float32)
+    bbox_inside_blob = _empty_blob(buf, 'bbox_inside_weights', shape,
+                                   np.float32)
+    start = 0
+    for labels, _, _, bbox_target_data in samples:
+        end = start + len(labels)
+        _get_bbox_regression_labels(
+            bbox_target_data, num_classes,
+            out=(bbox_targets_blob[start:end], bbox_inside_blob[start:end]))
+        start = end
+    bbox_outside_blob = _empty_blob(buf, 'bbox_outside_weights', shape,
+                                    np.float32)
+    np.greater(bbox_inside_blob, 0, out=bbox_outside_blob)
+    blobs['bbox_targets'] = bbox_targets_blob
+    blobs['bbox_inside_weights'] = bbox_inside_blob
+    blobs['bbox_outside_weights'] = bbox_outside_blob
+
+def _add_mask_blobs(blobs, roidb, samples, mask_h_w, cache=None, buf=None):
+    """Add the mask RoI and mask target blobs of the sampled RoIs."""
+    mask_samples = []
+    for im_i, (labels, _, rois, _) in enumerate(samples):
+        mask_rois, _, masks = _get_mask_rcnn_blobs(rois, roidb[im_i], labels,
+                                                   mask_h_w, cache)
+        mask_samples.append((mask_rois, masks))
+
+    # The mask targets go to caffe as uint8 (the ignore label -1 as 255)
+    num_masks = sum(len(masks) for _, masks in mask_samples)
+    mask_rois_blob = _empty_blob(buf, 'mask_rois', (num_masks, 5), np.float32)
+    masks_blob = _empty_blob(buf, 'masks', (num_masks, mask_h_w, mask_h_w),
+                             np.uint8)
+    start = 0
+    for im_i, (mask_rois, masks) in enumerate(mask_samples):
+        end = start + len(masks)
+        mask_rois_blob[start:end, 0] = im_i
+        mask_rois_blob[start:end, 1:] = mask_rois
+        masks_blob[start:end] = masks
+        start = end
+    blobs['mask_rois'] = mask_rois_blob
+    blobs['masks'] = masks_blob
+
+def _span(profiler, name):
+    """Return profiler.span(name), or a no-op context without profiler."""
+    if profiler is None:
+        return _no_span()
+    return profiler.span(name)
+
+@contextmanager
+def _no_span():
+    yield
+
+def _empty_blob(buf, name, shape, dtype):
+    """Return an uninitialized blob, from buf (a utils.blob.BlobBuffer) if
+    given.
+    """
+    if buf is None:
+        return np.empty(shape, dtype=dtype)
+    return buf.get(name, shape, dtype)
 
-def _sample_rois(roidb, fg_rois_per_image, rois_per_image, num_classes, mask_h_w):
+def _sample_rois(roidb, fg_rois_per_image, rois_per_image):
     """Generate a random sample of RoIs comprising foreground and background
     examples.
     """
@@ -155,19 +240,24 @@ def _sample_rois(roidb, fg_rois_per_image, rois_per_image, num_classes, mask_h_w
     sampled_boxes = rois[keep_inds]
     rois = sampled_boxes
 
-    bbox_targets, bbox_inside_weights = _get_bbox_regression_labels(
-            roidb['bbox_targets'][keep_inds, :], num_classes)
+    bbox_target_data = roidb['bbox_targets'][keep_inds, :]
 
-    mask_rois, roi_has_mask, masks = _get_mask_rcnn_blobs(sampled_boxes, roidb, labels, mask_h_w)
-    #mask_rois = mask_rois[np.newaxis, :]
-    return labels, overlaps, rois, bbox_targets, bbox_inside_weights, mask_rois, masks
+    return labels, overlaps, rois, bbox_target_data
 
-def _get_mask_rcnn_blobs(sampled_boxes, roidb, labels, mask_h_w):
+def _get_mask_rcnn_blobs(sampled_boxes, roidb, labels, mask_h_w, cache=None):
     M = mask_h_w
 
-    mask_file = cv2.imread(roidb["ins"], cv2.IMREAD_GRAYSCALE)
-    if roidb['flipped']:
-        mask_file = mask_file[:, ::-1]
+    instances = None
+    if cfg.TRAIN.INSTANCE_INDEX:
+        instances = load_instance_index(cfg.TRAIN.INSTANCE_INDEX).get(
+            roidb["ins"])
+    if instances is None:
+        path = roidb["ins"]
+        load = lambda: cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        # the flipped and unflipped entries share the cached map
+        mask_file = load() if cache is None else cache.get(path, load)
+        if roidb['flipped']:
+            mask_file = mask_file[:, ::-1]
 
     polys_gt_inds = np.where(
         (roidb['gt_classes'] > 0)
@@ -190,9 +280,6 @@ def _get_mask_rcnn_blobs(sampled_boxes, roidb, labels, mask_h_w):
 
     if fg_inds.shape[0] > 0:
 
-        # Class labels for the foreground rois
-        masks = np.zeros((fg_inds.shape[0], M, M), dtype=np.int32)
-
         # Find overlap between all foreground rois and the bounding boxes
         # enclosing each segmentation
         rois_fg = sampled_boxes[fg_inds]
@@ -204,39 +291,15 @@ def _get_mask_rcnn_blobs(sampled_boxes, roidb, labels, mask_h_w):
         # (measured by bbox overlap)
         fg_bbox_inds = np.argmax(overlaps_bbfg_bbpolys, axis=1)
 
-        # add fg targets
-        for i in range(rois_fg.shape[0]):
-            fg_bbox_ind = fg_bbox_inds[i]
-            boxes_from_masks_now=boxes_from_masks[fg_bbox_ind]
-            roi_fg = rois_fg[i]
-            # im = cv2.imread(roidb['image'])
-            # cv2.rectangle(im, (boxes_from_masks_now[0], boxes_from_masks_now[1]), (boxes_from_masks_now[2], boxes_from_masks_now[3]), (0, 255, 0), 2)
-            # font = cv2.FONT_HERSHEY_SIMPLEX
-            # cv2.putText(im, 'boxes_from_masks_now', (boxes_from_masks_now[0], boxes_from_masks_now[1]), font, 2, (255, 255, 255), 2)
-            # cv2.imwrite("boxes_from_masks_now.jpg", im)
-            # im = cv2.imread(roidb['image'])
-            # cv2.rectangle(im, (roi_fg[0], roi_fg[1]), (roi_fg[2], roi_fg[3]), (0, 122, 122), 2)
-            # font = cv2.FONT_HERSHEY_SIMPLEX
-            # cv2.putText(im, 'roi_fg_now', (roi_fg[0], roi_fg[1]), font, 2, (122, 122, 122), 2)
-            # cv2.imwrite("roi_fg_now.jpg", im)
-            # im = mask_file.copy()
-            # cv2.rectangle(im, (boxes_from_masks_now[0], boxes_from_masks_now[1]), (boxes_from_masks_now[2], boxes_from_masks_now[3]), (0, 255, 0), 2)
-            # font = cv2.FONT_HERSHEY_SIMPLEX
-            # cv2.putText(im, 'boxes_from_masks_now', (boxes_from_masks_now[0], boxes_from_masks_now[1]), font, 2, (255, 255, 255), 2)
-            # cv2.imwrite("boxes_from_masks_now_mask.jpg", im*999)
-            # im = mask_file.copy()
-            # cv2.rectangle(im, (roi_fg[0], roi_fg[1]), (roi_fg[2], roi_fg[3]), (0, 122, 122), 2)
-            # font = cv2.FONT_HERSHEY_SIMPLEX
-            # cv2.putText(im, 'roi_fg_now', (roi_fg[0], roi_fg[1]), font, 2, (122, 122, 122), 2)
-            # cv2.imwrite("roi_fg_now_mask.jpg", im*999)
-            # # Rasterize the portion of the polygon mask within the given fg roi
-            # to an M x M binary image
-            mask = get_mask(mask_file, roi_fg, boxes_from_masks_now, M)
-            mask = np.array(mask > 0, dtype=np.int32)  # Ensure it's binary
-            # cv2.imwrite("mask.png", mask*999)
-            masks[i, :] = mask
-            # input()
-            # masks[i, :] = np.reshape(mask, (M, M))
+        # Rasterize the portion of the instance map within each fg roi to
+        # an M x M binary image
+        if instances is None:
+            masks = _get_mask_targets(mask_file, rois_fg, boxes_from_masks,
+                                      fg_bbox_inds, M)
+        else:
+            masks = _get_index_mask_targets(instances, roidb['flipped'],
+                                            rois_fg, boxes_from_masks,
+                                            fg_bbox_inds, M)
     else:  # If there are no fg masks (it does happen)
         # The network cannot handle empty blobs, so we must provide a mask
         # We simply take the first bg roi, given it an all -1's mask (ignore
@@ -252,36 +315,137 @@ def _get_mask_rcnn_blobs(sampled_boxes, roidb, labels, mask_h_w):
         roi_has_mask[0] = 1
     return rois_fg, roi_has_mask, masks
 
-def get_mask(mask_in, roi, gt_rois, size):
-    x_start = int(math.floor(roi[1]))
-    x_end = int(math.ceil(roi[3]))
-    y_start = int(math.floor(roi[0]))
-    y_end = int(math.ceil(roi[2]))
-
-    width = mask_in.shape[0]
-    height = mask_in.shape[1]
-    x_start = min(max(0,x_start), width)
-    x_end = min(max(0,x_end), width)
-    y_start = min(max(0,y_start), height)
-    y_end = min(max(0,y_end), height)
-
-    if x_start == x_end:
-        x_end += 1
-    if y_start == y_end:
-        y_end += 1
-    if x_start == mask_in.shape[0]:
-        x_start -= 1
-    if y_start == mask_in.shape[1]:
-        y_start -= 1
-
-    patch_cropped = mask_in[x_start:x_end, y_start:y_end].copy()
-
+def _get_mask_targets(mask_in, rois, gt_rois, gt_inds, size):
+    """get_mask for all the rois at once: the target of rois[i] is the
+    instance that get_mask picks in gt_rois[gt_inds[i]].
+    """
+    # the instance with the most pixels in each gt box, the smallest id on
+    # ties
+    gt_ids = -np.ones(len(gt_rois), dtype=np.int64)
+    for j in np.unique(gt_inds):
+        counts = np.bincount(mask_in[_gt_window(gt_rois[j])].ravel(),
+                             minlength=1)
+        counts[0] = 0
+        if counts.max() > 0:
+            gt_ids[j] = counts.argmax()
+
+    rows, cols = _roi_windows(mask_in.shape, rois)
+    masks = np.empty((len(rois), size, size), dtype=np.int32)
+    valid = (rows[:, 1] > rows[:, 0]) & (cols[:, 1] > cols[:, 0])
+    masks[valid] = crop_resize_targets(mask_in, rows[valid], cols[valid],
+                                       gt_ids[gt_inds[valid]], size)
+    # empty windows, which cv2.resize rejects, go through get_mask as before
+    for i in np.where(~valid)[0]:
+        masks[i] = get_mask(mask_in, rois[i], gt_rois[gt_inds[i]], size) > 0
+    return masks
+
+def _get_index_mask_targets(instances, flipped, rois, gt_rois, gt_inds, size):
+    """_get_mask_targets on the label map indexed by instances (a
+    utils.instance_index.ImageInstances), flipped if flipped, from the
+    masks of the picked instances only.
+    """
+    height, width = instances.shape
+    # the gt windows, in the unflipped map
+    gt_windows = np.zeros((len(gt_rois), 4), dtype=np.int64)
+    for j in np.unique(gt_inds):
+        rows, cols = _gt_window(gt_rois[j])
+        y0, y1, _ = rows.indices(height)
+        x0, x1, _ = cols.indices(width)
+        y1, x1 = max(y0, y1), max(x0, x1)
+        if flipped:
+            x0, x1 = width - x1, width - x0
+        gt_windows[j] = y0, y1, x0, x1
+    # the instance with the most pixels in each gt box, as _get_mask_targets
+    # picks it
+    gt_ks = _dominant_instances(instances, gt_windows)
+
+    rows, cols = _roi_windows(instances.shape, rois)
+    masks = np.empty((len(rois), size, size), dtype=np.int32)
+    valid = (rows[:, 1] > rows[:, 0]) & (cols[:, 1] > cols[:, 0])
+    masks[valid] = crop_resize_instance_targets(
+        instances.mask, instances.boxes, gt_ks[gt_inds[valid]], rows[valid],
+        cols[valid], size, flip_width=width if flipped else None)
+    # empty windows, which cv2.resize rejects, go through get_mask as before
+    if not valid.all():
+        label_map = instances.label_map()
+        if flipped:
+            label_map = label_map[:, ::-1]
+        for i in np.where(~valid)[0]:
+            masks[i] = get_mask(label_map, rois[i], gt_rois[gt_inds[i]],
+                                size) > 0
+    return masks
+
+def _dominant_instances(instances, windows):
+    """Return, for each window (y0, y1, x0, x1) of rows [y0, y1) and columns
+    [x0, x1) of the (unflipped) label map, the index in instances of the
+    instance with the most pixels in it, the smallest id on ties, or -1 if
+    the window holds no instance pixel.
+    """
+    boxes = instances.boxes
+    # windows x instances intersections
+    iy0 = np.maximum(boxes[:, 1], windows[:, 0:1])
+    iy1 = np.minimum(boxes[:, 3] + 1, windows[:, 1:2])
+    ix0 = np.maximum(boxes[:, 0], windows[:, 2:3])
+    ix1 = np.minimum(boxes[:, 2] + 1, windows[:, 3:4])
+    # instances within a window count all their pixels, the ones across its
+    # border the pixels of their mask within it
+    inside = ((iy0 == boxes[:, 1]) & (iy1 == boxes[:, 3] + 1) &
+              (ix0 == boxes[:, 0]) & (ix1 == boxes[:, 2] + 1))
+    counts = np.where(inside, instances.areas, 0)
+    # an instance across the border has at most min(area, intersection)
+    # pixels in the window: skip the ones that cannot beat the best instance
+    # within it
+    bound = np.minimum(instances.areas, (np.maximum(iy1 - iy0, 0) *
+                                         np.maximum(ix1 - ix0, 0)))
+    best = counts.max(axis=1) if counts.shape[1] > 0 else counts[:, :0]
+    candidates = ~inside & (bound > 0) & (bound >= best[:, np.newaxis])
+    for j, k in zip(*np.where(candidates)):
+        x1, y1 = boxes[k, :2]
+        counts[j, k] = instances.mask(k)[iy0[j, k] - y1:iy1[j, k] - y1,
+                                         ix0[j, k] - x1:ix1[j, k] - x1].sum()
+    ks = -np.ones(len(windows), dtype=np.int64)
+    if counts.shape[1] > 0:
+        has_pixels = counts.max(axis=1) > 0
+        ks[has_pixels] = counts[has_pixels].argmax(axis=1)
+    return ks
+
+def _roi_windows(shape, rois):
+    """Return the N x 2 [start, stop) rows and columns that get_mask crops
+    for rois from a label map of the given shape.
+    """
+    x_start = np.floor(rois[:, 1]).astype(np.int64)
+    x_end = np.ceil(rois[:, 3]).astype(np.int64)
+    y_start = np.floor(rois[:, 0]).astype(np.int64)
+    y_end = np.ceil(rois[:, 2]).astype(np.int64)
+
+    width = shape[0]
+    height = shape[1]
+    x_start = np.clip(x_start, 0, width)
+    x_end = np.clip(x_end, 0, width)
+    y_start = np.clip(y_start, 0, height)
+    y_end = np.clip(y_end, 0, height)
+
+    x_end += x_start == x_end
+    y_end += y_start == y_end
+    x_start -= x_start == shape[0]
+    y_start -= y_start == shape[1]
+
+    rows = np.vstack(slice_bounds(x_start, x_end, shape[0])).T
+    cols = np.vstack(slice_bounds(y_start, y_end, shape[1])).T
+    return rows, cols
+
+def _gt_window(gt_rois):
+    """Return the (rows, columns) slices get_mask crops for gt_rois."""
     x_start_gt = int(math.floor(gt_rois[1]))
     x_end_gt = int(math.ceil(gt_rois[3]))
     y_start_gt = int(math.floor(gt_rois[0]))
     y_end_gt = int(math.ceil(gt_rois[2]))
+    return (slice(x_start_gt, x_end_gt), slice(y_start_gt, y_end_gt))
 
-    gt_patch_cropped = mask_in[x_start_gt:x_end_gt, y_start_gt:y_end_gt].copy()
+def get_mask(mask_in, roi, gt_rois, size):
+    rows, cols = _roi_windows(mask_in.shape, np.array([roi]))
+    patch_cropped = mask_in[rows[0, 0]:rows[0, 1], cols[0, 0]:cols[0, 1]].copy()
+    gt_patch_cropped = mask_in[_gt_window(gt_rois)].copy()
     # find the main obj by count the number of pixel
     ids = np.unique(gt_patch_cropped)
     size_ = -1
@@ -302,30 +466,61 @@ def get_mask(mask_in, roi, gt_rois, size):
     # mask = np.array(patch_resized == id_pick, dtype=np.int32)
     return mask
 
-def _get_image_blob(roidb, scale_inds):
+def _get_image_blob(roidb, scale_inds, buf=None, cache=None):
     """Builds an input blob from the images in the roidb at the specified
     scales.
     """
     num_images = len(roidb)
     processed_ims = []
     im_scales = []
+    fused = cfg.TRAIN.UINT8_RESIZE
     for i in xrange(num_images):
-        im = cv2.imread(roidb[i]['image'])
+        target_size = cfg.TRAIN.SCALES[scale_inds[i]]
+        if cfg.TRAIN.PRESCALED_DIR:
+            # pre-rendered at this scale by tools/prescale_images.py
+            im, im_scale = read_prescaled(cfg.TRAIN.PRESCALED_DIR,
+                                          roidb[i]['image'], target_size,
+                                          cfg.TRAIN.MAX_SIZE)
+            if im is not None:
+                if roidb[i]['flipped']:
+                    im = im[:, ::-1, :]
+                if not fused:
+                    im = im.astype(np.float32) - cfg.PIXEL_MEANS
+                im_scales.append(im_scale)
+                processed_ims.append(im)
+                continue
+        max_scale = 1.
+        if cfg.TRAIN.REDUCED_DECODE:
+            # a cached image is decoded for the largest scale, so that it
+            # serves every scale
+            max_scale = get_im_scale((roidb[i]['height'], roidb[i]['width']),
+                                     target_size if cache is None
+                                     else max(cfg.TRAIN.SCALES),
+                                     cfg.TRAIN.MAX_SIZE)
+        path = roidb[i]['image']
+        if cache is None:
+            im, decode_scale = read_image(path, max_scale)
+        else:
+            # the flipped and unflipped entries share the cached image
+            decode_scale = get_decode_scale(path, max_scale)
+            im = cache.get(path, lambda: read_image(path, max_scale)[0])
         if roidb[i]['flipped']:
             im = im[:, ::-1, :]
-        target_size = cfg.TRAIN.SCALES[scale_inds[i]]
         im, im_scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size,
-                                        cfg.TRAIN.MAX_SIZE)
-        im_scales.append(im_scale)
+                                        cfg.TRAIN.MAX_SIZE, fused=fused)
+        # relative to the full-resolution image, as the roidb boxes
+        im_scales.append(im_scale * decode_scale)
         processed_ims.append(im)
 
     # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+    blob = im_list_to_blob(processed_ims,
+                           pixel_means=cfg.PIXEL_MEANS if fused else None,
+                           buf=buf)
 
     return blob, im_scales
 
 # added for reading seg data
-def _get_seg_blob(roidb, scale_inds):
+def _get_seg_blob(roidb, scale_inds, buf=None):
     """Builds an input blob from the images in the roidb at the specified
     scales.
     """
@@ -344,7 +539,7 @@ def _get_seg_blob(roidb, scale_inds):
         processed_ims.append(seg)
 
     # Create a blob to hold the input images
-    blob = seg_list_to_blob(processed_ims)
+    blob = seg_list_to_blob(processed_ims, buf=buf)
 
     return blob, im_scales
 
@@ -353,29 +548,21 @@ def _project_im_rois(im_rois, im_scale_factor):
     rois = im_rois * im_scale_factor
     return rois
 
-def _get_bbox_regression_labels(bbox_target_data, num_classes):
+def _get_bbox_regression_labels(bbox_target_data, num_classes, out=None):
     """Bounding-box regression targets are stored in a compact form in the
     roidb.
 
     This function expands those targets into the 4-of-4*K representation used
     by the network (i.e. only one class has non-zero targets). The loss weights
-    are similarly expanded.
+    are similarly expanded. The outputs are written into out (a pair of
+    N x 4K float32 arrays) if given.
 
     Returns:
         bbox_target_data (ndarray): N x 4K blob of regression targets
         bbox_inside_weights (ndarray): N x 4K blob of loss weights
     """
-    clss = bbox_target_data[:, 0]
-    bbox_targets = np.zeros((clss.size, 4 * num_classes), dtype=np.float32)
-    bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
-    inds = np.where(clss > 0)[0]
-    for ind in inds:
-        cls = clss[ind]
-        start = int(4 * cls)
-        end = start + 4
-        bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-        bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
-    return bbox_targets, bbox_inside_weights
+    return expand_bbox_targets(bbox_target_data, num_classes,
+                               cfg.TRAIN.BBOX_INSIDE_WEIGHTS, out=out)
 
 def _vis_minibatch(im_blob, rois_blob, labels_blob, overlaps):
     """Visualize a mini-batch for debugging."""
@@ -0,0 +1,341 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Minibatch index streams and multi-worker prefetching for the data layers.
+
+A MinibatchStream is the endless, seeded sequence of roidb index minibatches
+a data layer trains on. A Prefetcher builds those minibatches with N worker
+processes (or threads): every worker replays the same stream and builds
+every N-th minibatch of it, so the workers never duplicate work. Each worker
+has a bounded queue of its own and the layer takes the minibatches round
+robin from the queues. The queues thus act as a reorder buffer of at most
+N * depth minibatches, and the layer receives the minibatches in stream
+order, the same order for any number of workers. Worker processes build the
+minibatches in shared memory slots, so that the image blobs are not pickled
+through the queues.
+"""
+
+import time
+import atexit
+import threading
+import traceback
+import Queue
+import ctypes
+import multiprocessing
+import numpy as np
+from utils.blob import BlobBuffer
+
+# seconds a blocked worker or consumer waits before checking for shutdown
+_POLL_INTERVAL = 0.5
+
+# alignment in bytes of the blobs in a shared memory slot
+_ALIGN = 64
+
+
+class MinibatchStream(object):
+    """Endless sequence of roidb index minibatches.
+
+    The roidb is shuffled once per epoch with a RandomState of its own, so
+    a stream only depends on its seed (e.g. cfg.RNG_SEED plus the rank of
+    the GPU) and each GPU of a multi-GPU run sees a different order.
+
+    Arguments:
+        roidb (list): the training roidb
+        ims_per_batch (int): number of images per minibatch
+        seed (int): seed of the shuffling
+        aspect_grouping (bool): only put images of the same orientation
+            (landscape or portrait) in a minibatch
+    """
+
+    def __init__(self, roidb, ims_per_batch, seed, aspect_grouping=False):
+        self._num_images = len(roidb)
+        self._ims_per_batch = ims_per_batch
+        self._rng = np.random.RandomState(seed)
+        self._horz = None
+        if aspect_grouping:
+            widths = np.array([r['width'] for r in roidb])
+            heights = np.array([r['height'] for r in roidb])
+            self._horz = widths >= heights
+        self._shuffle()
+
+    def _shuffle(self):
+        """Randomly permute the training roidb."""
+        if self._horz is None:
+            self._perm = self._rng.permutation(np.arange(self._num_images))
+        else:
+            # shuffle each orientation, cut it into minibatches and
+            # shuffle the minibatches
+            rows = []
+            for inds in (np.where(self._horz)[0], np.where(~self._horz)[0]):
+                inds = self._rng.permutation(inds)
+                num = len(inds) // self._ims_per_batch * self._ims_per_batch
+                rows.append(inds[:num].reshape((-1, self._ims_per_batch)))
+            rows = np.vstack(rows)
+            row_perm = self._rng.permutation(np.arange(rows.shape[0]))
+            self._perm = rows[row_perm, :].ravel()
+        self._cur = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the roidb indices of the next minibatch."""
+        if self._cur + self._ims_per_batch > len(self._perm):
+            self._shuffle()
+        db_inds = self._perm[self._cur:self._cur + self._ims_per_batch]
+        self._cur += self._ims_per_batch
+        return db_inds
+
+
+def _put(queue, item, stop):
+    """Put item in queue, giving up if stop is set. Return True if put."""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _get(queue, stop):
+    """Get an item from queue, giving up (returning None) if stop is set."""
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=_POLL_INTERVAL)
+        except Queue.Empty:
+            pass
+    return None
+
+
+class _SlotBuffer(BlobBuffer):
+    """BlobBuffer carving the blobs of a minibatch out of one slot of shared
+    memory.
+
+    get_minibatch writes its image blobs straight into the slot through
+    BlobBuffer.get; pack then copies the other (small) blobs in and
+    describes every blob by its offset, so only that description goes
+    through the queue. Blobs that do not fit in the slot are sent whole.
+    """
+
+    def __init__(self, mem):
+        BlobBuffer.__init__(self)
+        self._mem = mem
+        self._base = mem.__array_interface__['data'][0]
+        self.reset()
+
+    def reset(self):
+        """Free the whole slot for a new minibatch."""
+        self._offset = 0
+
+    def _alloc(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        start = -(-self._offset // _ALIGN) * _ALIGN
+        if start + nbytes > len(self._mem):
+            return None
+        self._offset = start + nbytes
+        return self._mem[start:start + nbytes].view(dtype).reshape(shape)
+
+    def get(self, name, shape, dtype):
+        blob = self._alloc(shape, dtype)
+        if blob is None:
+            return np.empty(shape, dtype=dtype)
+        return blob
+
+    def pack(self, blobs):
+        """Return the description of blobs sent to the consumer: name ->
+        (offset, shape, dtype) for the blobs in the slot, name -> array for
+        the others.
+        """
+        packed = {}
+        for name, blob in blobs.iteritems():
+            addr = blob.__array_interface__['data'][0]
+            if not (blob.flags.c_contiguous and
+                    self._base <= addr < self._base + len(self._mem)):
+                dst = self._alloc(blob.shape, blob.dtype)
+                if dst is None:
+                    packed[name] = blob
+                    continue
+                dst[...] = blob
+                addr = dst.__array_interface__['data'][0]
+            packed[name] = (addr - self._base, blob.shape, blob.dtype.str)
+        return packed
+
+
+def _unpack(mem, packed):
+    """Return the blobs described by _SlotBuffer.pack, as views of mem."""
+    blobs = {}
+    for name, blob in packed.iteritems():
+        if isinstance(blob, tuple):
+            offset, shape, dtype = blob
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            blob = mem[offset:offset + nbytes].view(dtype).reshape(shape)
+        blobs[name] = blob
+    return blobs
+
+
+def minibatch_slot_bytes(ims_per_batch, max_scale, max_size,
+                         bytes_per_pixel, extra=4 << 20):
+    """Size of a shared memory slot holding a minibatch of ims_per_batch
+    images of up to max_scale x max_size pixels, bytes_per_pixel bytes of
+    image blobs per pixel, and extra bytes for the other blobs.
+    """
+    return ims_per_batch * max_scale * max_size * bytes_per_pixel + extra
+
+
+def _run_worker(rank, num_workers, stream, roidb, build_fn, queue, stop,
+                seed, slots=None, free_slots=None, reseed=True):
+    """Build the minibatches rank, rank + num_workers, ... of stream.
+
+    With slots (_SlotBuffer), each minibatch is built into a slot taken from
+    free_slots and sent as (slot, packed blobs); otherwise it is sent as
+    (None, blobs). If reseed, the numpy RNG is seeded from seed and the
+    position of each minibatch in the stream before building it; worker
+    threads must not, as they share the RNG of the trainer.
+    """
+    try:
+        for k, db_inds in enumerate(stream):
+            if stop.is_set():
+                return
+            if k % num_workers != rank:
+                continue
+            if reseed:
+                # the sampling of a minibatch only depends on its position
+                # in the stream, not on the number of workers
+                np.random.seed([seed, k])
+            minibatch_db = [roidb[i] for i in db_inds]
+            if slots is None:
+                item = (None, build_fn(minibatch_db), None)
+            else:
+                slot = _get(free_slots, stop)
+                if slot is None:
+                    return
+                buf = slots[slot]
+                buf.reset()
+                blobs = build_fn(minibatch_db, buf=buf)
+                item = (slot, buf.pack(blobs), None)
+            if not _put(queue, item, stop):
+                return
+    except Exception:
+        _put(queue, (None, None, traceback.format_exc()), stop)
+
+
+class Prefetcher(object):
+    """Build the minibatches of a MinibatchStream ahead of time.
+
+    Worker processes write the minibatches into a ring of depth slots of
+    shared memory each (if slot_bytes is given): get returns views of a
+    slot, which goes back to its worker on the next call to get, so the
+    blobs are copied once, into the net. Without slots, the blobs are
+    pickled through the queues.
+
+    Arguments:
+        roidb (list): the training roidb
+        build_fn (callable): build_fn(minibatch_db, buf=None) returns the
+            blobs of the minibatch of roidb entries minibatch_db, with its
+            image blobs in buf (a utils.blob.BlobBuffer) if given (e.g. a
+            partial of get_minibatch)
+        num_workers (int): number of workers
+        ims_per_batch, seed, aspect_grouping: arguments of the
+            MinibatchStream replayed by each worker
+        depth (int): number of built minibatches each worker may queue
+        use_threads (bool): use threads instead of processes, e.g. when
+            build_fn can not run in a forked process. Threads share the
+            numpy RNG with the trainer, so they do not seed it and their
+            sampling is not reproducible
+        slot_bytes (int): size of a shared memory slot (see
+            minibatch_slot_bytes), None to pickle the blobs; unused with
+            threads
+    """
+
+    def __init__(self, roidb, build_fn, num_workers, ims_per_batch, seed,
+                 aspect_grouping=False, depth=2, use_threads=False,
+                 slot_bytes=None):
+        if use_threads:
+            make_queue, make_worker = Queue.Queue, threading.Thread
+            self._stop = threading.Event()
+            slot_bytes = None
+        else:
+            make_queue = multiprocessing.Queue
+            make_worker = multiprocessing.Process
+            self._stop = multiprocessing.Event()
+        self._queues = [make_queue(depth) for _ in xrange(num_workers)]
+        self._slots = [None] * num_workers
+        self._free_slots = [None] * num_workers
+        self._workers = []
+        for rank in xrange(num_workers):
+            if slot_bytes is not None:
+                # allocated before the fork, so shared with the worker
+                self._slots[rank] = [
+                    _SlotBuffer(np.frombuffer(multiprocessing.RawArray(
+                        ctypes.c_uint8, slot_bytes), dtype=np.uint8))
+                    for _ in xrange(depth)]
+                self._free_slots[rank] = multiprocessing.Queue()
+                for slot in xrange(depth):
+                    self._free_slots[rank].put(slot)
+            stream = MinibatchStream(roidb, ims_per_batch, seed,
+                                     aspect_grouping)
+            worker = make_worker(target=_run_worker,
+                                 args=(rank, num_workers, stream, roidb,
+                                       build_fn, self._queues[rank],
+                                       self._stop, seed, self._slots[rank],
+                                       self._free_slots[rank],
+                                       not use_threads))
+            # do not keep the trainer alive
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self._next = 0
+        # (rank, slot) of the blobs returned by the last call to get
+        self._held = None
+        atexit.register(self.close)
+        print 'Prefetching minibatches with {:d} {:s}{:s}'.format(
+            num_workers, 'threads' if use_threads else 'processes',
+            ' through shared memory' if slot_bytes is not None else '')
+
+    def get(self):
+        """Return the blobs of the next minibatch of the stream, valid until
+        the next call to get.
+        """
+        if self._held is not None:
+            rank, slot = self._held
+            self._free_slots[rank].put(slot)
+            self._held = None
+        rank = self._next
+        while True:
+            try:
+                slot, blobs, error = self._queues[rank].get(
+                    timeout=_POLL_INTERVAL)
+                break
+            except Queue.Empty:
+                if not self._workers[rank].is_alive():
+                    raise RuntimeError(
+                        'Prefetch worker {:d} died'.format(rank))
+        if error is not None:
+            raise RuntimeError('Prefetch worker {:d} failed:\n{:s}'.format(
+                rank, error))
+        if slot is not None:
+            blobs = _unpack(self._slots[rank][slot]._mem, blobs)
+            self._held = (rank, slot)
+        self._next = (rank + 1) % len(self._workers)
+        return blobs
+
+    def close(self):
+        """Stop the workers and wait for them to exit."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        deadline = time.time() + 5 * _POLL_INTERVAL
+        for queue, worker in zip(self._queues, self._workers):
+            # unblock a worker waiting on a full queue
+            while worker.is_alive() and time.time() < deadline:
+                try:
+                    queue.get_nowait()
+                except Queue.Empty:
+                    worker.join(_POLL_INTERVAL)
+            if worker.is_alive() and hasattr(worker, 'terminate'):
+                worker.terminate()
@@ -15,72 +15,54 @@ from fast_rcnn.config import cfg
 from roi_data_layer_with_instance.minibatch import get_minibatch
 import numpy as np
 import yaml
-from multiprocessing import Process, Queue
+from utils.blob import BlobBuffer
+from roi_data_layer.prefetch import MinibatchStream, Prefetcher, \
+    minibatch_slot_bytes
+from functools import partial
 
 class RoIDataLayer(caffe.Layer):
     """Fast R-CNN data layer used for training."""
 
-    def _shuffle_roidb_inds(self, gpu_id):
-        self.gpu_id = gpu_id
-        """Randomly permute the training roidb."""
-        if cfg.TRAIN.ASPECT_GROUPING:
-            widths = np.array([r['width'] for r in self._roidb])
-            heights = np.array([r['height'] for r in self._roidb])
-            horz = (widths >= heights)
-            vert = np.logical_not(horz)
-            horz_inds = np.where(horz)[0]
-            vert_inds = np.where(vert)[0]
-            inds = np.hstack((
-                np.random.permutation(horz_inds),
-                np.random.permutation(vert_inds)))
-            inds = np.reshape(inds, (-1, 2))
-            np.random.seed(gpu_id)
-            row_perm = np.random.permutation(np.arange(inds.shape[0]))
-            inds = np.reshape(inds[row_perm, :], (-1,))
-            self._perm = inds
-        else:
-            self._perm = np.random.permutation(np.arange(len(self._roidb)))
-        self._cur = 0
-
-    def _get_next_minibatch_inds(self):
-        """Return the roidb indices for the next minibatch."""
-        if self._cur + cfg.TRAIN.IMS_PER_BATCH >= len(self._roidb):
-            self._shuffle_roidb_inds(self.gpu_id)
-
-        db_inds = self._perm[self._cur:self._cur + cfg.TRAIN.IMS_PER_BATCH]
-        self._cur += cfg.TRAIN.IMS_PER_BATCH
-        return db_inds
-
     def _get_next_minibatch(self):
         """Return the blobs to be used for the next minibatch.
 
-        If cfg.TRAIN.USE_PREFETCH is True, then blobs will be computed in a
-        separate process and made available through self._blob_queue.
+        If cfg.TRAIN.USE_PREFETCH is a number of workers, the blobs are
+        built ahead of time by a Prefetcher.
         """
-        if cfg.TRAIN.USE_PREFETCH:
-            return self._blob_queue.get()
-        else:
-            db_inds = self._get_next_minibatch_inds()
-            minibatch_db = [self._roidb[i] for i in db_inds]
-            return get_minibatch(minibatch_db, self._num_classes)
+        if self._prefetcher is not None:
+            return self._prefetcher.get()
+        db_inds = self._stream.next()
+        minibatch_db = [self._roidb[i] for i in db_inds]
+        return get_minibatch(minibatch_db, self._num_classes,
+                             buf=self._blob_buffer)
 
     def set_roidb(self, roidb, gpu_id=0):
-        """Set the roidb to be used by this layer during training."""
+        """Set the roidb to be used by this layer during training.
+
+        The minibatch order is seeded with cfg.RNG_SEED + gpu_id, so that
+        the GPUs of a multi-GPU run train on different minibatches.
+        """
         self._roidb = roidb
-        self._shuffle_roidb_inds(gpu_id)
-        if cfg.TRAIN.USE_PREFETCH:
-            self._blob_queue = Queue(10)
-            self._prefetch_process = BlobFetcher(self._blob_queue,
-                                                 self._roidb,
-                                                 self._num_classes, gpu_id)
-            self._prefetch_process.start()
-            # Terminate the child process when the parent exists
-            def cleanup():
-                print 'Terminating BlobFetcher'
-                self._prefetch_process.terminate()
-                self._prefetch_process.join()
-            import atexit
-            atexit.register(cleanup)
+        seed = cfg.RNG_SEED + gpu_id
+        num_workers = int(cfg.TRAIN.USE_PREFETCH)
+        if num_workers > 0:
+            build_fn = partial(get_minibatch, num_classes=self._num_classes)
+            slot_bytes = None
+            if cfg.TRAIN.PREFETCH_SHARED_MEMORY:
+                # room for the float32 data and uint8 ins blobs at their largest
+                slot_bytes = minibatch_slot_bytes(
+                    cfg.TRAIN.IMS_PER_BATCH, max(cfg.TRAIN.SCALES),
+                    cfg.TRAIN.MAX_SIZE, 3 * 4 + 1)
+            self._prefetcher = Prefetcher(
+                roidb, build_fn, num_workers, cfg.TRAIN.IMS_PER_BATCH, seed,
+                aspect_grouping=cfg.TRAIN.ASPECT_GROUPING,
+                depth=cfg.TRAIN.PREFETCH_DEPTH,
+                use_threads=cfg.TRAIN.PREFETCH_THREADS,
+                slot_bytes=slot_bytes)
+        else:
+            self._stream = MinibatchStream(
+                roidb, cfg.TRAIN.IMS_PER_BATCH, seed,
+                aspect_grouping=cfg.TRAIN.ASPECT_GROUPING)
 
     def setup(self, bottom, top):
         """Setup the RoIDataLayer."""
@@ -89,6 +71,11 @@ class RoIDataLayer(caffe.Layer):
         layer_params = yaml.load(self.param_str)
 
         self._num_classes = layer_params['num_classes']
+        # the blobs are copied into the tops as soon as they are built, so
+        # their memory is reused across minibatches (but not by the
+        # prefetch workers, whose blobs wait in a queue)
+        self._blob_buffer = BlobBuffer()
+        self._prefetcher = None
 
         self._name_to_top_map = {}
 
@@ -175,41 +162,3 @@ class RoIDataLayer(caffe.Layer):
     def reshape(self, bottom, top):
         """Reshaping happens during the call to forward."""
         pass
-
-class BlobFetcher(Process):
-    """Experimental class for prefetching blobs in a separate process."""
-    def __init__(self, queue, roidb, num_classes, gpu_id=0):
-        super(BlobFetcher, self).__init__()
-        self._queue = queue
-        self._roidb = roidb
-        self._num_classes = num_classes
-        self._perm = None
-        self._cur = 0
-        self.gpu_id = gpu_id
-        self._shuffle_roidb_inds(self.gpu_id)
-        # fix the random seed for reproducibility
-        np.random.seed(cfg.RNG_SEED)
-
-    def _shuffle_roidb_inds(self):
-        """Randomly permute the training roidb."""
-        # TODO(rbg): remove duplicated code
-        self._perm = np.random.permutation(np.arange(len(self._roidb)))
-        self._cur = 0
-
-    def _get_next_minibatch_inds(self):
-        """Return the roidb indices for the next minibatch."""
-        # TODO(rbg): remove duplicated code
-        if self._cur + cfg.TRAIN.IMS_PER_BATCH >= len(self._roidb):
-            self._shuffle_roidb_inds(self.gpu_id)
-
-        db_inds = self._perm[self._cur:self._cur + cfg.TRAIN.IMS_PER_BATCH]
-        self._cur += cfg.TRAIN.IMS_PER_BATCH
-        return db_inds
-
-    def run(self):
-        print 'BlobFetcher started'
-        while True:
-            db_inds = self._get_next_minibatch_inds()
-            minibatch_db = [self._roidb[i] for i in db_inds]
-            blobs = get_minibatch(minibatch_db, self._num_classes)
-            self._queue.put(blobs)
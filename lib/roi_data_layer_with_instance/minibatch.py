@@ -14,8 +14,11 @@ from fast_rcnn.config import cfg
 from utils.blob import prep_im_for_blob, im_list_to_blob, \
     prep_seg_for_blob, seg_list_to_blob, prep_ins_for_blob, ins_list_to_blob
 
-def get_minibatch(roidb, num_classes):
-    """Given a roidb, construct a minibatch sampled from it."""
+def get_minibatch(roidb, num_classes, buf=None):
+    """Given a roidb, construct a minibatch sampled from it.
+
+    The image blobs are written into buf (a utils.blob.BlobBuffer) if given.
+    """
     num_images = len(roidb)
     # Sample random scales to use for each image in this batch
     random_scale_inds = npr.randint(0, high=len(cfg.TRAIN.SCALES),
@@ -27,13 +30,13 @@ def get_minibatch(roidb, num_classes):
     fg_rois_per_image = np.round(cfg.TRAIN.FG_FRACTION * rois_per_image)
 
     # Get the input image blob, formatted for caffe
-    im_blob, im_scales = _get_image_blob(roidb, random_scale_inds)
+    im_blob, im_scales = _get_image_blob(roidb, random_scale_inds, buf)
 
     # Get the input seg image blob, formatted for caffe
     # seg_blob, im_scales = _get_seg_blob(roidb, random_scale_inds)
 
     # Get the input ins image blob, formatted for caffe
-    ins_blob, im_scales = _get_ins_blob(roidb, random_scale_inds)
+    ins_blob, im_scales = _get_ins_blob(roidb, random_scale_inds, buf)
 
     # add seg_blob
     # blobs = {'data': im_blob, 'seg': seg_blob, 'ins': ins_blob}
@@ -135,30 +138,33 @@ def _sample_rois(roidb, fg_rois_per_image, rois_per_image, num_classes):
 
     return labels, overlaps, rois, bbox_targets, bbox_inside_weights
 
-def _get_image_blob(roidb, scale_inds):
+def _get_image_blob(roidb, scale_inds, buf=None):
     """Builds an input blob from the images in the roidb at the specified
     scales.
     """
     num_images = len(roidb)
     processed_ims = []
     im_scales = []
+    fused = cfg.TRAIN.UINT8_RESIZE
     for i in xrange(num_images):
         im = cv2.imread(roidb[i]['image'])
         if roidb[i]['flipped']:
             im = im[:, ::-1, :]
         target_size = cfg.TRAIN.SCALES[scale_inds[i]]
         im, im_scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size,
-                                        cfg.TRAIN.MAX_SIZE)
+                                        cfg.TRAIN.MAX_SIZE, fused=fused)
         im_scales.append(im_scale)
         processed_ims.append(im)
 
     # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+    blob = im_list_to_blob(processed_ims,
+                           pixel_means=cfg.PIXEL_MEANS if fused else None,
+                           buf=buf)
 
     return blob, im_scales
 
 # added for reading seg data
-def _get_seg_blob(roidb, scale_inds):
+def _get_seg_blob(roidb, scale_inds, buf=None):
     """Builds an input blob from the images in the roidb at the specified
     scales.
     """
@@ -177,12 +183,12 @@ def _get_seg_blob(roidb, scale_inds):
         processed_ims.append(seg)
 
     # Create a blob to hold the input images
-    blob = seg_list_to_blob(processed_ims)
+    blob = seg_list_to_blob(processed_ims, buf=buf)
 
     return blob, im_scales
 
 # added for reading ins data
-def _get_ins_blob(roidb, scale_inds):
+def _get_ins_blob(roidb, scale_inds, buf=None):
     """Builds an input blob from the images in the roidb at the specified
     scales.
     """
@@ -201,7 +207,7 @@ def _get_ins_blob(roidb, scale_inds):
         processed_ims.append(ins)
 
     # Create a blob to hold the input images
-    blob = ins_list_to_blob(processed_ims)
+    blob = ins_list_to_blob(processed_ims, buf=buf)
 
     return blob, im_scales
 
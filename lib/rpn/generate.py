@@ -7,7 +7,9 @@
 
 from fast_rcnn.config import cfg
 from fast_rcnn.train import filter_roidb
-from utils.blob import im_list_to_blob
+from utils.blob import im_list_to_blob, prep_im_for_blob, get_im_scale, \
+    BlobBuffer
+from utils.image_io import image_size, read_image
 from utils.timer import Timer
 from generate_anchors import generate_anchors
 from utils.cython_bbox import bbox_overlaps
@@ -48,47 +50,48 @@ def _vis_proposals(im, dets, thresh=0.5):
     plt.tight_layout()
     plt.draw()
 
-def _get_image_blob(im):
+def _get_image_blob(im, buf=None, decode_scale=1.):
     """Converts an image into a network input.
 
     Arguments:
         im (ndarray): a color image in BGR order
+        decode_scale (float): scale of im relative to the full-resolution
+            image (see utils.image_io.read_image); the scale of im_info is
+            relative to the full-resolution image
 
     Returns:
         blob (ndarray): a data blob holding an image pyramid
         im_scale_factors (list): list of image scales (relative to im) used
             in the image pyramid
     """
-    im_orig = im.astype(np.float32, copy=True)
-    im_orig -= cfg.PIXEL_MEANS
-
-    im_shape = im_orig.shape
-    im_size_min = np.min(im_shape[0:2])
-    im_size_max = np.max(im_shape[0:2])
-
     processed_ims = []
 
     assert len(cfg.TEST.SCALES) == 1
     target_size = cfg.TEST.SCALES[0]
 
-    im_scale = float(target_size) / float(im_size_min)
-    # Prevent the biggest axis from being more than MAX_SIZE
-    if np.round(im_scale * im_size_max) > cfg.TEST.MAX_SIZE:
-        im_scale = float(cfg.TEST.MAX_SIZE) / float(im_size_max)
-    im = cv2.resize(im_orig, None, None, fx=im_scale, fy=im_scale,
-                    interpolation=cv2.INTER_LINEAR)
-    im_info = np.hstack((im.shape[:2], im_scale))[np.newaxis, :]
+    fused = cfg.TEST.UINT8_PYRAMID
+    im, im_scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size,
+                                    cfg.TEST.MAX_SIZE, fused=fused)
+    im_info = np.hstack((im.shape[:2],
+                         im_scale * decode_scale))[np.newaxis, :]
     processed_ims.append(im)
 
     # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+    blob = im_list_to_blob(processed_ims,
+                           pixel_means=cfg.PIXEL_MEANS if fused else None,
+                           buf=buf)
 
     return blob, im_info
 
-def im_proposals(net, im):
-    """Generate RPN proposals on a single image."""
+def im_proposals(net, im, buf=None, decode_scale=1.):
+    """Generate RPN proposals on a single image.
+
+    The input blob is written into buf (a utils.blob.BlobBuffer) if given.
+    The proposals are relative to the full-resolution image, of which im is
+    decoded at decode_scale.
+    """
     blobs = {}
-    blobs['data'], blobs['im_info'] = _get_image_blob(im)
+    blobs['data'], blobs['im_info'] = _get_image_blob(im, buf, decode_scale)
     net.blobs['data'].reshape(*(blobs['data'].shape))
     net.blobs['im_info'].reshape(*(blobs['im_info'].shape))
     blobs_out = net.forward(
@@ -105,10 +108,16 @@ def imdb_proposals(net, imdb):
 
     _t = Timer()
     imdb_boxes = [[] for _ in xrange(imdb.num_images)]
+    buf = BlobBuffer()
     for i in xrange(imdb.num_images):
-        im = cv2.imread(imdb.image_path_at(i))
+        path = imdb.image_path_at(i)
+        max_scale = 1.
+        if cfg.TEST.REDUCED_DECODE:
+            max_scale = get_im_scale(image_size(path), cfg.TEST.SCALES[0],
+                                     cfg.TEST.MAX_SIZE)
+        im, decode_scale = read_image(path, max_scale)
         _t.tic()
-        imdb_boxes[i], scores = im_proposals(net, im)
+        imdb_boxes[i], scores = im_proposals(net, im, buf, decode_scale)
         _t.toc()
         print 'im_proposals: {:d}/{:d} {:.3f}s' \
               .format(i + 1, imdb.num_images, _t.average_time)
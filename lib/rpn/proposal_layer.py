@@ -47,35 +47,31 @@ class ProposalLayer(caffe.Layer):
     def forward(self, bottom, top):
         # Algorithm:
         #
-        # for each (H, W) location i
-        #   generate A anchor boxes centered on cell i
-        #   apply predicted bbox deltas at cell i to each of the A anchors
-        # clip predicted boxes to image
-        # remove predicted boxes with either height or width < threshold
-        # sort all (proposal, score) pairs by score from highest to lowest
-        # take top pre_nms_topN proposals before NMS
-        # apply NMS with threshold 0.7 to remaining proposals
-        # take after_nms_topN proposals after NMS
-        # return the top proposals (-> RoIs top, scores top)
-
-        assert bottom[0].data.shape[0] == 1, \
-            'Only single item batches are supported'
+        # for each image n in the batch
+        #   for each (H, W) location i
+        #     generate A anchor boxes centered on cell i
+        #     apply predicted bbox deltas at cell i to each of the A anchors
+        #   clip predicted boxes to image n
+        #   remove predicted boxes with either height or width < threshold
+        #   sort all (proposal, score) pairs by score from highest to lowest
+        #   take top pre_nms_topN proposals before NMS
+        #   apply NMS with threshold 0.7 to remaining proposals
+        #   take after_nms_topN proposals after NMS
+        # return the top proposals of every image, tagged with batch index n
+        # (-> RoIs top, scores top)
 
         cfg_key = str('TRAIN' if self.phase == 0 else 'TEST') # either 'TRAIN' or 'TEST'
-        pre_nms_topN  = cfg[cfg_key].RPN_PRE_NMS_TOP_N
-        post_nms_topN = cfg[cfg_key].RPN_POST_NMS_TOP_N
-        nms_thresh    = cfg[cfg_key].RPN_NMS_THRESH
-        min_size      = cfg[cfg_key].RPN_MIN_SIZE
+        if cfg_key == 'TRAIN':
+            assert bottom[0].data.shape[0] == 1, \
+                'Only single item batches are supported'
 
         # the first set of _num_anchors channels are bg probs
         # the second set are the fg probs, which we want
         scores = bottom[0].data[:, self._num_anchors:, :, :]
         bbox_deltas = bottom[1].data
-        im_info = bottom[2].data[0, :]
-
-        if DEBUG:
-            print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
-            print 'scale: {}'.format(im_info[2])
+        num_images = scores.shape[0]
+        assert bottom[2].data.shape[0] == num_images, \
+            'im_info must hold one row per image'
 
         # 1. Generate proposals from bbox deltas and shifted anchors
         height, width = scores.shape[-2:]
@@ -102,6 +98,41 @@ class ProposalLayer(caffe.Layer):
                   shifts.reshape((1, K, 4)).transpose((1, 0, 2))
         anchors = anchors.reshape((K * A, 4))
 
+        blobs = []
+        all_scores = []
+        for n in xrange(num_images):
+            proposals, im_scores = self._proposals_for_image(
+                anchors, scores[n:n + 1], bbox_deltas[n:n + 1],
+                bottom[2].data[n, :], cfg_key)
+            # Output rois blob: (n, x1, y1, x2, y2) where n is the index of
+            # the image in the batch
+            batch_inds = n * np.ones((proposals.shape[0], 1), dtype=np.float32)
+            blobs.append(np.hstack((batch_inds,
+                                    proposals.astype(np.float32, copy=False))))
+            all_scores.append(im_scores)
+        blob = np.vstack(blobs)
+        scores = np.vstack(all_scores)
+        # print blob.shape
+        top[0].reshape(*(blob.shape))
+        top[0].data[...] = blob
+
+        # [Optional] output scores blob
+        if len(top) > 1:
+            top[1].reshape(*(scores.shape))
+            top[1].data[...] = scores
+
+    def _proposals_for_image(self, anchors, scores, bbox_deltas, im_info,
+                             cfg_key):
+        """Turn the RPN outputs of a single image into scored proposals."""
+        pre_nms_topN  = cfg[cfg_key].RPN_PRE_NMS_TOP_N
+        post_nms_topN = cfg[cfg_key].RPN_POST_NMS_TOP_N
+        nms_thresh    = cfg[cfg_key].RPN_NMS_THRESH
+        min_size      = cfg[cfg_key].RPN_MIN_SIZE
+
+        if DEBUG:
+            print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
+            print 'scale: {}'.format(im_info[2])
+
         # Transpose and reshape predicted bbox transformations to get them
         # into the same order as the anchors:
         #
@@ -150,19 +181,7 @@ class ProposalLayer(caffe.Layer):
         proposals = proposals[keep, :]
         scores = scores[keep]
 
-        # Output rois blob
-        # Our RPN implementation only supports a single input image, so all
-        # batch inds are 0
-        batch_inds = np.zeros((proposals.shape[0], 1), dtype=np.float32)
-        blob = np.hstack((batch_inds, proposals.astype(np.float32, copy=False)))
-        # print blob.shape
-        top[0].reshape(*(blob.shape))
-        top[0].data[...] = blob
-
-        # [Optional] output scores blob
-        if len(top) > 1:
-            top[1].reshape(*(scores.shape))
-            top[1].data[...] = scores
+        return proposals, scores
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
@@ -10,10 +10,12 @@ import yaml
 import numpy as np
 import numpy.random as npr
 from fast_rcnn.config import cfg
-from fast_rcnn.bbox_transform import bbox_transform
+from fast_rcnn.bbox_transform import bbox_transform, expand_bbox_targets
+from utils.blob import BlobBuffer
 from utils.cython_bbox import bbox_overlaps
+from utils.instance_index import label_instances
+from utils.mask_targets import slice_bounds, crop_resize_targets
 import cv2
-import math
 DEBUG = False
 
 class ProposalTargetLayer(caffe.Layer):
@@ -26,6 +28,9 @@ class ProposalTargetLayer(caffe.Layer):
         layer_params = yaml.load(self.param_str)
         self._num_classes = layer_params['num_classes']
         self._mask_h_w = layer_params['out_size']
+        # the outputs are copied into the tops in forward, so their memory
+        # is reused across iterations
+        self._blob_buffer = BlobBuffer()
 
         # sampled rois (0, x1, y1, x2, y2)
         top[0].reshape(cfg.TRAIN.BATCH_SIZE, 5, 1, 1)
@@ -70,7 +75,8 @@ class ProposalTargetLayer(caffe.Layer):
         # print 'proposal_target_layer:', fg_rois_per_image
         labels, rois, bbox_targets, bbox_inside_weights, mask_rois, masks = _sample_rois(
             all_rois, gt_boxes, fg_rois_per_image,
-            rois_per_image, self._num_classes, mask_file, self._mask_h_w)
+            rois_per_image, self._num_classes, mask_file, self._mask_h_w,
+            self._blob_buffer)
 
         if DEBUG:
             print 'num fg: {}'.format((labels > 0).sum())
@@ -136,38 +142,26 @@ class ProposalTargetLayer(caffe.Layer):
         pass
 
 
-def _get_bbox_regression_labels(bbox_target_data, num_classes):
+def _get_bbox_regression_labels(bbox_target_data, num_classes, buf=None):
     """Bounding-box regression targets (bbox_target_data) are stored in a
     compact form N x (class, tx, ty, tw, th)
 
     This function expands those targets into the 4-of-4*K representation used
-    by the network (i.e. only one class has non-zero targets).
+    by the network (i.e. only one class has non-zero targets). The outputs
+    reuse the storage of buf (a utils.blob.BlobBuffer) if given.
 
     Returns:
         bbox_target (ndarray): N x 4K blob of regression targets
         bbox_inside_weights (ndarray): N x 4K blob of loss weights
     """
-
-    clss = bbox_target_data[:, 0]
-    bbox_targets = np.zeros((clss.size, 4 * num_classes), dtype=np.float32)
-    # print 'proposal_target_layer:', bbox_targets.shape
-    bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
-    inds = np.where(clss > 0)[0]
-    if cfg.TRAIN.AGNOSTIC:
-        for ind in inds:
-            cls = clss[ind]
-            start = 4 * (1 if cls > 0 else 0)
-            end = start + 4
-            bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-            bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
-    else:
-        for ind in inds:
-            cls = clss[ind]
-            start = int(4 * cls)
-            end = int(start + 4)
-            bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-            bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
-    return bbox_targets, bbox_inside_weights
+    out = None
+    if buf is not None:
+        shape = (bbox_target_data.shape[0], 4 * num_classes)
+        out = (buf.get('bbox_targets', shape, np.float32),
+               buf.get('bbox_inside_weights', shape, np.float32))
+    return expand_bbox_targets(bbox_target_data, num_classes,
+                               cfg.TRAIN.BBOX_INSIDE_WEIGHTS,
+                               agnostic=cfg.TRAIN.AGNOSTIC, out=out)
 
 
 def _compute_targets(ex_rois, gt_rois, labels):
@@ -177,15 +171,21 @@ def _compute_targets(ex_rois, gt_rois, labels):
     assert ex_rois.shape[1] == 4
     assert gt_rois.shape[1] == 4
 
-    targets = bbox_transform(ex_rois, gt_rois)
+    # float32 throughout: the rois and boxes come from float32 blobs
+    targets = np.empty((ex_rois.shape[0], 5), dtype=np.float32)
+    targets[:, 0] = labels
+    targets[:, 1:] = bbox_transform(ex_rois.astype(np.float32, copy=False),
+                                    gt_rois.astype(np.float32, copy=False))
     if cfg.TRAIN.BBOX_NORMALIZE_TARGETS_PRECOMPUTED:
         # Optionally normalize targets by a precomputed mean and stdev
-        targets = ((targets - np.array(cfg.TRAIN.BBOX_NORMALIZE_MEANS))
-                / np.array(cfg.TRAIN.BBOX_NORMALIZE_STDS))
-    return np.hstack(
-            (labels[:, np.newaxis], targets)).astype(np.float32, copy=False)
-
-def _sample_rois(all_rois, gt_boxes, fg_rois_per_image, rois_per_image, num_classes, mask_file, mask_h_w):
+        targets[:, 1:] -= np.array(cfg.TRAIN.BBOX_NORMALIZE_MEANS,
+                                   dtype=np.float32)
+        targets[:, 1:] /= np.array(cfg.TRAIN.BBOX_NORMALIZE_STDS,
+                                   dtype=np.float32)
+    return targets
+
+def _sample_rois(all_rois, gt_boxes, fg_rois_per_image, rois_per_image, num_classes, mask_file, mask_h_w,
+                 buf=None):
     """Generate a random sample of RoIs comprising foreground and background
     examples.
     """
@@ -235,7 +235,7 @@ def _sample_rois(all_rois, gt_boxes, fg_rois_per_image, rois_per_image, num_clas
 
     # print 'proposal_target_layer:', bbox_target_data
     bbox_targets, bbox_inside_weights = \
-        _get_bbox_regression_labels(bbox_target_data, num_classes)
+        _get_bbox_regression_labels(bbox_target_data, num_classes, buf)
 
     mask_rois, roi_has_mask, masks = _get_mask_rcnn_blobs(rois, mask_file, labels, mask_h_w)
     # input()
@@ -267,9 +267,6 @@ def _get_mask_rcnn_blobs(sampled_boxes, mask_file, labels, mask_h_w):
 
     if fg_inds.shape[0] > 0:
 
-        # Class labels for the foreground rois
-        masks = np.zeros((fg_inds.shape[0], M, M), dtype=np.int32)
-
         # Find overlap between all foreground rois and the bounding boxes
         # enclosing each segmentation
         rois_fg = sampled_boxes[fg_inds]
@@ -281,49 +278,10 @@ def _get_mask_rcnn_blobs(sampled_boxes, mask_file, labels, mask_h_w):
         # (measured by bbox overlap)
         fg_bbox_inds = np.argmax(overlaps_bbfg_bbpolys, axis=1)
 
-        # add fg targets
-        for i in range(rois_fg.shape[0]):
-            fg_bbox_ind = fg_bbox_inds[i]
-            boxes_from_masks_now=boxes_from_masks[fg_bbox_ind]
-            boxes_from_masks_now = boxes_from_masks_now.astype(np.uint16)
-            id_now = boxes_from_masks_now[0]
-            roi_fg = rois_fg[i]
-            # im = cv2.imread(roidb['image'])
-            # cv2.rectangle(im, (boxes_from_masks_now[0], boxes_from_masks_now[1]), (boxes_from_masks_now[2], boxes_from_masks_now[3]), (0, 255, 0), 2)
-            # font = cv2.FONT_HERSHEY_SIMPLEX
-            # cv2.putText(im, 'boxes_from_masks_now', (boxes_from_masks_now[0], boxes_from_masks_now[1]), font, 2, (255, 255, 255), 2)
-            # cv2.imwrite("boxes_from_masks_now.jpg", im)
-            # im = cv2.imread(roidb['image'])
-            # cv2.rectangle(im, (roi_fg[0], roi_fg[1]), (roi_fg[2], roi_fg[3]), (0, 122, 122), 2)
-            # font = cv2.FONT_HERSHEY_SIMPLEX
-            # cv2.putText(im, 'roi_fg_now', (roi_fg[0], roi_fg[1]), font, 2, (122, 122, 122), 2)
-            # cv2.imwrite("roi_fg_now.jpg", im)
-            # im = mask_file.copy()
-            # cv2.rectangle(im, (boxes_from_masks_now[0], boxes_from_masks_now[1]), (boxes_from_masks_now[2], boxes_from_masks_now[3]), (0, 255, 0), 2)
-            # font = cv2.FONT_HERSHEY_SIMPLEX
-            # cv2.putText(im, 'boxes_from_masks_now', (boxes_from_masks_now[0], boxes_from_masks_now[1]), font, 2, (255, 255, 255), 2)
-            # cv2.imwrite("boxes_from_masks_now_mask.jpg", im*999)
-            # font = cv2.FONT_HERSHEY_SIMPLEX
-            # im = mask_file.copy()
-            # im = im*100
-            # cv2.rectangle(im, (roi_fg[1], roi_fg[2]), (roi_fg[3], roi_fg[4]), 0, 3)
-            # cv2.putText(im, 'roi_fg_now', (roi_fg[1], roi_fg[2]), font, 2, 123, 2)
-            # cv2.rectangle(im, (boxes_from_masks_now[1], boxes_from_masks_now[2]), (boxes_from_masks_now[3], boxes_from_masks_now[4]), 0, 3)
-            # cv2.putText(im, 'boxes_from_masks_now', (boxes_from_masks_now[1], boxes_from_masks_now[2]), font, 2, 123, 2)
-            # cv2.imwrite("roi_fg_now_mask.jpg", im*20)
-            # # Rasterize the portion of the polygon mask within the given fg roi
-            # to an M x M binary image
-            if id_now == 0:
-                mask = -np.ones((M, M))
-            else:
-                mask = get_mask(mask_file, roi_fg, M, id_now)
-                mask = np.array(mask > 0, dtype=np.int32)  # Ensure it's binary
-            # cv2.imwrite("mask_org.png", im)
-            # cv2.imwrite("mask_crop.png", mask*999)
-            # print("id_now: {}".format(id_now))
-            masks[i, :] = mask
-            # input()
-            # masks[i, :] = np.reshape(mask, (M, M))
+        # Rasterize the portion of the instance map within each fg roi to
+        # an M x M binary image
+        ids = boxes_from_masks[fg_bbox_inds, 0].astype(np.uint16)
+        masks = _get_mask_targets(mask_file, rois_fg, ids, M)
     else:  # If there are no fg masks (it does happen)
         # The network cannot handle empty blobs, so we must provide a mask
         # We simply take the first bg roi, given it an all -1's mask (ignore
@@ -340,45 +298,56 @@ def _get_mask_rcnn_blobs(sampled_boxes, mask_file, labels, mask_h_w):
     return rois_fg, roi_has_mask, masks
 
 def get_bboxes_from_mask(mask_in):
-    ids = np.unique(mask_in)
-    index = (ids != 0)
-    ids = ids[index]
+    # one pass over the map for all the instances
+    ids, boxes, _ = label_instances(mask_in)
     bboxs = np.zeros((len(ids), 5))
-    for i, id in enumerate(ids):
-        position_now = (mask_in==id)
-        rows = np.any(position_now, axis=0)
-        cols = np.any(position_now, axis=1)
-        rmin, rmax = np.where(rows)[0][[0, -1]]
-        cmin, cmax = np.where(cols)[0][[0, -1]]
-        bboxs[i, 0] = id
-        bboxs[i, 1:] = [rmin, cmin, rmax, cmax]
+    bboxs[:, 0] = ids
+    bboxs[:, 1:] = boxes
     return bboxs
 
+def _get_mask_targets(mask_in, rois, ids, size):
+    """get_mask for all the rois at once, for the instances ids (0 for no
+    instance, which gets an all -1 target).
+    """
+    rows, cols = _roi_windows(mask_in.shape, rois)
+    masks = -np.ones((len(rois), size, size), dtype=np.int32)
+    has_id = ids != 0
+    valid = has_id & (rows[:, 1] > rows[:, 0]) & (cols[:, 1] > cols[:, 0])
+    masks[valid] = crop_resize_targets(mask_in, rows[valid], cols[valid],
+                                       ids[valid], size)
+    # empty windows, which cv2.resize rejects, go through get_mask as before
+    for i in np.where(has_id & ~valid)[0]:
+        masks[i] = get_mask(mask_in, rois[i], size, ids[i]) > 0
+    return masks
+
+def _roi_windows(shape, rois):
+    """Return the N x 2 [start, stop) rows and columns that get_mask crops
+    for rois (idx, x1, y1, x2, y2) from a label map of the given shape.
+    """
+    x_start = np.floor(rois[:, 1]).astype(np.int64)
+    x_end = np.ceil(rois[:, 3]).astype(np.int64)
+    y_start = np.floor(rois[:, 2]).astype(np.int64)
+    y_end = np.ceil(rois[:, 4]).astype(np.int64)
+
+    width = shape[0]
+    height = shape[1]
+    x_start = np.clip(x_start, 0, height)
+    x_end = np.clip(x_end, 0, height)
+    y_start = np.clip(y_start, 0, width)
+    y_end = np.clip(y_end, 0, width)
+
+    x_end += x_start == x_end
+    y_end += y_start == y_end
+    x_start -= x_start == shape[0]
+    y_start -= y_start == shape[1]
+
+    rows = np.vstack(slice_bounds(y_start, y_end, shape[0])).T
+    cols = np.vstack(slice_bounds(x_start, x_end, shape[1])).T
+    return rows, cols
+
 def get_mask(mask_in, roi, size, id_now):
-    roi = roi[1:]
-    # print(roi)
-    x_start = int(math.floor(roi[0]))
-    x_end = int(math.ceil(roi[2]))
-    y_start = int(math.floor(roi[1]))
-    y_end = int(math.ceil(roi[3]))
-
-    width = mask_in.shape[0]
-    height = mask_in.shape[1]
-    x_start = min(max(0,x_start), height)
-    x_end = min(max(0,x_end), height)
-    y_start = min(max(0,y_start), width)
-    y_end = min(max(0,y_end), width)
-
-    if x_start == x_end:
-        x_end += 1
-    if y_start == y_end:
-        y_end += 1
-    if x_start == mask_in.shape[0]:
-        x_start -= 1
-    if y_start == mask_in.shape[1]:
-        y_start -= 1
-
-    patch_cropped = mask_in[y_start:y_end, x_start:x_end].copy()
+    rows, cols = _roi_windows(mask_in.shape, np.array([roi]))
+    patch_cropped = mask_in[rows[0, 0]:rows[0, 1], cols[0, 0]:cols[0, 1]].copy()
 
     # print(patch_cropped.shape)
     patch_cropped_temp = np.array(patch_cropped == id_now, dtype=np.int32)
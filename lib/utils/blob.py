@@ -11,72 +11,160 @@ import numpy as np
 import cv2
 
 
-def im_list_to_blob(ims):
-    """Convert a list of images into a network input.
+class BlobBuffer(object):
+    """Reusable memory for the blobs built by the *_list_to_blob helpers.
+
+    Each named blob keeps its allocation from one batch to the next and is
+    only reallocated when a batch does not fit. The array returned for a
+    name is overwritten by the next batch written under that name, so it
+    must be consumed (e.g. copied into the net) before then; blobs handed
+    to another process or queued for later must not come from a buffer.
+    """
 
-    Assumes images are already prepared (means subtracted, BGR order, ...).
+    def __init__(self):
+        self._storage = {}
+
+    def get(self, name, shape, dtype):
+        """Return a contiguous array of the given shape and dtype, backed by
+        the storage of name. Its content is undefined.
+        """
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        storage = self._storage.get(name)
+        if storage is None or storage.dtype != dtype or storage.size < size:
+            storage = np.empty(size, dtype=dtype)
+            self._storage[name] = storage
+        return storage[:size].reshape(shape)
+
+
+def _list_to_blob(ims, dtype, buf=None, name=None, pixel_means=None):
+    """Write a list of H x W x C images into a contiguous N x C x H x W
+    blob, zero-padded to the largest image at the bottom and right.
+
+    Arguments:
+        ims (list): the images, all with the same number of channels
+        dtype: dtype of the blob
+        buf (BlobBuffer): if given, the blob reuses the storage of name in
+            buf and only its padding is zeroed
+        name (str): name of the blob in buf
+        pixel_means (ndarray): if given, subtracted from each image as it
+            is written
     """
     max_shape = np.array([im.shape for im in ims]).max(axis=0)
     num_images = len(ims)
-    blob = np.zeros((num_images, max_shape[0], max_shape[1], 3),
-                    dtype=np.float32)
+    shape = (num_images, max_shape[2], max_shape[0], max_shape[1])
+    if buf is None:
+        blob = np.zeros(shape, dtype=dtype)
+    else:
+        blob = buf.get(name, shape, dtype)
+    if pixel_means is not None:
+        pixel_means = np.asarray(pixel_means, dtype=dtype).reshape((-1, 1, 1))
     for i in xrange(num_images):
         im = ims[i]
-        blob[i, 0:im.shape[0], 0:im.shape[1], :] = im
-    # Move channels (axis 3) to axis 1
-    # Axis order will become: (batch elem, channel, height, width)
-    channel_swap = (0, 3, 1, 2)
-    blob = blob.transpose(channel_swap)
+        height, width = im.shape[:2]
+        # Move channels (axis 2) to axis 0 while copying
+        # Axis order will become: (channel, height, width)
+        if pixel_means is None:
+            blob[i, :, 0:height, 0:width] = im.transpose((2, 0, 1))
+        else:
+            np.subtract(im.transpose((2, 0, 1)), pixel_means,
+                        out=blob[i, :, 0:height, 0:width])
+        if buf is not None:
+            blob[i, :, height:, :] = 0
+            blob[i, :, 0:height, width:] = 0
     return blob
 
 
-def seg_list_to_blob(segs):
+def im_list_to_blob(ims, pixel_means=None, buf=None):
+    """Convert a list of images into a network input.
+
+    Assumes images are already prepared (means subtracted, BGR order, ...),
+    unless pixel_means is given: the images (e.g. still uint8) then have
+    pixel_means subtracted as they are written into the blob, without a
+    float copy of each image.
+
+    Returns a contiguous float32 blob, held by buf (see BlobBuffer) if
+    given.
+    """
+    return _list_to_blob(ims, np.float32, buf, 'data', pixel_means)
+
+
+def im_pyramid(im, im_scales):
+    """Resize an image to each scale of im_scales, keeping its dtype.
+
+    The levels are built from the largest scale to the smallest. A level
+    that downsamples im is resized from the nearest larger downsampled
+    level built so far (instead of from im), which is cheaper for the small
+    levels. The size of the level of scale s is round(s * size of im).
+
+    Returns:
+        levels (list): the resized images, in the order of im_scales
+    """
+    height, width = im.shape[:2]
+    levels = [None] * len(im_scales)
+    src, src_scale = im, 1.
+    for i in np.argsort(-np.asarray(im_scales, dtype=np.float64),
+                        kind='mergesort'):
+        im_scale = im_scales[i]
+        size = (int(np.round(width * im_scale)),
+                int(np.round(height * im_scale)))
+        if im_scale == src_scale:
+            levels[i] = src
+        elif im_scale < src_scale and src_scale < 1:
+            levels[i] = cv2.resize(src, size, interpolation=cv2.INTER_LINEAR)
+        else:
+            # upsampling and the first downsampled level start from im, on
+            # the sampling grid of prep_im_for_blob
+            levels[i] = cv2.resize(im, None, None, fx=im_scale, fy=im_scale,
+                                   interpolation=cv2.INTER_LINEAR)
+        if im_scale <= 1:
+            src, src_scale = levels[i], im_scale
+    return levels
+
+
+def seg_list_to_blob(segs, buf=None):
     """Convert a list of images into a network input.
 
     Assumes images are already prepared (means subtracted, BGR order, ...).
+    Returns a contiguous uint8 blob, held by buf (see BlobBuffer) if given.
     """
-    max_shape = np.array([seg.shape for seg in segs]).max(axis=0)
-    num_images = len(segs)
-    blob = np.zeros((num_images, max_shape[0], max_shape[1], 1),
-                    dtype=np.uint8)
-    for i in xrange(num_images):
-        seg = segs[i]
-        blob[i, 0:seg.shape[0], 0:seg.shape[1], :] = seg
-    # Move channels (axis 3) to axis 1
-    # Axis order will become: (batch elem, channel, height, width)
-    channel_swap = (0, 3, 1, 2)
-    blob = blob.transpose(channel_swap)
-    return blob
+    return _list_to_blob(segs, np.uint8, buf, 'seg')
 
-def ins_list_to_blob(inss):
+def ins_list_to_blob(inss, buf=None):
     """Convert a list of images into a network input.
 
     Assumes images are already prepared (means subtracted, BGR order, ...).
+    Returns a contiguous uint8 blob, held by buf (see BlobBuffer) if given.
     """
-    max_shape = np.array([ins.shape for ins in inss]).max(axis=0)
-    num_images = len(inss)
-    blob = np.zeros((num_images, max_shape[0], max_shape[1], 1),
-                    dtype=np.uint8)
-    for i in xrange(num_images):
-        ins = inss[i]
-        blob[i, 0:ins.shape[0], 0:ins.shape[1], :] = ins
-    # Move channels (axis 3) to axis 1
-    # Axis order will become: (batch elem, channel, height, width)
-    channel_swap = (0, 3, 1, 2)
-    blob = blob.transpose(channel_swap)
-    return blob
+    return _list_to_blob(inss, np.uint8, buf, 'ins')
 
-def prep_im_for_blob(im, pixel_means, target_size, max_size):
-    """Mean subtract and scale an image for use in a blob."""
-    im = im.astype(np.float32, copy=False)
-    im -= pixel_means
-    im_shape = im.shape
+def get_im_scale(im_shape, target_size, max_size):
+    """Return the scale that resizes the shortest side of an image of shape
+    im_shape to target_size, unless its longest side then exceeds max_size.
+    """
     im_size_min = np.min(im_shape[0:2])
     im_size_max = np.max(im_shape[0:2])
     im_scale = float(target_size) / float(im_size_min)
     # Prevent the biggest axis from being more than MAX_SIZE
     if np.round(im_scale * im_size_max) > max_size:
         im_scale = float(max_size) / float(im_size_max)
+    return im_scale
+
+
+def prep_im_for_blob(im, pixel_means, target_size, max_size, fused=False):
+    """Mean subtract and scale an image for use in a blob.
+
+    With fused=True the image is resized in its own dtype (e.g. the uint8 of
+    cv2.imread) and returned without the means subtracted; pass pixel_means
+    to im_list_to_blob, which then converts, subtracts and transposes it in
+    one pass while writing the blob. The resize moves a quarter of the bytes
+    and the subtraction runs on the resized image. Pixels differ from the
+    float path by the rounding of the resize (less than 1).
+    """
+    if not fused:
+        im = im.astype(np.float32, copy=False)
+        im -= pixel_means
+    im_scale = get_im_scale(im.shape, target_size, max_size)
     im = cv2.resize(im, None, None, fx=im_scale, fy=im_scale,
                     interpolation=cv2.INTER_LINEAR)
 
@@ -0,0 +1,132 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Byte-budgeted LRU cache of decoded images, in shared memory.
+
+The pixels and the index of the cache live in shared memory allocated when
+the cache is created, so processes forked afterwards (e.g. the prefetch
+workers of the training data layer) all read and fill the same cache: an
+image decoded by one worker is a hit for every other. The set of keys (image
+paths) must be known up front. When the pixels of a new image do not fit,
+the least recently used images are evicted until they do.
+
+A hit copies the image out of the cache under the lock, so the returned
+array stays valid whatever other processes evict afterwards. Copying a
+decoded uint8 image is much cheaper than reading and decoding it.
+"""
+
+import ctypes
+import multiprocessing
+import numpy as np
+
+# alignment in bytes of the images in the arena
+_ALIGN = 64
+_MAX_DIMS = 3
+
+
+class ImageCache(object):
+    """Cache of decoded images keyed by path.
+
+    Arguments:
+        keys (list): every key that may be cached; other keys bypass the
+            cache
+        budget (int): bytes of pixels the cache may hold
+    """
+
+    def __init__(self, keys, budget):
+        keys = sorted(set(keys))
+        self._index = dict((key, i) for i, key in enumerate(keys))
+        num_keys = len(keys)
+        self._arena = _shared_array(np.uint8, max(budget, 1))
+        # per key: offset in the arena (-1 if not cached), size in bytes,
+        # shape, dtype (index in _DTYPES) and tick of its last use
+        self._offset = _shared_array(np.int64, num_keys)
+        self._offset[:] = -1
+        self._nbytes = _shared_array(np.int64, num_keys)
+        self._shape = _shared_array(np.int64, num_keys * _MAX_DIMS).reshape(
+            (num_keys, _MAX_DIMS))
+        self._ndim = _shared_array(np.int64, num_keys)
+        self._dtype = _shared_array(np.int64, num_keys)
+        self._last_used = _shared_array(np.int64, num_keys)
+        # tick, hits, misses
+        self._counters = _shared_array(np.int64, 3)
+        self._lock = multiprocessing.Lock()
+
+    def get(self, key, load_fn):
+        """Return the image of key, calling load_fn() to load it on a miss.
+
+        The returned array belongs to the caller.
+        """
+        i = self._index.get(key)
+        if i is None:
+            return load_fn()
+        with self._lock:
+            self._counters[0] += 1
+            if self._offset[i] >= 0:
+                self._counters[1] += 1
+                self._last_used[i] = self._counters[0]
+                return self._view(i).copy()
+            self._counters[2] += 1
+
+        im = np.ascontiguousarray(load_fn())
+        if im.ndim > _MAX_DIMS or im.nbytes > len(self._arena):
+            return im
+        with self._lock:
+            # another process may have cached it meanwhile
+            if self._offset[i] < 0:
+                offset = self._alloc(im.nbytes)
+                self._offset[i] = offset
+                self._nbytes[i] = im.nbytes
+                self._ndim[i] = im.ndim
+                self._shape[i, :im.ndim] = im.shape
+                self._dtype[i] = _DTYPES.index(im.dtype)
+                self._view(i)[...] = im
+            self._last_used[i] = self._counters[0]
+        return im
+
+    def stats(self):
+        """Return (hits, misses, number of images, bytes) of the cache."""
+        with self._lock:
+            cached = self._offset >= 0
+            return (int(self._counters[1]), int(self._counters[2]),
+                    int(cached.sum()), int(self._nbytes[cached].sum()))
+
+    def _view(self, i):
+        offset = self._offset[i]
+        dtype = _DTYPES[self._dtype[i]]
+        return self._arena[offset:offset + self._nbytes[i]].view(dtype) \
+            .reshape(self._shape[i, :self._ndim[i]])
+
+    def _alloc(self, nbytes):
+        """Return the offset of a free block of nbytes, evicting the least
+        recently used images until there is one. The lock must be held.
+        """
+        while True:
+            cached = np.where(self._offset >= 0)[0]
+            order = np.argsort(self._offset[cached])
+            starts = self._offset[cached][order]
+            ends = starts + self._nbytes[cached][order]
+            # first gap (before each image, and after the last) that fits
+            gap_starts = np.hstack(([0], _align(ends)))
+            gap_ends = np.hstack((starts, [len(self._arena)]))
+            fits = np.where(gap_ends - gap_starts >= nbytes)[0]
+            if len(fits) > 0:
+                return int(gap_starts[fits[0]])
+            lru = cached[np.argmin(self._last_used[cached])]
+            self._offset[lru] = -1
+
+
+_DTYPES = [np.dtype(t) for t in (np.uint8, np.uint16, np.int32, np.float32)]
+
+
+def _align(offsets):
+    return -(-offsets // _ALIGN) * _ALIGN
+
+
+def _shared_array(dtype, size):
+    """Return a numpy array of size elements in shared memory."""
+    dtype = np.dtype(dtype)
+    raw = multiprocessing.RawArray(ctypes.c_uint8, int(size) * dtype.itemsize)
+    return np.frombuffer(raw, dtype=dtype)
@@ -0,0 +1,68 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Image decoding at the resolution the net needs.
+
+libjpeg can decode a JPEG at 1/2, 1/4 or 1/8 of its size for a fraction of
+the cost of a full decode (cv2.IMREAD_REDUCED_COLOR_*). When an image is
+going to be downscaled anyway, read_image picks the largest such factor that
+keeps the decoded image at or above the target resolution. The caller
+computes the target scale from the header size (image_size, or the width
+and height of a roidb entry) and multiplies the scales it computes on the
+decoded image by the returned decode scale, which maps full-resolution
+coordinates exactly onto the decoded pixels.
+"""
+
+import os
+import cv2
+import PIL.Image
+
+# decode factor -> cv2.imread flag, largest factor first
+_REDUCED_FLAGS = [(factor, getattr(cv2, 'IMREAD_REDUCED_COLOR_{:d}'
+                                   .format(factor), None))
+                  for factor in (8, 4, 2)]
+_JPEG_EXTENSIONS = ('.jpg', '.jpeg', '.jpe')
+
+
+def image_size(path):
+    """Return the (height, width) of the image at path, read from its header
+    without decoding it.
+    """
+    width, height = PIL.Image.open(path).size
+    return height, width
+
+
+def get_decode_scale(path, max_scale=1.):
+    """Return the scale, relative to the full-resolution image, at which
+    read_image(path, max_scale) decodes the image at path.
+    """
+    return _decode_flag(path, max_scale)[1]
+
+
+def read_image(path, max_scale=1.):
+    """Decode the BGR image at path, at reduced resolution when it will be
+    resized by at most max_scale.
+
+    Arguments:
+        path (str): image file
+        max_scale (float): largest scale, relative to the full-resolution
+            image, the image will be resized to
+
+    Returns:
+        im (ndarray): the decoded image
+        decode_scale (float): scale of im relative to the full-resolution
+            image (1, 1/2, 1/4 or 1/8)
+    """
+    flag, decode_scale = _decode_flag(path, max_scale)
+    return cv2.imread(path, flag), decode_scale
+
+
+def _decode_flag(path, max_scale):
+    """Return the cv2.imread flag and the decode scale of read_image."""
+    if os.path.splitext(path)[1].lower() in _JPEG_EXTENSIONS:
+        for factor, flag in _REDUCED_FLAGS:
+            if flag is not None and factor * max_scale <= 1:
+                return flag, 1. / factor
+    return cv2.IMREAD_COLOR, 1.
@@ -0,0 +1,209 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Index of the instances of the instance label maps (*_label_id.png).
+
+The mask targets need, for every image, which instance ids its label map
+holds, where and how large they are, and the pixels of each. Rather than
+rescanning the full-resolution maps at every iteration,
+tools/build_instance_index.py scans them once and writes, for each map, its
+instance ids, their tight boxes and pixel areas and a run-length encoding of
+each instance within its box, into one binary file (an uncompressed .npz of
+flat arrays). The data layer loads it through cfg.TRAIN.INSTANCE_INDEX.
+
+The runs of an instance cover its box row by row and alternate between
+background and instance pixels, starting with background (possibly an empty
+run).
+"""
+
+import os
+import numpy as np
+
+_VERSION = 1
+
+
+def label_instances(label_map):
+    """Find the instances of a label map in one pass.
+
+    Arguments:
+        label_map (ndarray): H x W map of instance ids, 0 for background
+
+    Returns:
+        ids (ndarray): the instance ids, ascending
+        boxes (ndarray): len(ids) x 4 tight boxes (x1, y1, x2, y2),
+            inclusive
+        areas (ndarray): number of pixels of each instance
+    """
+    width = label_map.shape[1]
+    flat = label_map.ravel()
+    pixels = np.flatnonzero(flat)
+    ids, inverse, areas = np.unique(flat[pixels], return_inverse=True,
+                                    return_counts=True)
+    # group the pixels by instance, in raster order within an instance
+    order = np.argsort(inverse, kind='mergesort')
+    ys, xs = np.divmod(pixels[order], width)
+    starts = np.cumsum(areas) - areas
+    boxes = np.zeros((len(ids), 4), dtype=np.int32)
+    if len(ids) > 0:
+        boxes[:, 0] = np.minimum.reduceat(xs, starts)
+        boxes[:, 1] = ys[starts]
+        boxes[:, 2] = np.maximum.reduceat(xs, starts)
+        boxes[:, 3] = ys[starts + areas - 1]
+    return ids, boxes, areas
+
+
+def encode_rle(mask):
+    """Return the runs (uint32) of the boolean mask, row by row, starting with
+    a (possibly empty) run of False.
+    """
+    flat = mask.ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.hstack(([0], changes, [flat.size]))
+    counts = np.diff(bounds)
+    if flat.size > 0 and flat[0]:
+        counts = np.hstack(([0], counts))
+    return counts.astype(np.uint32)
+
+
+def decode_rle(counts, shape):
+    """Return the boolean mask of the given shape encoded by encode_rle."""
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape(shape)
+
+
+class ImageInstances(object):
+    """The instances of one label map in an InstanceIndex.
+
+    Attributes:
+        shape (tuple): (height, width) of the label map
+        ids (ndarray): instance ids, ascending
+        boxes (ndarray): tight boxes (x1, y1, x2, y2), inclusive
+        areas (ndarray): number of pixels of each instance
+    """
+
+    def __init__(self, shape, ids, boxes, areas, counts):
+        self.shape = shape
+        self.ids = ids
+        self.boxes = boxes
+        self.areas = areas
+        self._counts = counts
+        self._box_list = boxes.tolist()
+        self._masks = {}
+
+    def mask(self, k):
+        """Return the boolean mask of instance k within its box."""
+        if k not in self._masks:
+            x1, y1, x2, y2 = self._box_list[k]
+            self._masks[k] = decode_rle(self._counts[k],
+                                        (y2 - y1 + 1, x2 - x1 + 1))
+        return self._masks[k]
+
+    def label_map(self):
+        """Return the label map, painted from the instances."""
+        label_map = np.zeros(self.shape, dtype=self.ids.dtype)
+        for k, (x1, y1, x2, y2) in enumerate(self._box_list):
+            label_map[y1:y2 + 1, x1:x2 + 1][self.mask(k)] = self.ids[k]
+        return label_map
+
+
+def build_index(paths, out_path, read_fn):
+    """Index the label maps at paths into out_path.
+
+    Arguments:
+        paths (list): label map files
+        out_path (str): index file to write
+        read_fn (callable): read_fn(path) returns the label map at path
+    """
+    shapes = np.zeros((len(paths), 2), dtype=np.int32)
+    mtimes = np.zeros(len(paths), dtype=np.float64)
+    inst_starts = [0]
+    rle_starts = [0]
+    all_ids, all_boxes, all_areas, all_counts = [], [], [], []
+    for i, path in enumerate(paths):
+        label_map = read_fn(path)
+        shapes[i] = label_map.shape[:2]
+        mtimes[i] = os.stat(path).st_mtime
+        ids, boxes, areas = label_instances(label_map)
+        for instance_id, (x1, y1, x2, y2) in zip(ids, boxes):
+            counts = encode_rle(label_map[y1:y2 + 1, x1:x2 + 1] ==
+                                instance_id)
+            all_counts.append(counts)
+            rle_starts.append(rle_starts[-1] + len(counts))
+        all_ids.append(ids.astype(np.int32))
+        all_boxes.append(boxes)
+        all_areas.append(areas.astype(np.int64))
+        inst_starts.append(inst_starts[-1] + len(ids))
+    # through a file object, so that savez keeps the name as given
+    with open(out_path, 'wb') as f:
+        np.savez(f, version=_VERSION,
+                 paths=np.array([os.path.abspath(p) for p in paths]),
+                 shapes=shapes, mtimes=mtimes,
+                 inst_starts=np.array(inst_starts, dtype=np.int64),
+                 ids=np.hstack(all_ids + [np.zeros(0, np.int32)]),
+                 boxes=np.vstack(all_boxes + [np.zeros((0, 4), np.int32)]),
+                 areas=np.hstack(all_areas + [np.zeros(0, np.int64)]),
+                 rle_starts=np.array(rle_starts, dtype=np.int64),
+                 counts=np.hstack(all_counts + [np.zeros(0, np.uint32)]))
+
+
+class InstanceIndex(object):
+    """Loader of an index written by build_index.
+
+    Label maps changed since they were indexed are left out (get returns
+    None for them), so that they are read from their files instead.
+
+    Arguments:
+        path (str): index file
+    """
+
+    def __init__(self, path):
+        data = np.load(path)
+        try:
+            assert int(data['version']) == _VERSION, \
+                'Instance index {:s} has an unknown version'.format(path)
+            self._shapes = data['shapes']
+            self._inst_starts = data['inst_starts']
+            self._ids = data['ids']
+            self._boxes = data['boxes']
+            self._areas = data['areas']
+            self._rle_starts = data['rle_starts']
+            self._counts = data['counts']
+            self._rows = {}
+            num_stale = 0
+            for row, (map_path, mtime) in enumerate(zip(data['paths'],
+                                                        data['mtimes'])):
+                if not os.path.exists(map_path) or \
+                        os.stat(map_path).st_mtime != mtime:
+                    num_stale += 1
+                    continue
+                self._rows[str(map_path)] = row
+        finally:
+            data.close()
+        print 'Loaded instance index {:s} ({:d} maps, {:d} out of date)' \
+            .format(path, len(self._rows), num_stale)
+
+    def get(self, path):
+        """Return the ImageInstances of the label map at path, or None if it
+        is not (or no longer) indexed.
+        """
+        row = self._rows.get(os.path.abspath(path))
+        if row is None:
+            return None
+        start, end = self._inst_starts[row], self._inst_starts[row + 1]
+        counts = [self._counts[self._rle_starts[k]:self._rle_starts[k + 1]]
+                  for k in xrange(start, end)]
+        return ImageInstances(tuple(self._shapes[row]), self._ids[start:end],
+                              self._boxes[start:end], self._areas[start:end],
+                              counts)
+
+
+_loaded = {}
+
+
+def load_instance_index(path):
+    """Return the InstanceIndex at path, loading it on the first call."""
+    if path not in _loaded:
+        _loaded[path] = InstanceIndex(path)
+    return _loaded[path]
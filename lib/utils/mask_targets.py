@@ -0,0 +1,105 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Mask targets of all the foreground RoIs of an image in one gather.
+
+A mask target is the crop of a RoI window from the instance label map,
+compared against an instance id and resized to size x size with
+cv2.INTER_NEAREST. Nearest-neighbour resizing only picks pixels, so the
+targets of all the RoIs are one fancy-indexing gather from the label map at
+the source pixels cv2.resize would pick, computed with the same floating
+point arithmetic as cv2.resize. The targets are bit-identical to cropping
+and resizing each RoI. crop_resize_instance_targets gathers the same targets
+from the masks of the instances of an indexed map (see
+utils.instance_index), without the map itself.
+"""
+
+import numpy as np
+
+
+def slice_bounds(start, stop, length):
+    """Return the (start, stop) that python slicing resolves start:stop to
+    on an axis of the given length, for arrays of starts and stops.
+    """
+    start = np.where(start < 0, np.maximum(start + length, 0),
+                     np.minimum(start, length))
+    stop = np.where(stop < 0, np.maximum(stop + length, 0),
+                    np.minimum(stop, length))
+    return start, np.maximum(stop, start)
+
+
+def nearest_indices(src_lengths, size):
+    """Return the len(src_lengths) x size source indices that cv2.resize,
+    with INTER_NEAREST, picks to resize each src_length pixels to size.
+    """
+    # as cv::resizeNN: floor(i * (1. / (size / src_length)))
+    inv_scale = float(size) / src_lengths.astype(np.float64)
+    inds = np.floor(np.arange(size)[np.newaxis, :] *
+                    (1. / inv_scale)[:, np.newaxis]).astype(np.int64)
+    return np.minimum(inds, src_lengths[:, np.newaxis] - 1)
+
+
+def crop_resize_targets(label_map, rows, cols, ids, size):
+    """Return the binary size x size mask targets of RoI windows.
+
+    Target i is cv2.resize(label_map[rows[i, 0]:rows[i, 1],
+    cols[i, 0]:cols[i, 1]] == ids[i], (size, size), cv2.INTER_NEAREST).
+
+    Arguments:
+        label_map (ndarray): H x W instance label map
+        rows, cols (ndarray): N x 2 non-empty [start, stop) windows, within
+            the map
+        ids (ndarray): N instance ids
+        size (int): side of the targets
+
+    Returns:
+        targets (ndarray): N x size x size int32 targets
+    """
+    src_rows = rows[:, :1] + nearest_indices(rows[:, 1] - rows[:, 0], size)
+    src_cols = cols[:, :1] + nearest_indices(cols[:, 1] - cols[:, 0], size)
+    picked = label_map[src_rows[:, :, np.newaxis], src_cols[:, np.newaxis, :]]
+    return (picked == ids[:, np.newaxis, np.newaxis]).astype(np.int32)
+
+
+def crop_resize_instance_targets(masks, boxes, ks, rows, cols, size,
+                                 flip_width=None):
+    """crop_resize_targets for a label map given by the masks of its
+    instances rather than the map itself.
+
+    Target i is the crop_resize_targets target of instance ks[i]: it only
+    reads masks[ks[i]] at the source pixels of window i, so the full label
+    map is never painted.
+
+    Arguments:
+        masks (callable): masks(k) returns the boolean mask of instance k
+            within its box
+        boxes (ndarray): inclusive boxes (x1, y1, x2, y2) of the instances
+        ks (ndarray): N instances, -1 for none (an all zero target)
+        rows, cols (ndarray): N x 2 non-empty [start, stop) windows, within
+            the map
+        size (int): side of the targets
+        flip_width (int): if given, the windows are in the horizontally
+            flipped map, of this width
+
+    Returns:
+        targets (ndarray): N x size x size int32 targets
+    """
+    src_rows = rows[:, :1] + nearest_indices(rows[:, 1] - rows[:, 0], size)
+    src_cols = cols[:, :1] + nearest_indices(cols[:, 1] - cols[:, 0], size)
+    if flip_width is not None:
+        src_cols = flip_width - 1 - src_cols
+    targets = np.zeros((len(ks), size, size), dtype=np.int32)
+    # one gather per instance, for all its windows
+    for k in np.unique(ks[ks >= 0]):
+        inds = np.where(ks == k)[0]
+        mask = masks(k)
+        r = src_rows[inds] - boxes[k, 1]
+        c = src_cols[inds] - boxes[k, 0]
+        inside = (((r >= 0) & (r < mask.shape[0]))[:, :, np.newaxis] &
+                  ((c >= 0) & (c < mask.shape[1]))[:, np.newaxis, :])
+        picked = mask[np.clip(r, 0, mask.shape[0] - 1)[:, :, np.newaxis],
+                      np.clip(c, 0, mask.shape[1] - 1)[:, np.newaxis, :]]
+        targets[inds] = picked & inside
+    return targets
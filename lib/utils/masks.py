@@ -0,0 +1,138 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Paste fixed-size mask predictions back into image space.
+
+All (box, mask) pairs of an image are handled in one call. The per-box
+bookkeeping (integer extents, empty boxes, paste order, thresholding of the
+low resolution masks) is done on whole arrays; only the resampling of each
+mask to its box is left to cv2, which is much faster per pixel than any
+numpy gather.
+"""
+
+import numpy as np
+import cv2
+
+
+def _box_extents(boxes):
+    """Integer box corners (truncated, as box.astype(int)) and sizes.
+
+    A box covers rows y1..y2-1 and columns x1..x2-1.
+    """
+    boxes = boxes[:, :4].astype(np.int64)
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    w = boxes[:, 2] - x1
+    h = boxes[:, 3] - y1
+    return x1, y1, w, h
+
+
+def _resized_masks(boxes, masks, im_shape, thresh, bilinear, order):
+    """Yield (k, y1, x1, mask) with the binary mask of box k resampled to the
+    part of the box that lies inside the image, following order and skipping
+    boxes with zero area.
+    """
+    height, width = im_shape[:2]
+    masks = masks.reshape((masks.shape[0],) + masks.shape[-2:])
+    if bilinear:
+        masks = masks.astype(np.float32, copy=False)
+    else:
+        # thresholding commutes with nearest-neighbor sampling, so do it once
+        # for all masks on the low resolution grid
+        masks = (masks > thresh).astype(np.uint8)
+
+    x1, y1, w, h = _box_extents(boxes)
+    valid = (w > 0) & (h > 0)
+    # visible part of each box
+    cx1 = np.maximum(x1, 0)
+    cy1 = np.maximum(y1, 0)
+    cx2 = np.minimum(x1 + w, width)
+    cy2 = np.minimum(y1 + h, height)
+    valid &= (cx2 > cx1) & (cy2 > cy1)
+
+    interpolation = cv2.INTER_LINEAR if bilinear else cv2.INTER_NEAREST
+    for k in order[valid[order]]:
+        m = cv2.resize(masks[k], (int(w[k]), int(h[k])),
+                       interpolation=interpolation)
+        m = m[cy1[k] - y1[k]:cy2[k] - y1[k], cx1[k] - x1[k]:cx2[k] - x1[k]]
+        if bilinear:
+            m = m > thresh
+        else:
+            m = m.view(np.bool_)
+        yield k, cy1[k], cx1[k], m
+
+
+def paste_masks(boxes, masks, im_shape, scores=None, thresh=0.5,
+                bilinear=False):
+    """Paste the masks of all detections of an image into a label map.
+
+    Arguments:
+        boxes (ndarray): N x 4 (or N x 5 with scores) boxes in image
+            coordinates
+        masks (ndarray): N x M x M (or N x 1 x M x M) mask probabilities or
+            binary masks, one per box
+        im_shape (tuple): shape of the image
+        scores (ndarray): detection scores; where instances overlap, the
+            highest scoring one keeps the pixel. Without scores, earlier
+            instances win.
+        thresh (float): a pixel is foreground if its mask value is > thresh
+        bilinear (bool): upsample the mask probabilities bilinearly and
+            threshold afterwards, instead of nearest-neighbor sampling
+
+    Returns:
+        label_map (ndarray): H x W int32 map, 0 for background and k + 1 for
+            the pixels of instance k (its row in boxes). Boxes with zero area
+            are skipped.
+    """
+    label_map = np.zeros(im_shape[:2], dtype=np.int32)
+    if len(boxes) == 0:
+        return label_map
+
+    if scores is None:
+        order = np.arange(len(boxes))
+    else:
+        order = np.argsort(-np.asarray(scores), kind='mergesort')
+    # paste from the lowest to the highest priority, later ones overwrite
+    for k, y, x, m in _resized_masks(boxes, masks, im_shape, thresh,
+                                     bilinear, order[::-1]):
+        region = label_map[y:y + m.shape[0], x:x + m.shape[1]]
+        np.copyto(region, k + 1, where=m)
+    return label_map
+
+
+def paste_masks_rle(boxes, masks, im_shape, thresh=0.5, bilinear=False):
+    """Encode the pasted mask of every detection of an image as a COCO RLE.
+
+    Instances are encoded independently, overlaps are not resolved. The
+    arguments are as in paste_masks.
+
+    Returns:
+        rles (list): one compressed RLE dict per box (empty for boxes with
+            zero area), as produced by pycocotools.mask
+    """
+    from pycocotools import mask as COCOmask
+    height, width = im_shape[:2]
+    num_pixels = height * width
+    if len(boxes) == 0:
+        return []
+
+    runs = [[num_pixels] for _ in xrange(len(boxes))]
+    for k, y, x, m in _resized_masks(boxes, masks, im_shape, thresh,
+                                     bilinear, np.arange(len(boxes))):
+        # RLEs run over the image in column-major order
+        cols, rows = np.nonzero(m.T)
+        if len(cols) == 0:
+            continue
+        pos = (cols + x) * height + rows + y
+        breaks = np.where(np.diff(pos) != 1)[0] + 1
+        # alternating background / foreground run lengths
+        edges = np.empty(2 * len(breaks) + 4, dtype=np.int64)
+        edges[0] = 0
+        edges[1:-1:2] = pos[np.r_[0, breaks]]
+        edges[2:-1:2] = pos[np.r_[breaks - 1, len(pos) - 1]] + 1
+        edges[-1] = num_pixels
+        runs[k] = np.diff(edges).tolist()
+    return COCOmask.frPyObjects(
+        [{'size': [height, width], 'counts': r} for r in runs],
+        height, width)
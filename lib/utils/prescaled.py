@@ -0,0 +1,78 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Training images pre-rendered at the training scales.
+
+With fixed TRAIN.SCALES, every minibatch resizes the same images to the same
+sizes. tools/prescale_images.py renders each image at each scale once, into
+a cache directory, and the data layer then only reads, flips and mean
+subtracts them. A pre-rendered image is the uint8 resize of the
+full-resolution image (as prep_im_for_blob with fused=True), stored with its
+im_scale as an uncompressed .npz. Flipped roidb entries flip the rendered
+image, which can differ by a sub-pixel shift from resizing the flipped image
+when the resized width is rounded.
+
+The file of an image is named after a hash of its absolute path, its mtime
+and size and the scale config, so that changing any of them makes the old
+file unused rather than wrong.
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+import cv2
+from utils.blob import prep_im_for_blob
+
+# bump when the way the images are rendered changes
+_VERSION = 1
+
+
+def prescaled_path(cache_dir, path, target_size, max_size):
+    """Return the file of the image at path rendered at target_size and
+    max_size (see utils.blob.get_im_scale) in cache_dir.
+    """
+    stat = os.stat(path)
+    key = '{:d}|{:s}|{!r}|{:d}|{:d}|{:d}'.format(
+        _VERSION, os.path.abspath(path), stat.st_mtime, stat.st_size,
+        int(target_size), int(max_size))
+    return os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + '.npz')
+
+
+def write_prescaled(cache_dir, path, target_size, max_size):
+    """Render the image at path at target_size and max_size into cache_dir.
+
+    Returns:
+        out_path (str): the written file
+    """
+    out_path = prescaled_path(cache_dir, path, target_size, max_size)
+    im, im_scale = prep_im_for_blob(cv2.imread(path), None, target_size,
+                                    max_size, fused=True)
+    # write then rename, so that readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, im=im, im_scale=np.float64(im_scale))
+    os.rename(tmp_path, out_path)
+    return out_path
+
+
+def read_prescaled(cache_dir, path, target_size, max_size):
+    """Read the image at path rendered at target_size and max_size from
+    cache_dir.
+
+    Returns:
+        im (ndarray): the resized uint8 BGR image, None if it is not in
+            cache_dir (or out of date)
+        im_scale (float): scale of im relative to the image at path
+    """
+    try:
+        data = np.load(prescaled_path(cache_dir, path, target_size,
+                                      max_size))
+    except IOError:
+        return None, None
+    try:
+        return data['im'], float(data['im_scale'])
+    finally:
+        data.close()
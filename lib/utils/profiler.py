@@ -0,0 +1,173 @@
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Named latency spans with percentile summaries.
+
+Code records the duration of a named stage with
+
+    with get_profiler().span('forward'):
+        ...
+
+or with get_profiler().add(name, seconds) for intervals measured elsewhere.
+The profiler is shared by all threads (e.g. the stages of a Pipeline).
+
+Count, total, mean and max are always exact. The percentiles come from at
+most max_samples durations per span, a uniform reservoir sample of every
+span recorded so far, so long-lived users (the training data layer, a
+server) keep bounded memory. The profiler of the test code keeps every
+sample, as a test run is finite, and reports exact p50 / p95 / p99 values.
+"""
+
+import time
+import random
+import json
+import csv
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+# Columns of the summary and of the dumps
+_FIELDS = ('count', 'total', 'mean', 'p50', 'p95', 'p99', 'max')
+
+
+class _Span(object):
+    """Durations of one span: exact aggregates and a sample for the
+    percentiles.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = -float('inf')
+        self.samples = []
+
+
+class Profiler(object):
+    """Collect the durations of named spans.
+
+    Arguments:
+        report_interval (float): min number of seconds between two console
+            summaries printed by maybe_report (0 prints on every call, a
+            negative value never prints)
+        max_samples (int): max number of durations kept per span for the
+            percentiles, or None to keep them all (exact percentiles)
+    """
+
+    def __init__(self, report_interval=10., max_samples=10000):
+        self.report_interval = report_interval
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        # own generator: the reservoir must not draw from the numpy one the
+        # training sampler uses
+        self._rng = random.Random(0)
+        self.reset()
+
+    def reset(self):
+        """Drop every sample and restart the wall clock."""
+        with self._lock:
+            # span name -> _Span, in order of first use
+            self._spans = {}
+            self._names = []
+            self._start_time = time.time()
+            self._last_report = self._start_time
+
+    def add(self, name, diff):
+        """Record a span of diff seconds."""
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                span = self._spans[name] = _Span()
+                self._names.append(name)
+            span.count += 1
+            span.total += diff
+            span.max = max(span.max, diff)
+            if self.max_samples is None or \
+                    len(span.samples) < self.max_samples:
+                span.samples.append(diff)
+            else:
+                # reservoir sampling: every duration is kept with
+                # probability max_samples / count
+                k = self._rng.randint(0, span.count - 1)
+                if k < self.max_samples:
+                    span.samples[k] = diff
+
+    @contextmanager
+    def span(self, name):
+        """Context manager recording the time spent in its block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def stats(self):
+        """Return a list of (name, {field: value}) in order of first use.
+
+        Times are in seconds; count is the number of recorded spans.
+        """
+        with self._lock:
+            spans = [(name, self._spans[name].count,
+                      self._spans[name].total, self._spans[name].max,
+                      np.array(self._spans[name].samples))
+                     for name in self._names]
+        stats = []
+        for name, count, total, max_diff, samples in spans:
+            p50, p95, p99 = np.percentile(samples, (50, 95, 99))
+            stats.append((name, {'count': count,
+                                 'total': total,
+                                 'mean': total / count,
+                                 'p50': p50, 'p95': p95, 'p99': p99,
+                                 'max': max_diff}))
+        return stats
+
+    def summary(self):
+        """Return a table of the span statistics, one line per span."""
+        lines = ['{:<14s} {:>7s} {:>9s} {:>8s} {:>8s} {:>8s} {:>8s}'.format(
+            'span', 'count', 'total(s)', 'mean', 'p50', 'p95', 'p99')]
+        for name, s in self.stats():
+            lines.append(
+                '{:<14s} {:>7d} {:>9.2f} {:>8.4f} {:>8.4f} {:>8.4f} {:>8.4f}'
+                .format(name, s['count'], s['total'], s['mean'], s['p50'],
+                        s['p95'], s['p99']))
+        return '\n'.join(lines)
+
+    def maybe_report(self, header=''):
+        """Print header and the summary if report_interval seconds passed
+        since the last report.
+        """
+        if self.report_interval < 0:
+            return
+        now = time.time()
+        with self._lock:
+            if now - self._last_report < self.report_interval:
+                return
+            self._last_report = now
+        print '{:s} ({:.1f}s)\n{:s}'.format(header, now - self._start_time,
+                                            self.summary())
+
+    def dump(self, filename):
+        """Write the span statistics to filename, as CSV if it ends with
+        .csv and as JSON otherwise.
+        """
+        stats = self.stats()
+        if filename.endswith('.csv'):
+            with open(filename, 'wb') as f:
+                writer = csv.writer(f)
+                writer.writerow(('span',) + _FIELDS)
+                for name, s in stats:
+                    writer.writerow((name,) + tuple(s[k] for k in _FIELDS))
+        else:
+            with open(filename, 'w') as f:
+                json.dump({'wall_time': time.time() - self._start_time,
+                           'spans': [dict(s, span=name)
+                                     for name, s in stats]},
+                          f, indent=2)
+
+
+_profiler = Profiler(max_samples=None)
+
+def get_profiler():
+    """Return the profiler shared by the test code."""
+    return _profiler
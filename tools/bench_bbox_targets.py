@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Benchmark the expansion of the bbox regression targets.
+
+For RoI batches of 128, 256 and 512 and 2, 21 and 81 classes, times the
+per-RoI loop the data layers used to run against expand_bbox_targets (one
+scatter into reused buffers), and the float64 against the float32 target
+computation of the proposal target layer. Exits with status 1 if the
+expanded targets differ.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from fast_rcnn.bbox_transform import bbox_transform, expand_bbox_targets
+from utils.blob import BlobBuffer
+import numpy as np
+import argparse
+import time
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the expansion of the bbox targets')
+    parser.add_argument('--iters', dest='iters',
+                        help='timed calls per configuration',
+                        default=200, type=int)
+    parser.add_argument('--agnostic', dest='agnostic',
+                        help='class-agnostic regression',
+                        action='store_true')
+
+    args = parser.parse_args()
+    return args
+
+def loop_expand(bbox_target_data, num_classes, agnostic):
+    """The per-RoI loop of the data layers, as a reference."""
+    clss = bbox_target_data[:, 0]
+    bbox_targets = np.zeros((clss.size, 4 * num_classes), dtype=np.float32)
+    bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
+    inds = np.where(clss > 0)[0]
+    for ind in inds:
+        cls = clss[ind]
+        start = 4 if agnostic else int(4 * cls)
+        end = start + 4
+        bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
+        bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
+    return bbox_targets, bbox_inside_weights
+
+def random_boxes(rng, num):
+    xy = rng.uniform(0, 800, (num, 2))
+    wh = rng.uniform(8, 300, (num, 2))
+    return np.hstack((xy, xy + wh)).astype(np.float32)
+
+def compute_targets(ex_rois, gt_rois, labels, dtype):
+    targets = np.empty((ex_rois.shape[0], 5), dtype=dtype)
+    targets[:, 0] = labels
+    targets[:, 1:] = bbox_transform(ex_rois.astype(dtype),
+                                    gt_rois.astype(dtype))
+    targets[:, 1:] -= np.array(cfg.TRAIN.BBOX_NORMALIZE_MEANS, dtype=dtype)
+    targets[:, 1:] /= np.array(cfg.TRAIN.BBOX_NORMALIZE_STDS, dtype=dtype)
+    return targets.astype(np.float32, copy=False)
+
+def time_fn(fn, iters):
+    fn()
+    start = time.time()
+    for _ in xrange(iters):
+        fn()
+    return 1000 * (time.time() - start) / iters
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = np.random.RandomState(cfg.RNG_SEED)
+    buf = BlobBuffer()
+    failed = False
+
+    print '{:>5s} {:>4s} {:>10s} {:>10s} {:>8s} {:>12s} {:>12s}'.format(
+        'rois', 'K', 'loop ms', 'scatter ms', 'speedup', 'f64 tgt ms',
+        'f32 tgt ms')
+    for num_rois in (128, 256, 512):
+        for num_classes in (2, 21, 81):
+            ex_rois = random_boxes(rng, num_rois)
+            gt_rois = random_boxes(rng, num_rois)
+            labels = rng.randint(1, num_classes, num_rois).astype(np.float32)
+            # cfg.TRAIN.FG_FRACTION of foreground RoIs
+            labels[int(cfg.TRAIN.FG_FRACTION * num_rois):] = 0
+            data = compute_targets(ex_rois, gt_rois, labels, np.float32)
+
+            shape = (num_rois, 4 * num_classes)
+            expand = lambda: expand_bbox_targets(
+                data, num_classes, cfg.TRAIN.BBOX_INSIDE_WEIGHTS,
+                agnostic=args.agnostic,
+                out=(buf.get('bbox_targets', shape, np.float32),
+                     buf.get('bbox_inside_weights', shape, np.float32)))
+            ref = loop_expand(data, num_classes, args.agnostic)
+            if not all(np.array_equal(a, b) for a, b in zip(ref, expand())):
+                print 'Expanded targets differ: {:d} rois, {:d} classes' \
+                    .format(num_rois, num_classes)
+                failed = True
+
+            loop_ms = time_fn(
+                lambda: loop_expand(data, num_classes, args.agnostic),
+                args.iters)
+            scatter_ms = time_fn(expand, args.iters)
+            f64_ms = time_fn(lambda: compute_targets(
+                ex_rois, gt_rois, labels, np.float64), args.iters)
+            f32_ms = time_fn(lambda: compute_targets(
+                ex_rois, gt_rois, labels, np.float32), args.iters)
+            print '{:5d} {:4d} {:10.3f} {:10.3f} {:7.1f}x {:12.3f} {:12.3f}' \
+                .format(num_rois, num_classes, loop_ms, scatter_ms,
+                        loop_ms / scatter_ms, f64_ms, f32_ms)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Benchmark the float and fused (uint8 resize) paths of prep_im_for_blob.
+
+Both paths turn each image into a contiguous N x 3 x H x W blob through
+im_list_to_blob. The script prints the time per image of each path and the
+max / mean absolute difference of their blobs, and exits with status 1 if
+the max difference exceeds --tol.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from utils.blob import prep_im_for_blob, im_list_to_blob
+import numpy as np
+import cv2
+import argparse
+import glob
+import time
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark prep_im_for_blob')
+    parser.add_argument('--images', dest='images',
+                        help='glob of the images to use (default: random '
+                             'images)', default=None, type=str)
+    parser.add_argument('--num', dest='num_images',
+                        help='number of images', default=20, type=int)
+    parser.add_argument('--size', dest='size', nargs=2,
+                        help='height and width of the random images',
+                        default=(1080, 1920), type=int)
+    parser.add_argument('--scale', dest='scale',
+                        help='target size of the shortest side',
+                        default=600, type=int)
+    parser.add_argument('--max_size', dest='max_size',
+                        help='max size of the longest side',
+                        default=1000, type=int)
+    parser.add_argument('--tol', dest='tol',
+                        help='max allowed absolute pixel difference',
+                        default=1.0, type=float)
+
+    args = parser.parse_args()
+    return args
+
+def load_images(args):
+    if args.images is not None:
+        paths = sorted(glob.glob(args.images))[:args.num_images]
+        return [cv2.imread(p) for p in paths]
+    rng = np.random.RandomState(cfg.RNG_SEED)
+    ims = []
+    for _ in xrange(args.num_images):
+        noise = rng.randint(0, 256, tuple(args.size) + (3,)).astype(np.uint8)
+        # smooth the noise a little so that resizing is not all aliasing
+        ims.append(cv2.GaussianBlur(noise, (5, 5), 2))
+    return ims
+
+def prep_blob(im, args, fused):
+    im, _ = prep_im_for_blob(im, cfg.PIXEL_MEANS, args.scale, args.max_size,
+                             fused=fused)
+    return im_list_to_blob([im],
+                           pixel_means=cfg.PIXEL_MEANS if fused else None)
+
+def time_path(ims, args, fused):
+    prep_blob(ims[0], args, fused)
+    start = time.time()
+    for im in ims:
+        prep_blob(im, args, fused)
+    return (time.time() - start) / len(ims)
+
+if __name__ == '__main__':
+    args = parse_args()
+    ims = load_images(args)
+    if not ims:
+        print 'No images found'
+        sys.exit(1)
+
+    float_time = time_path(ims, args, False)
+    fused_time = time_path(ims, args, True)
+
+    max_diff = 0.
+    sum_diff = 0.
+    for im in ims:
+        diff = np.abs(prep_blob(im, args, False) - prep_blob(im, args, True))
+        max_diff = max(max_diff, diff.max())
+        sum_diff += diff.mean()
+
+    print '{:d} images, scale {:d}, max size {:d}'.format(
+        len(ims), args.scale, args.max_size)
+    print 'float: {:.2f}ms/image'.format(1000 * float_time)
+    print 'fused: {:.2f}ms/image ({:.2f}x)'.format(
+        1000 * fused_time, float_time / fused_time)
+    print 'abs diff: max {:.4f} mean {:.4f}'.format(
+        max_diff, sum_diff / len(ims))
+    if max_diff > args.tol:
+        print 'The fused path differs by more than {:.4f}'.format(args.tol)
+        sys.exit(1)
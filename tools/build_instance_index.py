@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Index the instance label maps (*_label_id.png) of datasets.
+
+Writes the ids, tight boxes, pixel areas and run-length encoded masks of the
+instances of every label map into one file (see utils.instance_index), which
+training reads through cfg.TRAIN.INSTANCE_INDEX instead of scanning the maps
+at every iteration. Maps changed after indexing are read from their files
+until the index is rebuilt.
+"""
+
+import _init_paths
+from datasets.factory import get_imdb
+from utils.instance_index import build_index
+import argparse
+import time
+import cv2
+import os
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Index the instance label maps of datasets')
+    parser.add_argument('--imdb', dest='imdb_name',
+                        help='dataset(s) to index, joined by +',
+                        default='voc_2007_trainval', type=str)
+    parser.add_argument('--out', dest='out_path',
+                        help='index file to write',
+                        required=True, type=str)
+
+    args = parser.parse_args()
+    return args
+
+def read_label_map(path):
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    paths = set()
+    for name in args.imdb_name.split('+'):
+        imdb = get_imdb(name)
+        paths.update(imdb.ins_path_at(i) for i in xrange(imdb.num_images))
+    paths = sorted(paths)
+
+    start = time.time()
+    build_index(paths, args.out_path, read_label_map)
+    print 'Indexed {:d} label maps into {:s} ({:.1f}MB) in {:.1f}s'.format(
+        len(paths), args.out_path, os.path.getsize(args.out_path) / 1e6,
+        time.time() - start)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Check fast_rcnn.nms_wrapper.multiclass_nms on the CPU.
+
+Compares multiclass_nms on random detector outputs with NMS run class by
+class, and checks that images without any RoI (or without any box above
+the score threshold) give empty detections. Exits with status 1 if a check
+fails.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from fast_rcnn.nms_wrapper import nms, multiclass_nms, split_by_class
+import numpy as np
+import sys
+
+NUM_CLASSES = 5
+
+def check(name, ok):
+    print '{:<40s} {:s}'.format(name, 'ok' if ok else 'FAILED')
+    return ok
+
+def is_empty(dets, labels):
+    return dets.shape == (0, 5) and dets.dtype == np.float32 and \
+        labels.shape == (0,)
+
+def per_class_nms(scores, boxes, thresh, score_thresh):
+    cls_dets = [[]]
+    for j in xrange(1, NUM_CLASSES):
+        inds = np.where(scores[:, j] > score_thresh)[0]
+        dets = np.hstack((boxes[inds, j * 4:(j + 1) * 4],
+                          scores[inds, j, np.newaxis])).astype(np.float32)
+        keep = nms(dets, thresh, force_cpu=True)
+        dets = dets[keep]
+        cls_dets.append(dets[np.argsort(-dets[:, 4], kind='mergesort')])
+    return cls_dets
+
+def run_checks():
+    rng = np.random.RandomState(cfg.RNG_SEED)
+    num_boxes = 200
+    scores = rng.rand(num_boxes, NUM_CLASSES).astype(np.float32)
+    xy = rng.rand(num_boxes, 2 * NUM_CLASSES) * 100
+    wh = rng.rand(num_boxes, 2 * NUM_CLASSES) * 50
+    boxes = np.hstack((xy, xy + wh)).reshape(num_boxes, 2, NUM_CLASSES, 2)
+    boxes = boxes.transpose(0, 2, 1, 3).reshape(num_boxes, -1)
+    boxes = boxes.astype(np.float32)
+    passed = True
+
+    dets, labels = multiclass_nms(scores, boxes, 0.3, score_thresh=0.05,
+                                  force_cpu=True)
+    expected = per_class_nms(scores, boxes, 0.3, 0.05)
+    passed &= check('multiclass_nms vs per-class nms',
+                    all(np.array_equal(a, b) for a, b in
+                        zip(split_by_class(dets, labels, NUM_CLASSES)[1:],
+                            expected[1:])))
+
+    dets, labels = multiclass_nms(scores[:0], boxes[:0], 0.3,
+                                  score_thresh=0.05, max_per_image=100,
+                                  force_cpu=True)
+    passed &= check('multiclass_nms (no RoIs)', is_empty(dets, labels))
+
+    dets, labels = multiclass_nms(scores, boxes, 0.3, score_thresh=1.,
+                                  force_cpu=True)
+    passed &= check('multiclass_nms (no box above thresh)',
+                    is_empty(dets, labels))
+    return passed
+
+if __name__ == '__main__':
+    if not run_checks():
+        sys.exit(1)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Check tools/serve_net.py on localhost, on the CPU.
+
+The Batcher runs a stub detector instead of a caffe.Net: one box over the
+whole image per request, scored from the image's mean, put through the
+server's NMS and result formatting. The checks cover the coalescing of
+concurrent requests into batches, the max_latency deadline of a partial
+batch, and the HTTP status codes of DetectionServer (200, 400 for a bad
+request, 404, and 500 for an internal error). Exits with status 1 if a
+check fails.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from serve_net import Batcher, DetectionServer, RequestError
+from collections import Counter
+import numpy as np
+import threading
+import urllib2
+import json
+import time
+import sys
+import cv2
+
+NUM_CLASSES = 3
+
+class StubBatcher(Batcher):
+    """Batcher whose forward pass is a stub detector.
+
+    Images one pixel high raise an internal ValueError.
+    """
+
+    def _run(self, batch):
+        for r in batch:
+            if r.im.shape[0] == 1:
+                raise ValueError('internal error')
+            height, width = r.im.shape[:2]
+            scores = np.zeros((1, NUM_CLASSES), dtype=np.float32)
+            scores[0, 1] = r.im.mean() / 255.
+            scores[0, 0] = 1 - scores[0, 1]
+            boxes = np.tile([0, 0, width - 1, height - 1],
+                            NUM_CLASSES)[np.newaxis].astype(np.float32)
+            r.result = self._detections(r, scores, boxes)
+
+def check(name, ok):
+    print '{:<40s} {:s}'.format(name, 'ok' if ok else 'FAILED')
+    return ok
+
+def image(value, height=20, width=30):
+    return np.full((height, width, 3), value, dtype=np.uint8)
+
+def submit_all(batcher, ims):
+    """Submit ims from one thread each; return the results and the time
+    until the last one returned.
+    """
+    results = [None] * len(ims)
+    def submit(i):
+        results[i] = batcher.submit(ims[i], thresh=0.1)
+    threads = [threading.Thread(target=submit, args=(i,))
+               for i in xrange(len(ims))]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.time() - start
+
+def post(port, path, body):
+    """POST body to the server; return the status code and JSON reply."""
+    url = 'http://127.0.0.1:{:d}{:s}'.format(port, path)
+    try:
+        reply = urllib2.urlopen(urllib2.Request(url, body))
+        code = reply.getcode()
+    except urllib2.HTTPError as e:
+        reply, code = e, e.code
+    return code, json.loads(reply.read())
+
+def get(port, path):
+    url = 'http://127.0.0.1:{:d}{:s}'.format(port, path)
+    try:
+        reply = urllib2.urlopen(url)
+        return reply.getcode(), json.loads(reply.read())
+    except urllib2.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+def check_batching():
+    passed = True
+    # a full batch runs without waiting for its deadline
+    batcher = StubBatcher(None, max_batch=4, max_latency=2.)
+    results, elapsed = submit_all(batcher, [image(200)] * 4)
+    passed &= check('full batch', batcher.batch_sizes == Counter({4: 1})
+                    and elapsed < 2.)
+    passed &= check('detections of a batch',
+                    all(len(r) == 1 and r[0]['label'] == 1 and
+                        r[0]['box'] == [0., 0., 29., 19.] for r in results))
+
+    # a partial batch waits for the deadline of its first request
+    batcher = StubBatcher(None, max_batch=4, max_latency=0.3)
+    _, elapsed = submit_all(batcher, [image(200)])
+    passed &= check('partial batch deadline',
+                    batcher.batch_sizes == Counter({1: 1}) and
+                    0.3 <= elapsed < 2.)
+
+    # more requests than max_batch are split
+    batcher = StubBatcher(None, max_batch=4, max_latency=0.3)
+    submit_all(batcher, [image(200)] * 6)
+    passed &= check('max_batch', batcher.batch_sizes == Counter({4: 1, 2: 1}))
+
+    try:
+        batcher.submit(image(200), masks=True)
+        passed &= check('masks without a mask net', False)
+    except RequestError:
+        passed &= check('masks without a mask net', True)
+    return passed
+
+def check_http():
+    batcher = StubBatcher(None, max_batch=4, max_latency=0.01)
+    server = DetectionServer(('127.0.0.1', 0), batcher, thresh=0.5)
+    port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    passed = True
+    try:
+        png = cv2.imencode('.png', image(200))[1].tostring()
+        code, reply = post(port, '/detect', png)
+        passed &= check('POST /detect', code == 200 and
+                        len(reply['detections']) == 1)
+        code, reply = post(port, '/detect?thresh=0.9', png)
+        passed &= check('POST /detect?thresh', code == 200 and
+                        reply['detections'] == [])
+        code, _ = post(port, '/detect?thresh=high', png)
+        passed &= check('bad thresh -> 400', code == 400)
+        code, _ = post(port, '/detect', 'not an image')
+        passed &= check('bad image -> 400', code == 400)
+        code, _ = post(port, '/detect?masks=1', png)
+        passed &= check('masks without a mask net -> 400', code == 400)
+        code, _ = post(port, '/detect',
+                       cv2.imencode('.png', image(200, 1))[1].tostring())
+        passed &= check('internal ValueError -> 500', code == 500)
+        code, _ = post(port, '/other', png)
+        passed &= check('POST unknown path -> 404', code == 404)
+        # three requests reached the batcher, one image per batch
+        code, metrics = get(port, '/metrics')
+        passed &= check('GET /metrics', code == 200 and
+                        metrics['images'] == 3 and
+                        metrics['batch_sizes'] == {'1': 3} and
+                        metrics['latency']['request']['count'] == 3)
+        code, _ = get(port, '/health')
+        passed &= check('GET /health', code == 200)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return passed
+
+if __name__ == '__main__':
+    cfg.USE_GPU_NMS = False
+    passed = check_batching()
+    passed &= check_http()
+    if not passed:
+        sys.exit(1)
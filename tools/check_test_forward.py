@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Check the forward passes of fast_rcnn.test on tiny nets.
+
+Builds small deploy nets out of stock Caffe layers (with constant fillers,
+so no caffemodel is needed) and runs the test-time entry points through
+them on the CPU: _forward_blobs with RoI and with im_info inputs,
+im_detect, im_detect_mask, and im_det_with_scales plus im_seg_dets on a
+detection and mask net combined by tools/combine_mask_deploy.py (against
+the two nets run separately). Exits with status 1 if a forward fails or its
+outputs are not what the inputs imply.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg
+import fast_rcnn.test as test
+from combine_mask_deploy import combine
+from caffe.proto import caffe_pb2
+import google.protobuf.text_format as text_format
+import caffe
+import numpy as np
+import tempfile
+import shutil
+import os
+import sys
+
+NUM_CLASSES = 3
+MASK_SIZE = 4
+
+# data -> res4f (4 channels, stride 1)
+BACKBONE = '''
+layer { name: "conv" type: "Convolution" bottom: "data" top: "res4f"
+  convolution_param { num_output: 4 kernel_size: 1
+    weight_filler { type: "constant" value: 0.01 }
+    bias_filler { type: "constant" value: 0.1 } } }
+'''
+
+# Fast R-CNN head on res4f and rois
+DET_HEAD = '''
+layer { name: "roi_pool" type: "ROIPooling" bottom: "res4f" bottom: "rois"
+  top: "pool" roi_pooling_param { pooled_h: 2 pooled_w: 2
+    spatial_scale: 1 } }
+layer { name: "cls_score" type: "InnerProduct" bottom: "pool"
+  top: "cls_score" inner_product_param { num_output: %d
+    weight_filler { type: "constant" value: 0.01 } } }
+layer { name: "cls_prob" type: "Softmax" bottom: "cls_score"
+  top: "cls_prob" }
+layer { name: "bbox_pred" type: "InnerProduct" bottom: "pool"
+  top: "bbox_pred" inner_product_param { num_output: %d
+    weight_filler { type: "constant" value: 0 } } }
+''' % (NUM_CLASSES, 4 * NUM_CLASSES)
+
+# mask head on res4f and rois
+MASK_HEAD = '''
+layer { name: "mask_pool" type: "ROIPooling" bottom: "res4f"
+  bottom: "rois" top: "mask_pool" roi_pooling_param { pooled_h: %d
+    pooled_w: %d spatial_scale: 1 } }
+layer { name: "mask_score" type: "Convolution" bottom: "mask_pool"
+  top: "mask_score" convolution_param { num_output: 1 kernel_size: 1
+    weight_filler { type: "constant" value: 0.5 } } }
+layer { name: "mask_prob" type: "Sigmoid" bottom: "mask_score"
+  top: "mask_prob" }
+''' % (MASK_SIZE, MASK_SIZE)
+
+def input_layer(name, shape):
+    return 'layer {{ name: "{0}" type: "Input" top: "{0}" input_param ' \
+        '{{ shape {{ {1} }} }} }}\n'.format(
+            name, ' '.join('dim: {:d}'.format(d) for d in shape))
+
+def load_net(prototxt, out_dir, name):
+    path = os.path.join(out_dir, name + '.prototxt')
+    with open(path, 'w') as f:
+        f.write(prototxt)
+    return caffe.Net(path, caffe.TEST)
+
+def parse_net(prototxt):
+    net = caffe_pb2.NetParameter()
+    text_format.Merge(prototxt, net)
+    return net
+
+def check(name, ok):
+    print '{:<40s} {:s}'.format(name, 'ok' if ok else 'FAILED')
+    return ok
+
+def run_checks(out_dir):
+    rng = np.random.RandomState(cfg.RNG_SEED)
+    im = rng.randint(0, 255, (40, 56, 3)).astype(np.uint8)
+    boxes = np.array([[0, 0, 20, 20], [10, 5, 50, 35], [30, 20, 55, 39]],
+                     dtype=np.float32)
+    passed = True
+
+    cfg.TEST.HAS_RPN = False
+    det_net = load_net(input_layer('data', (1, 3, 32, 32)) +
+                       input_layer('rois', (1, 5)) + BACKBONE + DET_HEAD,
+                       out_dir, 'det')
+    blobs, _ = test._get_blobs(im, boxes)
+    out = test._forward_blobs(det_net, blobs)
+    passed &= check('_forward_blobs (rois)',
+                    out['cls_prob'].shape == (len(boxes), NUM_CLASSES) and
+                    np.array_equal(det_net.blobs['data'].data,
+                                   blobs['data']) and
+                    np.array_equal(det_net.blobs['rois'].data,
+                                   blobs['rois']))
+    scores, pred_boxes = test.im_detect(det_net, im, boxes)
+    passed &= check('im_detect',
+                    scores.shape == (len(boxes), NUM_CLASSES) and
+                    pred_boxes.shape == (len(boxes), 4 * NUM_CLASSES))
+
+    cfg.TEST.HAS_RPN = True
+    rpn_net = load_net(input_layer('data', (1, 3, 32, 32)) +
+                       input_layer('im_info', (1, 3)) + BACKBONE,
+                       out_dir, 'rpn')
+    blobs, im_scales = test._get_blobs(im, None)
+    blobs['im_info'] = test._get_im_info(im.shape, im_scales)
+    test._forward_blobs(rpn_net, blobs)
+    passed &= check('_forward_blobs (im_info)',
+                    np.array_equal(rpn_net.blobs['im_info'].data,
+                                   blobs['im_info']) and
+                    rpn_net.blobs['res4f'].data.shape[2:] ==
+                    blobs['data'].shape[2:])
+
+    cfg.TEST.HAS_RPN = False
+    mask_net = load_net(input_layer('data', (1, 3, 32, 32)) +
+                        input_layer('rois', (1, 5)) + BACKBONE + MASK_HEAD,
+                        out_dir, 'mask')
+    masks = test.im_detect_mask(mask_net, im, boxes)
+    passed &= check('im_detect_mask',
+                    masks.shape == (len(boxes), 1, MASK_SIZE, MASK_SIZE))
+
+    # the detection net above and a mask net on its res4f, run separately
+    # and combined into one net
+    mask_prototxt = input_layer('res4f', (1, 4, 32, 32)) + \
+        input_layer('rois', (1, 5)) + MASK_HEAD
+    mask_net = load_net(mask_prototxt, out_dir, 'mask_head')
+    combined = parse_net(input_layer('data', (1, 3, 32, 32)) +
+                         input_layer('rois', (1, 5)) + BACKBONE + DET_HEAD)
+    combined = load_net(text_format.MessageToString(
+        combine(combined, parse_net(mask_prototxt))), out_dir, 'combined')
+    labels = np.arange(len(boxes)) % NUM_CLASSES
+    outs = []
+    for net, head in ((det_net, mask_net), (combined, combined)):
+        scores, pred_boxes, feat, im_scales = \
+            test.im_det_with_scales(net, im, boxes)
+        masks = test.im_seg_dets(head, feat, boxes, labels, im_scales)
+        outs.append((scores, pred_boxes, masks))
+    passed &= check('combined detection and mask net',
+                    all(np.allclose(a, b) for a, b in zip(*outs)))
+    return passed
+
+if __name__ == '__main__':
+    caffe.set_mode_cpu()
+    cfg.TEST.SCALES = (32,)
+    cfg.TEST.MAX_SIZE = 64
+    out_dir = tempfile.mkdtemp()
+    try:
+        passed = run_checks(out_dir)
+    finally:
+        shutil.rmtree(out_dir)
+    if not passed:
+        sys.exit(1)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Merge a detection deploy net and a mask deploy net into a single net.
+
+The mask branch is appended after the detection layers and reads the
+backbone features (e.g. res4f) of the detection net in place. It starts with
+an Input layer named "mask_rois", so fast_rcnn.test runs the detection part
+with forward(end=...) and the mask part with forward(start='mask_rois'),
+without copying the features between two nets. mask_rois is an input of the
+combined net, so the inputs are filled in place in net.blobs rather than
+passed to forward (which takes keyword inputs only for all of them at once).
+tools/check_test_forward.py runs a combined net end to end.
+
+Mask branch layers whose name also exists in the detection net (e.g. the
+res5 head shared by both branches at training time) are renamed with a
+"_mask" suffix and share their parameters with the detection layer, so the
+caffemodel loads them once.
+"""
+
+import _init_paths
+from caffe.proto import caffe_pb2
+import google.protobuf.text_format as text_format
+import argparse
+import sys
+
+# Name of the Input layer (and blob) holding the RoIs of the mask branch
+MASK_ROIS = 'mask_rois'
+
+def parse_args():
+    """Parse input arguments."""
+    parser = argparse.ArgumentParser(
+        description='Combine detection and mask deploy nets')
+    parser.add_argument('--def', dest='prototxt',
+                        help='prototxt file defining the detection network',
+                        default=None, type=str)
+    parser.add_argument('--def_mask', dest='prototxt_mask',
+                        help='prototxt file defining the mask network',
+                        default=None, type=str)
+    parser.add_argument('--out', dest='prototxt_out',
+                        help='combined prototxt file to write',
+                        default=None, type=str)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+def load_net(prototxt):
+    net = caffe_pb2.NetParameter()
+    with open(prototxt, 'r') as f:
+        text_format.Merge(f.read(), net)
+    return net
+
+def num_param_blobs(layer):
+    """Number of parameter blobs of a layer."""
+    if layer.type in ('Convolution', 'Deconvolution'):
+        return 1 + int(layer.convolution_param.bias_term)
+    if layer.type == 'InnerProduct':
+        return 1 + int(layer.inner_product_param.bias_term)
+    if layer.type == 'Scale':
+        return 1 + int(layer.scale_param.bias_term)
+    if layer.type == 'BatchNorm':
+        return 3
+    return len(layer.param)
+
+def share_params(owner, layer):
+    """Name the parameters of owner and layer alike, so Caffe shares them."""
+    num_params = num_param_blobs(owner)
+    for l in (owner, layer):
+        while len(l.param) < num_params:
+            spec = l.param.add()
+            if l.type == 'BatchNorm':
+                # BatchNorm statistics must not be learned
+                spec.lr_mult = 0
+                spec.decay_mult = 0
+        for i in xrange(num_params):
+            l.param[i].name = '{}_param{}'.format(owner.name, i)
+
+def combine(det_net, mask_net):
+    """Append the layers of mask_net to det_net.
+
+    The Input layers of mask_net are dropped: its RoI input (the only 2-D
+    one) becomes the "mask_rois" Input layer, and its other inputs must be
+    blobs of det_net.
+    """
+    det_layers = dict((l.name, i) for i, l in enumerate(det_net.layer))
+    det_blobs = set(top for l in det_net.layer for top in l.top)
+
+    net = caffe_pb2.NetParameter()
+    net.CopyFrom(det_net)
+
+    # blob renames applied to the mask branch
+    renames = {}
+    # (detection layer, mask layer) index pairs sharing their parameters
+    shared = []
+    for layer in mask_net.layer:
+        if layer.type != 'Input':
+            continue
+        for top, shape in zip(layer.top, layer.input_param.shape):
+            if len(shape.dim) != 2:
+                # features computed by the detection net
+                assert top in det_blobs, \
+                    '{} is not a blob of the detection net'.format(top)
+                continue
+            assert MASK_ROIS not in renames.values(), \
+                'The mask net must have a single input besides the features'
+            renames[top] = MASK_ROIS
+            rois = net.layer.add()
+            rois.name = MASK_ROIS
+            rois.type = 'Input'
+            rois.top.append(MASK_ROIS)
+            rois.input_param.shape.add().CopyFrom(shape)
+    assert MASK_ROIS in renames.values(), 'The mask net has no RoI input'
+
+    for layer in mask_net.layer:
+        if layer.type == 'Input':
+            continue
+        new = net.layer.add()
+        new.CopyFrom(layer)
+        for i, bottom in enumerate(layer.bottom):
+            new.bottom[i] = renames.get(bottom, bottom)
+        for i, top in enumerate(layer.top):
+            if top not in renames and top in det_blobs:
+                renames[top] = top + '_mask'
+            new.top[i] = renames.get(top, top)
+        if layer.name in det_layers:
+            new.name = layer.name + '_mask'
+            shared.append((det_layers[layer.name], len(net.layer) - 1))
+
+    for owner, layer in shared:
+        share_params(net.layer[owner], net.layer[layer])
+    return net
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    net = combine(load_net(args.prototxt), load_net(args.prototxt_mask))
+    with open(args.prototxt_out, 'w') as f:
+        f.write(text_format.MessageToString(net))
+    print 'Wrote combined net to: {:s}'.format(args.prototxt_out)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Compare the profile.json dumps of two test runs.
+
+Prints the p50 / p95 / p99 latency of every span in both runs and exits with
+status 1 if a span got slower than the tolerance allows.
+"""
+
+import json
+import sys
+import argparse
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Compare two profiles')
+    parser.add_argument('base', help='profile.json of the reference run',
+                        type=str)
+    parser.add_argument('new', help='profile.json of the run to check',
+                        type=str)
+    parser.add_argument('--field', dest='field',
+                        help='statistic checked against the tolerance',
+                        default='p95', choices=('mean', 'p50', 'p95', 'p99'),
+                        type=str)
+    parser.add_argument('--tol', dest='tol',
+                        help='allowed relative slowdown (0.1 = 10%%)',
+                        default=0.1, type=float)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+def load_spans(filename):
+    with open(filename, 'r') as f:
+        profile = json.load(f)
+    return dict((s['span'], s) for s in profile['spans'])
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    base = load_spans(args.base)
+    new = load_spans(args.new)
+
+    print '{:<14s} {:>17s} {:>17s} {:>17s} {:>8s}'.format(
+        'span', 'p50 base/new', 'p95 base/new', 'p99 base/new', 'change')
+    regressions = []
+    for name in sorted(set(base) | set(new)):
+        if name not in base or name not in new:
+            print '{:<14s} only in {:s}'.format(
+                name, args.base if name in base else args.new)
+            continue
+        b, n = base[name], new[name]
+        change = n[args.field] / max(b[args.field], 1e-9) - 1
+        print '{:<14s} {:>8.4f}/{:<8.4f} {:>8.4f}/{:<8.4f} {:>8.4f}/{:<8.4f} ' \
+              '{:>+7.1f}%'.format(name, b['p50'], n['p50'], b['p95'],
+                                  n['p95'], b['p99'], n['p99'], 100 * change)
+        if change > args.tol:
+            regressions.append(name)
+
+    if regressions:
+        print '{:s} regressed by more than {:.0f}%: {:s}'.format(
+            args.field, 100 * args.tol, ', '.join(regressions))
+        sys.exit(1)
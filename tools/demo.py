@@ -16,7 +16,7 @@ See README.md for installation instructions before running.
 import _init_paths
 from fast_rcnn.config import cfg
 from fast_rcnn.test import im_detect
-from fast_rcnn.nms_wrapper import nms
+from fast_rcnn.nms_wrapper import multiclass_nms, split_by_class
 from utils.timer import Timer
 import matplotlib.pyplot as plt
 import numpy as np
@@ -87,15 +87,11 @@ def demo(net, image_name):
     # Visualize detections for each class
     CONF_THRESH = 0.8
     NMS_THRESH = 0.3
+    dets, labels = multiclass_nms(scores, boxes, NMS_THRESH)
+    cls_dets = split_by_class(dets, labels, len(CLASSES))
     for cls_ind, cls in enumerate(CLASSES[1:]):
         cls_ind += 1 # because we skipped background
-        cls_boxes = boxes[:, 4*cls_ind:4*(cls_ind + 1)]
-        cls_scores = scores[:, cls_ind]
-        dets = np.hstack((cls_boxes,
-                          cls_scores[:, np.newaxis])).astype(np.float32)
-        keep = nms(dets, NMS_THRESH)
-        dets = dets[keep, :]
-        vis_detections(im, cls, dets, thresh=CONF_THRESH)
+        vis_detections(im, cls, cls_dets[cls_ind], thresh=CONF_THRESH)
 
 def parse_args():
     """Parse input arguments."""
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Pre-render the training images at the training scales.
+
+Every image of the given datasets is rendered at each of cfg.TRAIN.SCALES
+(and cfg.TRAIN.MAX_SIZE) into the cache directory, which training then reads
+through cfg.TRAIN.PRESCALED_DIR (see utils.prescaled). Images already
+rendered for the current files and config are skipped, so the script can be
+rerun after changing the dataset or the scales; --clean removes the files
+the current ones made unused.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
+from datasets.factory import get_imdb
+from utils.prescaled import prescaled_path, write_prescaled
+import multiprocessing
+import argparse
+import glob
+import time
+import sys
+import os
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Pre-render the training images at the training scales')
+    parser.add_argument('--imdb', dest='imdb_name',
+                        help='dataset(s) to render, joined by +',
+                        default='voc_2007_trainval', type=str)
+    parser.add_argument('--dir', dest='cache_dir',
+                        help='cache directory (default: '
+                             'cfg.TRAIN.PRESCALED_DIR)',
+                        default=None, type=str)
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file',
+                        default=None, type=str)
+    parser.add_argument('--workers', dest='num_workers',
+                        help='number of worker processes',
+                        default=multiprocessing.cpu_count(), type=int)
+    parser.add_argument('--clean', dest='clean',
+                        help='remove the unused files of the cache directory',
+                        action='store_true')
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    return args
+
+def render(job):
+    cache_dir, path, target_size = job
+    return write_prescaled(cache_dir, path, target_size, cfg.TRAIN.MAX_SIZE)
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+    cache_dir = args.cache_dir or cfg.TRAIN.PRESCALED_DIR
+    if not cache_dir:
+        print 'No cache directory: pass --dir or set TRAIN.PRESCALED_DIR'
+        sys.exit(1)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    paths = set()
+    for name in args.imdb_name.split('+'):
+        imdb = get_imdb(name)
+        paths.update(imdb.image_path_at(i) for i in xrange(imdb.num_images))
+    paths = sorted(paths)
+
+    used = set()
+    jobs = []
+    for path in paths:
+        for target_size in cfg.TRAIN.SCALES:
+            out_path = prescaled_path(cache_dir, path, target_size,
+                                      cfg.TRAIN.MAX_SIZE)
+            used.add(out_path)
+            if not os.path.exists(out_path):
+                jobs.append((cache_dir, path, target_size))
+    print '{:d} images x {:d} scales, {:d} to render into {:s}'.format(
+        len(paths), len(cfg.TRAIN.SCALES), len(jobs), cache_dir)
+
+    start = time.time()
+    pool = multiprocessing.Pool(max(args.num_workers, 1))
+    for i, _ in enumerate(pool.imap_unordered(render, jobs, chunksize=8)):
+        if (i + 1) % 500 == 0 or i + 1 == len(jobs):
+            print 'rendered {:d}/{:d} ({:.1f}ms/image)'.format(
+                i + 1, len(jobs), 1000 * (time.time() - start) / (i + 1))
+    pool.close()
+    pool.join()
+
+    if args.clean:
+        unused = [f for f in glob.glob(os.path.join(cache_dir, '*.npz'))
+                  if f not in used]
+        for f in unused:
+            os.remove(f)
+        print 'removed {:d} unused files'.format(len(unused))
@@ -10,7 +10,8 @@
 """Reval = re-eval. Re-evaluate saved detections."""
 
 import _init_paths
-from fast_rcnn.test import apply_nms
+from fast_rcnn.test import apply_nms, apply_nms_store
+from fast_rcnn.det_store import DetectionReader
 from fast_rcnn.config import cfg
 from datasets.factory import get_imdb
 import cPickle
@@ -46,14 +47,23 @@ def from_dets(imdb_name, output_dir, args):
     imdb = get_imdb(imdb_name)
     imdb.competition_mode(args.comp_mode)
     imdb.config['matlab_eval'] = args.matlab_eval
-    with open(os.path.join(output_dir, 'detections.pkl'), 'rb') as f:
-        dets = cPickle.load(f)
-
-    if args.apply_nms:
-        print 'Applying NMS to all detections'
-        nms_dets = apply_nms(dets, cfg.TEST.NMS)
+    det_path = os.path.join(output_dir, 'detections')
+    if os.path.isdir(det_path):
+        # streamed by test_net, read lazily
+        reader = DetectionReader(det_path)
+        if args.apply_nms:
+            print 'Applying NMS to all detections'
+            reader = apply_nms_store(reader, det_path + '_nms', cfg.TEST.NMS)
+        nms_dets = reader.all_boxes()
     else:
-        nms_dets = dets
+        with open(os.path.join(output_dir, 'detections.pkl'), 'rb') as f:
+            dets = cPickle.load(f)
+
+        if args.apply_nms:
+            print 'Applying NMS to all detections'
+            nms_dets = apply_nms(dets, cfg.TEST.NMS)
+        else:
+            nms_dets = dets
 
     print 'Evaluating detections'
     imdb.evaluate_detections(nms_dets, output_dir)
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Serve a Fast R-CNN (or Mask R-CNN) network over HTTP.
+
+The net is loaded once. Concurrent requests are coalesced into batches of up
+to --max_batch images. A batch is run as soon as it is full, or --max_latency
+seconds after its first request arrived, whichever comes first.
+
+Endpoints:
+
+    POST /detect[?thresh=0.5&masks=1]   body: an encoded image (JPEG, PNG...)
+        returns {"detections": [{"label", "class", "score", "box",
+                 ["mask"]}], "time"}, with box = [x1, y1, x2, y2] and mask a
+                 COCO RLE ({"size": [h, w], "counts": "..."})
+    GET /metrics    queue depth, batch sizes and latency percentiles
+    GET /health
+
+Example, on the CPU:
+
+    ./tools/serve_net.py --cpu --def test.prototxt --net model.caffemodel
+    curl --data-binary @image.jpg 'http://127.0.0.1:8000/detect?thresh=0.7'
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
+from fast_rcnn.test import im_detect, im_detect_batch, im_det_with_scales, \
+    im_seg_dets
+from fast_rcnn.nms_wrapper import multiclass_nms
+from utils.masks import paste_masks_rle
+from utils.profiler import Profiler
+from collections import Counter
+import BaseHTTPServer
+import SocketServer
+import urlparse
+import threading
+import Queue
+import json
+import numpy as np
+import caffe, sys, cv2
+import argparse
+import time
+
+# Latency samples kept per span for the percentiles of GET /metrics
+LATENCY_SAMPLES = 1000
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Serve a Fast R-CNN network')
+    parser.add_argument('--gpu', dest='gpu_id', help='GPU id to use',
+                        default=0, type=int)
+    parser.add_argument('--cpu', dest='cpu_mode',
+                        help='Use CPU mode (overrides --gpu)',
+                        action='store_true')
+    parser.add_argument('--def', dest='prototxt',
+                        help='prototxt file defining the network',
+                        default=None, type=str)
+    parser.add_argument('--def_mask', dest='prototxt_mask',
+                        help='prototxt file defining the mask network',
+                        default=None, type=str)
+    parser.add_argument('--mask', dest='mask',
+                        help='serve masks with a combined net given by --def',
+                        action='store_true')
+    parser.add_argument('--net', dest='caffemodel',
+                        help='model to serve',
+                        default=None, type=str)
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--classes', dest='classes_file',
+                        help='file with one class name per line, background '
+                             'first', default=None, type=str)
+    parser.add_argument('--host', dest='host', help='address to listen on',
+                        default='127.0.0.1', type=str)
+    parser.add_argument('--port', dest='port', help='port to listen on',
+                        default=8000, type=int)
+    parser.add_argument('--max_batch', dest='max_batch',
+                        help='max number of images per forward pass',
+                        default=4, type=int)
+    parser.add_argument('--max_latency', dest='max_latency',
+                        help='max seconds a request waits for its batch '
+                             'to fill', default=0.01, type=float)
+    parser.add_argument('--thresh', dest='thresh',
+                        help='default score threshold of the detections',
+                        default=0.5, type=float)
+    parser.add_argument('--num_dets', dest='max_per_image',
+                        help='max number of detections per image',
+                        default=100, type=int)
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+
+class RequestError(Exception):
+    """A request the server cannot serve, answered with HTTP 400."""
+
+
+class _Request(object):
+    """An image waiting for its detections."""
+
+    def __init__(self, im, thresh, masks):
+        self.im = im
+        self.thresh = thresh
+        self.masks = masks
+        self.arrival = time.time()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Batcher(object):
+    """Run the requests submitted by any thread through net in batches.
+
+    The net is only used by the thread of the batcher. Caffe keeps its mode
+    and device per thread, so setup_fn (e.g. caffe.set_mode_gpu and
+    caffe.set_device) is called from that thread before the first batch.
+
+    Arguments:
+        net (caffe.Net): detection network
+        net_mask (caffe.Net): mask network, net itself for a combined
+            detection and mask net, or None to serve boxes only
+        max_batch (int): max number of images per forward pass
+        max_latency (float): max seconds the first request of a batch waits
+            for more requests
+        max_per_image (int): max number of detections per image
+        classes (list): class names, or None
+        setup_fn (callable): called in the batcher thread before any forward
+    """
+
+    def __init__(self, net, net_mask=None, max_batch=4, max_latency=0.01,
+                 max_per_image=100, classes=None, setup_fn=None):
+        self._net = net
+        self._net_mask = net_mask
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.max_per_image = max_per_image
+        self.classes = classes
+        self._setup_fn = setup_fn
+        self._queue = Queue.Queue()
+        self.batch_sizes = Counter()
+        # a bounded reservoir per span: the server runs indefinitely
+        self.profiler = Profiler(report_interval=-1,
+                                 max_samples=LATENCY_SAMPLES)
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def has_masks(self):
+        return self._net_mask is not None
+
+    def submit(self, im, thresh=0.5, masks=False):
+        """Queue an image and block until its detections are ready.
+
+        Returns:
+            detections (list): one dict per detection, as returned by
+                POST /detect
+        """
+        if masks and not self.has_masks:
+            raise RequestError('This server has no mask network')
+        request = _Request(im, thresh, masks)
+        self._queue.put(request)
+        request.done.wait()
+        self.profiler.add('request', time.time() - request.arrival)
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].arrival + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        if self._setup_fn is not None:
+            self._setup_fn()
+        while True:
+            batch = self._next_batch()
+            start = time.time()
+            for request in batch:
+                self.profiler.add('queue', start - request.arrival)
+            try:
+                self._run(batch)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            self.batch_sizes[len(batch)] += 1
+            self.profiler.add('batch', time.time() - start)
+            for request in batch:
+                request.done.set()
+
+    def _run(self, batch):
+        # images with masks need the features of their own forward pass
+        mask_reqs = [r for r in batch if r.masks]
+        box_reqs = [r for r in batch if not r.masks]
+        if len(box_reqs) > 1 and len(cfg.TEST.SCALES) == 1:
+            all_scores, all_boxes = im_detect_batch(
+                self._net, [r.im for r in box_reqs])
+            for r, scores, boxes in zip(box_reqs, all_scores, all_boxes):
+                r.result = self._detections(r, scores, boxes)
+        else:
+            for r in box_reqs:
+                scores, boxes = im_detect(self._net, r.im)
+                r.result = self._detections(r, scores, boxes)
+        for r in mask_reqs:
+            # the images are decoded at full resolution (decode scale 1)
+            scores, boxes, feat, im_scales = im_det_with_scales(self._net,
+                                                                r.im)
+            r.result = self._detections(r, scores, boxes, feat, im_scales)
+
+    def _detections(self, request, scores, boxes, feat=None, im_scales=None):
+        dets, labels = multiclass_nms(scores, boxes, cfg.TEST.NMS,
+                                      score_thresh=request.thresh,
+                                      max_per_image=self.max_per_image,
+                                      agnostic=cfg.TEST.AGNOSTIC)
+        results = [{'label': int(label), 'score': float(det[4]),
+                    'box': [float(x) for x in det[:4]]}
+                   for det, label in zip(dets, labels)]
+        if self.classes is not None:
+            for result in results:
+                result['class'] = self.classes[result['label']]
+        if feat is not None:
+            masks = im_seg_dets(self._net_mask, feat, dets[:, :4], labels,
+                                im_scales)
+            rles = paste_masks_rle(dets, masks, request.im.shape,
+                                   thresh=cfg.TEST.MASK_THRESH,
+                                   bilinear=cfg.TEST.MASK_BILINEAR)
+            for result, rle in zip(results, rles):
+                result['mask'] = {'size': list(rle['size']),
+                                  'counts': rle['counts']}
+        return results
+
+    def metrics(self):
+        """Return the queue depth, batch size histogram and latencies.
+
+        The latency percentiles are estimated from at most LATENCY_SAMPLES
+        requests per span, sampled uniformly since the server started.
+        """
+        num_batches = sum(self.batch_sizes.values())
+        num_images = sum(k * n for k, n in self.batch_sizes.iteritems())
+        return {'queue_depth': self._queue.qsize(),
+                'batches': num_batches,
+                'images': num_images,
+                'mean_batch_size': float(num_images) / max(num_batches, 1),
+                'batch_sizes': dict((str(k), n)
+                                    for k, n in self.batch_sizes.iteritems()),
+                'latency': dict((name, s)
+                                for name, s in self.profiler.stats())}
+
+
+class DetectionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """HTTP front end of a Batcher (self.server.batcher)."""
+
+    def _send_json(self, obj, code=200):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        if path == '/metrics':
+            self._send_json(self.server.batcher.metrics())
+        elif path == '/health':
+            self._send_json({'status': 'ok'})
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/detect':
+            self._send_json({'error': 'not found'}, 404)
+            return
+        params = urlparse.parse_qs(url.query)
+        try:
+            thresh = float(params.get('thresh', [self.server.thresh])[0])
+            masks = params.get('masks', ['0'])[0] not in ('0', 'false', '')
+        except ValueError as e:
+            self._send_json({'error': str(e)}, 400)
+            return
+        length = int(self.headers.getheader('content-length', 0))
+        data = np.frombuffer(self.rfile.read(length), dtype=np.uint8)
+        im = cv2.imdecode(data, cv2.IMREAD_COLOR) if len(data) else None
+        if im is None:
+            self._send_json({'error': 'could not decode the image'}, 400)
+            return
+
+        start = time.time()
+        try:
+            detections = self.server.batcher.submit(im, thresh, masks)
+        except RequestError as e:
+            self._send_json({'error': str(e)}, 400)
+            return
+        except Exception as e:
+            self._send_json({'error': str(e)}, 500)
+            return
+        self._send_json({'detections': detections,
+                         'time': time.time() - start})
+
+    def log_message(self, format, *args):
+        # the request log would dominate the console
+        pass
+
+
+class DetectionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server: every request thread blocks on the Batcher."""
+
+    daemon_threads = True
+
+    def __init__(self, address, batcher, thresh=0.5):
+        BaseHTTPServer.HTTPServer.__init__(self, address, DetectionHandler)
+        self.batcher = batcher
+        self.thresh = thresh
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+    cfg.TEST.HAS_RPN = True  # Use RPN for proposals
+
+    if args.cpu_mode:
+        cfg.USE_GPU_NMS = False
+        caffe.set_mode_cpu()
+    else:
+        cfg.GPU_ID = args.gpu_id
+        caffe.set_mode_gpu()
+        caffe.set_device(args.gpu_id)
+
+    def setup():
+        if args.cpu_mode:
+            caffe.set_mode_cpu()
+        else:
+            caffe.set_mode_gpu()
+            caffe.set_device(args.gpu_id)
+
+    net = caffe.Net(args.prototxt, args.caffemodel, caffe.TEST)
+    net_mask = None
+    if args.prototxt_mask is not None:
+        net_mask = caffe.Net(args.prototxt_mask, args.caffemodel, caffe.TEST)
+        net_mask.share_with(net)
+    elif args.mask:
+        net_mask = net
+    print '\n\nLoaded network {:s}'.format(args.caffemodel)
+
+    classes = None
+    if args.classes_file is not None:
+        with open(args.classes_file, 'r') as f:
+            classes = [line.strip() for line in f if line.strip()]
+
+    batcher = Batcher(net, net_mask, max_batch=args.max_batch,
+                      max_latency=args.max_latency,
+                      max_per_image=args.max_per_image, classes=classes,
+                      setup_fn=setup)
+    server = DetectionServer((args.host, args.port), batcher,
+                             thresh=args.thresh)
+    print 'Serving on http://{:s}:{:d}'.format(args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
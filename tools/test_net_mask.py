@@ -13,7 +13,6 @@ import _init_paths
 from fast_rcnn.test import test_net_mask, test_net_mask_reload
 from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
 from datasets.factory import get_imdb
-import caffe
 import argparse
 import pprint
 import time, os, sys
@@ -29,7 +28,9 @@ def parse_args():
                         help='prototxt file defining the network',
                         default=None, type=str)
     parser.add_argument('--def_mask', dest='prototxt_mask',
-                        help='prototxt file defining the network',
+                        help='prototxt file defining the mask network; omit '
+                             'it if --def is a combined net written by '
+                             'tools/combine_mask_deploy.py',
                         default=None, type=str)
     parser.add_argument('--net', dest='caffemodel',
                         help='model to test',
@@ -88,13 +89,6 @@ if __name__ == '__main__':
         print('Waiting for {} to exist...'.format(args.caffemodel))
         time.sleep(10)
 
-    caffe.set_mode_gpu()
-    caffe.set_device(args.gpu_id)
-    net = caffe.Net(args.prototxt, args.caffemodel, caffe.TEST)
-    net.name = os.path.splitext(os.path.basename(args.caffemodel))[0]
-    net_mask = caffe.Net(args.prototxt_mask, args.caffemodel, caffe.TEST)
-    net_mask.name = os.path.splitext(os.path.basename(args.caffemodel))[0]
-
     imdb = get_imdb(args.imdb_name)
     imdb.competition_mode(args.comp_mode)
 
@@ -105,4 +99,3 @@ if __name__ == '__main__':
 
     test_net_mask_reload(args.prototxt, args.prototxt_mask, args.caffemodel, imdb, max_per_image=args.max_per_image,\
                          vis=args.vis, save_path=args.mask_out_path)
-    # test_net_mask(net, net_mask, imdb, max_per_image=args.max_per_image, vis=args.vis, save_path=args.mask_out_path)
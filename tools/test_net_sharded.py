@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Mask R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Test a Fast R-CNN (or Mask R-CNN) network with several worker processes.
+
+The images of the test set are split into interleaved shards, one per
+worker. Each worker holds its own net on a GPU (round robin over --gpu) or
+on the CPU, and streams its detections to a store of its own
+(output_dir/detections_shard<k>of<n>). The stores double as checkpoints: a
+rerun skips the images that are already done. Once every shard is complete,
+the stores are merged in image order into output_dir/detections and
+evaluated.
+"""
+
+import _init_paths
+from fast_rcnn.test import test_net, test_net_mask
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
+from fast_rcnn.model_pool import ModelPool
+from fast_rcnn.det_store import DetectionReader, merge_stores, shard_path
+from datasets.factory import get_imdb
+import caffe
+from multiprocessing import Process
+import argparse
+import pprint
+import time, os, sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Test a Fast R-CNN network with several processes')
+    parser.add_argument('--gpu', dest='gpu_id',
+                        help='GPU ids to use, the shards go round robin',
+                        default="0", type=str)
+    parser.add_argument('--cpu', dest='cpu_mode',
+                        help='run every shard on the CPU',
+                        action='store_true')
+    parser.add_argument('--shards', dest='num_shards',
+                        help='number of worker processes (default: one per '
+                             'GPU)', default=None, type=int)
+    parser.add_argument('--restart', dest='restart',
+                        help='test every image again instead of resuming',
+                        action='store_true')
+    parser.add_argument('--def', dest='prototxt',
+                        help='prototxt file defining the network',
+                        default=None, type=str)
+    parser.add_argument('--def_mask', dest='prototxt_mask',
+                        help='prototxt file defining the mask network; '
+                             'tests masks as tools/test_net_mask.py',
+                        default=None, type=str)
+    parser.add_argument('--mask', dest='mask',
+                        help='test masks with a combined net given by --def',
+                        action='store_true')
+    parser.add_argument('--net', dest='caffemodel',
+                        help='model to test',
+                        default=None, type=str)
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--imdb', dest='imdb_name',
+                        help='dataset to test',
+                        default='voc_2007_test', type=str)
+    parser.add_argument('--comp', dest='comp_mode', help='competition mode',
+                        action='store_true')
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+    parser.add_argument('--num_dets', dest='max_per_image',
+                        help='max number of detections per image',
+                        default=400, type=int)
+    parser.add_argument('--rpn_file', dest='rpn_file',
+                        default=None, type=str)
+    parser.add_argument('--mask_out_path', dest='mask_out_path',
+                        default="./output/mask_out_default", type=str)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+def load_imdb(args):
+    imdb = get_imdb(args.imdb_name)
+    imdb.competition_mode(args.comp_mode)
+
+    if not cfg.TEST.HAS_RPN:
+        imdb.set_proposal_method(cfg.TEST.PROPOSAL_METHOD)
+        if cfg.TEST.PROPOSAL_METHOD == 'rpn':
+            imdb.config['rpn_file'] = args.rpn_file
+    return imdb
+
+def test_shard(args, shard, gpu_id):
+    """Test the images of shard (index, count) in this process."""
+    # the device is only set up in the worker: a CUDA context does not
+    # survive a fork
+    if gpu_id is None:
+        caffe.set_mode_cpu()
+    else:
+        cfg.GPU_ID = gpu_id
+        caffe.set_mode_gpu()
+        caffe.set_device(gpu_id)
+
+    imdb = load_imdb(args)
+    pool = ModelPool()
+    net = pool.get(args.prototxt, args.caffemodel)
+    resume = not args.restart
+    if args.prototxt_mask is not None or args.mask:
+        net_mask = None
+        if args.prototxt_mask is not None:
+            net_mask = pool.get(args.prototxt_mask, args.caffemodel,
+                                share_with=net)
+        test_net_mask(net, net_mask, imdb, max_per_image=args.max_per_image,
+                      save_path=args.mask_out_path, mask_scale=10,
+                      shard=shard, resume=resume)
+    else:
+        test_net(net, imdb, max_per_image=args.max_per_image, shard=shard,
+                 resume=resume)
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    print('Called with args:')
+    print(args)
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+
+    gpus = [int(i) for i in args.gpu_id.split(',')]
+    num_shards = args.num_shards or len(gpus)
+    if args.cpu_mode:
+        cfg.USE_GPU_NMS = False
+
+    print('Using config:')
+    pprint.pprint(cfg)
+
+    while not os.path.exists(args.caffemodel):
+        print('Waiting for {} to exist...'.format(args.caffemodel))
+        time.sleep(10)
+
+    start_time = time.time()
+    procs = []
+    for k in xrange(num_shards):
+        gpu_id = None if args.cpu_mode else gpus[k % len(gpus)]
+        p = Process(target=test_shard, args=(args, (k, num_shards), gpu_id))
+        p.daemon = False
+        p.start()
+        procs.append(p)
+    for p in procs:
+        p.join()
+    failed = [k for k, p in enumerate(procs) if p.exitcode != 0]
+    if failed:
+        print 'Shards {} failed; rerun to resume them'.format(failed)
+        sys.exit(1)
+    print 'Tested {:d} shards in {:.1f}s'.format(num_shards,
+                                                 time.time() - start_time)
+
+    imdb = load_imdb(args)
+    net_name = os.path.splitext(os.path.basename(args.caffemodel))[0]
+    output_dir = os.path.join(get_output_dir(imdb), net_name)
+    det_path = os.path.join(output_dir, 'detections')
+    missing = merge_stores([shard_path(det_path, (k, num_shards))
+                            for k in xrange(num_shards)], det_path)
+    assert not missing, \
+        '{:d} images are missing from the shards'.format(len(missing))
+    print 'Merged the shards into: {:s}'.format(det_path)
+
+    print 'Evaluating detections'
+    imdb.evaluate_detections(DetectionReader(det_path).all_boxes(), output_dir)